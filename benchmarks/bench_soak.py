@@ -0,0 +1,96 @@
+"""
+Soak test of the OpenGL resource lifecycle of BlocksWorld3D
+
+Runs many resets, each followed by a render and an occlusion-query
+visibility call, and periodically closes and recreates the environment.
+Live OpenGL object counts and the resident memory of the process are
+sampled along the way, and must stay flat once the first rounds are
+done. Each recreated environment must render the same frames as the
+first one. Usage:
+
+    python benchmarks/bench_soak.py [--resets N] [--recreate-every N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+# Import the package of this checkout, without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blocksworld3d import BlocksWorld3D  # noqa: E402
+from blocksworld3d.utils.opengl import GLResources  # noqa: E402
+
+
+def rss_bytes():
+    """
+    Resident memory of the process, in bytes
+    """
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resets", type=int, default=100000)
+    parser.add_argument("--recreate-every", type=int, default=1000)
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--problem", default="stairs")
+    # Allowed growth of the resident memory after warmup, in MiB
+    parser.add_argument("--max-growth", type=float, default=16)
+    args = parser.parse_args()
+
+    sample_every = max(args.resets // args.samples, 1)
+    warmup = min(2 * args.recreate_every, args.resets // 4)
+
+    options = {"problem_instance": args.problem}
+    env = BlocksWorld3D(render_quality="low")
+    ref_obs, _ = env.reset(seed=0, options=options)
+    rss_samples = []
+    live_samples = []
+    t0 = time.perf_counter()
+
+    for i in range(args.resets):
+        if i > 0 and i % args.recreate_every == 0:
+            env.close()
+            env = BlocksWorld3D(render_quality="low")
+
+            # Objects freed with the previous context must not be reused
+            obs, _ = env.reset(seed=0, options=options)
+            assert np.array_equal(obs, ref_obs), "frames differ after recreating"
+
+        env.reset(seed=i, options=options)
+        env.get_visible_ents(method="gl")
+
+        if (i + 1) % sample_every == 0:
+            live = dict(GLResources.live)
+            rss = rss_bytes()
+            print(
+                "resets %8d   %7.1f resets/s   rss %8.1f MiB   live %s"
+                % (i + 1, (i + 1) / (time.perf_counter() - t0), rss / 2**20, live)
+            )
+            if i >= warmup:
+                rss_samples.append(rss)
+                live_samples.append(live)
+
+    env.close()
+    live = {kind: count for kind, count in GLResources.live.items() if count}
+    print("live after close:", live)
+
+    # Only the shared textures remain once every environment is closed
+    assert set(live) <= {"textures"}, "leaked OpenGL objects: %s" % live
+    assert all(s == live_samples[0] for s in live_samples), "OpenGL objects grow"
+
+    growth = (max(rss_samples) - rss_samples[0]) / 2**20 if rss_samples else 0
+    print("rss growth after warmup: %.1f MiB" % growth)
+    assert growth <= args.max_growth, "resident memory grows"
+
+    print("ok, mean %.2f ms per reset" % (1000 * (time.perf_counter() - t0) / args.resets))
+
+
+if __name__ == "__main__":
+    main()
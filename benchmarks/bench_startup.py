@@ -0,0 +1,71 @@
+"""
+Measure the import, construction and first-render times of BlocksWorld3D
+
+Each measurement runs in a fresh interpreter so that module caches do not
+hide the import cost. Usage:
+
+    python benchmarks/bench_startup.py [--repeats N]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SNIPPET = """
+import json, sys, time
+
+t0 = time.perf_counter()
+import blocksworld3d
+t1 = time.perf_counter()
+env = blocksworld3d.BlocksWorld3D()
+t2 = time.perf_counter()
+gl_loaded = "pyglet.gl" in sys.modules
+env.reset(seed=0)
+t3 = time.perf_counter()
+
+print(json.dumps({
+    "import": t1 - t0,
+    "construct": t2 - t1,
+    "first_reset": t3 - t2,
+    "gl_loaded_before_render": gl_loaded,
+}))
+"""
+
+
+def run_once():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in [repo_dir, env.get("PYTHONPATH")] if p
+    )
+    out = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", SNIPPET],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.repeats)]
+
+    for key in ["import", "construct", "first_reset"]:
+        times = sorted(r[key] for r in results)
+        print(
+            "%-12s median %8.2f ms   min %8.2f ms"
+            % (key, 1000 * times[len(times) // 2], 1000 * times[0])
+        )
+
+    print("OpenGL loaded before first render:", results[0]["gl_loaded_before_render"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 import gymnasium as gym
 from .blocksworld3d import BlocksWorld3D
 from .utils.problems import get_problem_list, get_problem_instance
+from .utils.replay import ReplayEngine
+from .utils.vector import BlocksWorld3DBatch
 
 __all__ = [
     "BlocksWorld3D",
     "get_problem_list",
     "get_problem_instance",
+    "ReplayEngine",
+    "BlocksWorld3DBatch",
 ]
 
 gym.register(
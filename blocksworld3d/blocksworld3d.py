@@ -1,38 +1,88 @@
-import math
 import numpy as np
 
 from gymnasium import utils
-from .utils.entity import Block
+from .utils.compositor import LayerCompositor
+from .utils.entity import Block, BlockPool
 from .utils.core import MiniWorldEnv
+from .utils.grid import BlockGrid
+from .utils.opengl import Preprocess
 from .utils.problems import get_problem_instance
+from .utils.symbolic import (
+    MAX_STACK_HEIGHT,
+    SymbolicState,
+    action_masks,
+    plan_macro,
+    sample_start_col,
+)
 
 
 class BlocksWorld3D(MiniWorldEnv, utils.EzPickle):
     BLOCK_SIZE = 0.8
+    # Distance along x between consecutive rows of stacks
+    ROW_SPACING = 3
 
-    def __init__(self, size=8, **kwargs):
+    def __init__(self, size=8, max_height=MAX_STACK_HEIGHT, obs_backend="gl", **kwargs):
+        assert obs_backend in ("gl", "composite"), "unknown observation backend"
         self.size = size
+        self.max_height = max_height
         self.cur_row = 0
         self.prev_move = None
-        self.spots = [[np.array((4, 0, z)) for z in range(2, self.size - 1)],
-                      [np.array((7, 0, z)) for z in range(2, self.size - 1)]]
+        self.start_col = None
+        # Stack layout, set from the shape of each problem instance
+        self.spots = None
+        self.grid = None
+        # Block entities, reused by every episode
+        self.block_pool = BlockPool(self.BLOCK_SIZE)
+        
+        # Observations composited from prerendered layers, see utils.compositor
+        self.compositor = LayerCompositor() if obs_backend == "composite" else None
         
         MiniWorldEnv.__init__(self, max_episode_steps=100, **kwargs)
-        utils.EzPickle.__init__(self, size, **kwargs)
+        utils.EzPickle.__init__(self, size, max_height, obs_backend=obs_backend, **kwargs)
+
+        if self.compositor is not None:
+            assert self.obs_channels == ("rgb",), "composited observations are rgb only"
+            assert self.obs_preprocess == Preprocess(), "composited observations are not preprocessed"
+            assert not self.domain_rand, "composited observations need fixed colors"
     
+    def _reset_world(self, seed=None, options=None):
+        # The start column may be sampled ahead of time for a batch of envs
+        self.start_col = (options or {}).get('start_col')
+        super()._reset_world(seed=seed, options=options)
+
     def _gen_world(self, problem_instance):
         """Generate the world based on the problem ID."""
+        start, goal = get_problem_instance(problem_instance)
+        self._set_layout(np.shape(start))
+        self.cur_row = 0
+        self.prev_move = None
         self._create_room()
         self._place_agent()
-        self.blocks, self.state, self.goal = self._gen_blocks(problem_instance)
+        self.blocks, self.goal = self._place_blocks(start), goal
+        self._reset_goal_counters()
+
+    def _set_layout(self, shape):
+        """Position the stacks for a problem with the given (rows, cols) shape."""
+        if self.grid is not None and self.grid.heights.shape == shape:
+            return
+
+        num_rows, num_cols = shape
+        xs = 4 + self.ROW_SPACING * np.arange(num_rows)
+        zs = 2 + np.arange(num_cols)
+        self.spots = np.zeros((num_rows, num_cols, 3))
+        self.spots[..., 0] = xs[:, np.newaxis]
+        self.spots[..., 2] = zs
+        self.grid = BlockGrid(self.spots, self.BLOCK_SIZE, self.max_height)
 
     def _create_room(self):
         """Add room with specific boundaries and textures."""
+        # Grow the room past the default size to fit larger layouts
+        num_rows, num_cols = self.grid.heights.shape
         self.add_rect_room(
             min_x=0,
-            max_x=self.size,
+            max_x=max(self.size, int(self.spots[-1, 0, 0]) + 1),
             min_z=0,
-            max_z=self.size,
+            max_z=max(self.size, num_cols + 3),
             wall_tex="brick_wall",
             floor_tex="asphalt",
             no_ceiling=False,
@@ -41,49 +91,184 @@ class BlocksWorld3D(MiniWorldEnv, utils.EzPickle):
     def _place_agent(self):
         """Place the agent in the world."""
         self.agent.radius = 1
-        loc = np.random.choice((2, self.size-2))
-        self.place_agent(pos=(2, 0, loc), dir=0)
+        col = self.start_col
+        if col is None:
+            col = sample_start_col(self.np_random, self.grid.num_cols)
+        self.place_agent(pos=self._agent_pos(col), dir=0)
 
-    def _gen_blocks(self, problem_instance):
-        """Generate blocks based on the problem instance."""
-        blocks = []
-        start, goal = get_problem_instance(problem_instance)
-        
-        for row_idx, row in enumerate(start):
-            for stack_idx, stack in enumerate(row):
-                if stack != 0:
-                    prev_block = None
-                    for block_idx in range(stack):
-                        block = Block(color='blue', size=self.BLOCK_SIZE)
-                        pos = self.spots[row_idx][stack_idx] + np.array((0, block_idx * self.BLOCK_SIZE, 0))
-                        self.place_entity(block, pos=pos, dir=0)
-
-                        if prev_block:
-                            prev_block.is_beneath = block
-                            block.is_above = prev_block
-
-                        blocks.append(block)
-                        prev_block = block
-
-        return blocks, start, goal
-
-    def step(self, action):
-        """Step the environment with the given action."""
-        obs, reward, termination, truncation, info = super().step(action)
+    def _agent_pos(self, col):
+        """Position of the agent facing the given column."""
+        return (2, 0, self.spots[0, col, 2])
+
+    def _place_blocks(self, heights, num_extra=0):
+        """Fill the block grid and bind one pooled block entity per grid block."""
+        self.grid.fill(heights, num_extra)
+        blocks = self.block_pool.get(self.grid, color='blue')
+
+        for block in blocks:
+            self.place_entity(block, pos=block.pos, dir=0)
+
+        return blocks
+
+    def render_obs(self, frame_buffer=None):
+        """Render the agent view, composited without OpenGL when possible."""
+        if self.compositor is not None and (frame_buffer is None or frame_buffer is self.obs_fb):
+            return self.compositor.compose([self])[0]
+        return super().render_obs(frame_buffer)
+
+    @property
+    def state(self):
+        """Stack heights of each row, as nested lists."""
+        return self.grid.heights.tolist()
+
+    @property
+    def symbolic_state(self):
+        """Discrete state of the episode, see utils.symbolic."""
+        return SymbolicState(
+            col=self.grid.col_at(self.agent.pos),
+            row=int(self.cur_row),
+            prev_move=self.prev_move,
+            carrying=self.agent.carrying is not None,
+            heights=tuple(tuple(row) for row in self.state),
+        )
+
+    def render_symbolic_top_view(self, cell_size=4):
+        """
+        Low-resolution top view drawn from the block grid, without OpenGL.
+        Each meter of the floor is a cell of cell_size pixels, x to the
+        right and z down as in render_top_view. Stacks are blue with a
+        brightness proportional to their height, stacks of the current
+        row are tinted green, and the agent is red (magenta if carrying).
+        """
+
+        size_x = int(np.ceil(self.max_x - self.min_x))
+        size_z = int(np.ceil(self.max_z - self.min_z))
+        img = np.zeros((size_z, size_x, 3), dtype=np.uint8)
+
+        # Stack cells, indexed by (z, x)
+        xs = (self.spots[..., 0] - self.min_x).astype(int)
+        zs = (self.spots[..., 2] - self.min_z).astype(int)
+        img[zs, xs, 2] = 55 + 200 * self.grid.heights // self.grid.max_height
+        img[zs[self.cur_row], xs[self.cur_row], 1] = 96
+
+        x, _, z = self.agent.pos
+        agent_cell = int(z - self.min_z), int(x - self.min_x)
+        img[agent_cell] = (255, 0, 255) if self.agent.carrying else (255, 0, 0)
+
+        return np.repeat(np.repeat(img, cell_size, axis=0), cell_size, axis=1)
+
+    def set_symbolic_state(self, sym_state):
+        """Rebuild the blocks and the agent pose from a symbolic state."""
+        if np.shape(sym_state.heights) != self.grid.heights.shape:
+            # Build a room for the new layout first
+            self._reset_world(options={'problem_instance': {
+                'start': sym_state.heights, 'goal': sym_state.heights}})
+
+        self.entities = [ent for ent in self.entities if not isinstance(ent, Block)]
+        self.blocks = self._place_blocks(sym_state.heights, num_extra=int(sym_state.carrying))
+        self.cur_row = sym_state.row
+        self.prev_move = sym_state.prev_move
+        self.agent.pos = self._agent_pos(sym_state.col)
+        self.agent.carrying = None
+
+        if sym_state.carrying:
+            block = self.blocks[-1]
+            block.pos = self._get_carry_pos(self.agent.pos, block)
+            block.dir = self.agent.dir
+            self.agent.carrying = block
+
+        rand = self.np_random if self.domain_rand else None
+        Block.randomize_many(self.blocks, self.params, rand)
+
+        self._reset_goal_counters()
+
+    def _reset_goal_counters(self):
+        """Recompute the distance to the goal from the block grid."""
+        self.goal_heights = np.array(self.goal, dtype=np.int32)
+        # Stack height minus goal height, for each column of each row
+        self.height_deltas = self.grid.heights - self.goal_heights
+        # Number of stacks whose height differs from the goal
+        self.num_mismatched = int(np.count_nonzero(self.height_deltas))
+
+    def _step_reward(self):
+        """Reward of the last step, with termination once the goal is reached."""
+        reward, termination, truncation = super()._step_reward()
         
-        if self.state == self.goal:
+        if self.num_mismatched == 0:
             reward = 10
             termination = True
         
         reward = -0.1 if reward == 0 else reward
                 
-        return obs, reward, termination, truncation, info
+        return reward, termination, truncation
     
+    def step_macro(self, macro):
+        """
+        Execute a macro-action, see utils.symbolic.plan_macro. Its primitive
+        actions are applied without rendering and only the final frame is
+        rendered. Returns the summed reward, info['num_steps'] holds the
+        number of primitive actions taken.
+        """
+        reward, termination, truncation, num_steps = self._step_macro_world(macro)
+        obs = self.render_obs()
+        info = self._get_info()
+        info['num_steps'] = num_steps
+        return obs, reward, termination, truncation, info
+
+    def _step_macro_world(self, macro):
+        """Apply the primitive actions of a macro-action until the episode ends."""
+        return self._step_plan(self.plan_macro(macro))
+
+    def plan_macro(self, macro):
+        """Primitive actions of a macro-action, raises ValueError if impossible."""
+        return plan_macro(self.symbolic_state, macro, self.grid.max_height)
+
+    def _step_plan(self, actions):
+        """Apply planned primitive actions until the episode ends."""
+        total_reward = 0
+        termination = truncation = False
+
+        for num_steps, action in enumerate(actions, 1):
+            self._step_world(action)
+            reward, termination, truncation = self._step_reward()
+            total_reward += reward
+            if termination or truncation:
+                return total_reward, termination, truncation, num_steps
+
+        return total_reward, termination, truncation, len(actions)
+
+    def action_masks(self):
+        """Mask of the actions that change the current state, done only if none does."""
+        return action_masks(
+            col=[self.grid.col_at(self.agent.pos)],
+            row=[self.cur_row],
+            prev_move=[self.prev_move or 0],
+            carrying=[self.agent.carrying is not None],
+            heights=self.grid.heights[np.newaxis],
+            max_height=self.grid.max_height,
+        )[0]
+
+    def _get_info(self):
+        """Distance to the goal, usable for reward shaping, and valid actions."""
+        return {
+            'num_mismatched': self.num_mismatched,
+            'height_deltas': self.height_deltas.copy(),
+            'action_mask': self.action_masks(),
+        }
+
     def update_representation(self, loc, action):
         """Update the internal representation of the blocksworld state."""
-        if action is 'pickup':
-            # Remove block from state during pickup action
-            self.state[self.cur_row][loc] -= 1
+        if action == 'pickup':
+            # Remove block from its stack during pickup action
+            self.grid.pop(self.cur_row, loc)
+            change = -1
         else:
-            # Add block to state during drop action
-            self.state[self.cur_row][loc] += 1
\ No newline at end of file
+            # Add the carried block to the stack during drop action
+            self.grid.push(self.cur_row, loc, self.agent.carrying.id)
+            change = 1
+
+        # Only this stack changed, update the goal counters incrementally
+        was_matched = self.height_deltas[self.cur_row, loc] == 0
+        self.height_deltas[self.cur_row, loc] += change
+        is_matched = self.height_deltas[self.cur_row, loc] == 0
+        self.num_mismatched += int(was_matched) - int(is_matched)
\ No newline at end of file
@@ -0,0 +1,73 @@
+"""
+Mirror-symmetry augmentation of logged transitions
+
+Reversing the columns, and swapping the two rows of a two-row layout, map
+episodes to equally valid episodes. Transitions are mirrored by remapping
+their actions and symbolic states, without stepping any environment.
+Mirrored frames are composited from the prerendered layers of an
+environment, see utils.compositor. Without one, frames with reversed columns
+are flipped horizontally, which also mirrors the room textures and lighting.
+"""
+
+import numpy as np
+
+from .symbolic import Actions
+
+# Lateral moves exchanged by reversing the columns
+MIRRORED_ACTIONS = np.arange(len(Actions))
+MIRRORED_ACTIONS[[Actions.move_left, Actions.move_right]] = [Actions.move_right, Actions.move_left]
+
+
+def mirror_action(action, flip_cols=True):
+    """
+    Action of the mirrored episode, toggling rows is unchanged with two rows
+    """
+
+    return Actions(MIRRORED_ACTIONS[action]) if flip_cols else Actions(action)
+
+
+def mirror_state(state, flip_cols=True, swap_rows=False):
+    """
+    Symbolic state of the mirrored episode
+    """
+
+    col, row, prev_move, heights = state.col, state.row, state.prev_move, state.heights
+
+    if flip_cols:
+        col = len(heights[0]) - 1 - col
+        prev_move = None if prev_move is None else -prev_move
+        heights = tuple(tuple(reversed(stacks)) for stacks in heights)
+
+    if swap_rows:
+        assert len(heights) == 2, "only two rows can be swapped"
+        row = 1 - row
+        heights = heights[::-1]
+
+    return state._replace(col=col, row=row, prev_move=prev_move, heights=heights)
+
+
+def mirror_transitions(obs, actions, states, flip_cols=True, swap_rows=False, env=None):
+    """
+    Mirror a batch of transitions
+    obs holds the (N, H, W, C) frames of the symbolic states, and actions the
+    (N,) actions taken from them. Returns the mirrored frames, actions and
+    states. The frames are composited when env has the composite observation
+    backend and the layout of the states, swapping rows requires it.
+    Otherwise, reversing the columns flips the frames.
+    """
+
+    obs = np.asarray(obs)
+    assert len(obs) == len(actions) == len(states)
+
+    states = [mirror_state(state, flip_cols, swap_rows) for state in states]
+    actions = MIRRORED_ACTIONS[np.asarray(actions)] if flip_cols else np.array(actions)
+
+    if env is not None and env.compositor is not None:
+        assert obs.shape[1:] == env.observation_space.shape
+        obs = env.compositor.compose_states(env, states)
+    elif swap_rows:
+        raise ValueError("swapping rows needs an environment with obs_backend='composite'")
+    else:
+        obs = np.ascontiguousarray(np.flip(obs, axis=2)) if flip_cols else obs.copy()
+
+    return obs, actions, states
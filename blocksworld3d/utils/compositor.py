@@ -0,0 +1,282 @@
+"""
+Observations composited from prerendered layers
+
+The agent camera only takes one pose per column, and blocks only sit in the
+stacks of the block grid, or in front of the agent when carried. For each
+camera pose, the static room and a sprite of each (row, column, height)
+stack are rendered once. Observations are then produced with NumPy, by
+compositing the sprites of the stacks over the room in depth order, so no
+OpenGL is needed once every pose was seen.
+"""
+
+import numpy as np
+
+from . import gl
+from .core import INACTIVE_ROW_OPACITY
+from .entity import COLORS, Block
+from .opengl import FrameBuffer
+
+
+class LayerCompositor:
+    """
+    Prerendered layers of the scenes seen by a set of environments
+    Environments with the same layout and rendering parameters share the
+    same layers, and their observations are composited in a single batch.
+    """
+
+    def __init__(self):
+        # Layers of each scene, indexed by scene_key
+        self.scenes = {}
+
+    @staticmethod
+    def scene_key(env):
+        """
+        Parameters that the rendered layers depend on
+        """
+
+        # Without domain randomization, all the blocks have the same color
+        colors = env.grid.colors
+        assert np.all(colors == colors[:1]), "blocks must all have the same color"
+        color = tuple(colors[0]) if len(colors) > 0 else None
+
+        agent = env.agent
+        return (
+            env.grid.heights.shape,
+            env.grid.max_height,
+            (env.min_x, env.max_x, env.min_z, env.max_z),
+            (env.obs_width, env.obs_height, env.render_quality, env.render_pipeline),
+            (agent.cam_height, agent.cam_pitch, agent.cam_fov_y, agent.cam_fwd_disp, agent.radius),
+            tuple(np.concatenate([env.sky_color, env.light_pos, env.light_color, env.light_ambient])),
+            color,
+        )
+
+    def compose(self, envs):
+        """
+        Observations of a list of environments, shape (num_envs, H, W, 3)
+        Camera poses seen for the first time are rendered with OpenGL
+        """
+
+        env = envs[0]
+        frames = np.empty((len(envs), env.obs_height, env.obs_width, 3), dtype=np.uint8)
+
+        groups = {}
+        for i, env in enumerate(envs):
+            key = self.scene_key(env)
+            if key not in self.scenes:
+                self.scenes[key] = SceneLayers(env)
+            groups.setdefault(key, []).append(i)
+
+        for key, idxs in groups.items():
+            frames[idxs] = self.scenes[key].compose([envs[i] for i in idxs])
+
+        for env, frame in zip(envs, frames):
+            env.last_obs = frame
+
+        return frames
+
+    def compose_states(self, env, states):
+        """
+        Observations of symbolic states, see utils.symbolic, in the scene of
+        an environment, shape (num_states, H, W, 3). The states must have
+        the layout of the current episode of the environment.
+        """
+
+        key = self.scene_key(env)
+        if key not in self.scenes:
+            self.scenes[key] = SceneLayers(env)
+
+        return self.scenes[key].compose_states(
+            [env] * len(states),
+            [state.col for state in states],
+            [state.row for state in states],
+            [state.carrying for state in states],
+            [state.heights for state in states],
+        )
+
+    def memory_bytes(self):
+        """
+        Memory used by the prerendered layers, in bytes
+        """
+
+        return sum(scene.memory_bytes() for scene in self.scenes.values())
+
+
+class SceneLayers:
+    """
+    Room background and stack sprites of one scene, for each camera pose
+    """
+
+    def __init__(self, env):
+        grid = env.grid
+        self.num_cols = grid.num_cols
+        self.max_height = grid.max_height
+
+        # Sprite of each (row, column, height) stack, with its top block at
+        # each level, then of the carried block, then of each stack again
+        # with the opacity of the rows other than the current one
+        self.stacks = np.argwhere(np.ones(grid.ids.shape, dtype=bool))
+        self.carried = len(self.stacks)
+        self.inactive = self.carried + 1
+        num_sprites = self.inactive + len(self.stacks)
+
+        # Depth rank of each sprite from each pose. The stacks are separated
+        # by the planes between rows and between columns, so the farther
+        # rows, then the columns farther from the camera, are behind. The
+        # carried block is in front of everything.
+        poses = np.arange(self.num_cols)[:, np.newaxis]
+        rows, cols, _ = self.stacks.T
+        ranks = rows * self.num_cols + np.abs(cols - poses)
+        self.depths = np.concatenate([ranks, np.full((self.num_cols, 1), -1), ranks], axis=1)
+        assert self.depths.shape[1] == num_sprites
+
+        # Background of each pose, and the (y0, y1, x0, x1, premultiplied
+        # rgb, alpha) bounding box of each sprite
+        self.backgrounds = np.zeros((self.num_cols, env.obs_height, env.obs_width, 3), dtype=np.float32)
+        self.sprites = [None] * self.num_cols
+
+    def _render_pose(self, env, col):
+        """
+        Render the background and the sprites seen from a column
+        """
+
+        env._init_context()
+        env._make_current()
+
+        profile = env.render_profile
+        fb = FrameBuffer(
+            env.obs_width,
+            env.obs_height,
+            profile.obs_samples,
+            color_format=profile.color_format,
+            resolve_depth=False,
+            resources=env.gl_resources,
+        )
+
+        agent = env.agent
+        agent_pos, agent_dir = agent.pos, agent.dir
+        agent.pos, agent.dir = np.array(env._agent_pos(col), dtype=float), 0
+
+        try:
+            # Static parts of the room, over the sky
+            fb.bind()
+            gl.glClearColor(*env.sky_color, 1.0)
+            gl.glClearDepth(1.0)
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            env._load_agent_camera(fb)
+            if env.static_dirty:
+                env._render_static()
+                env.static_dirty = False
+            env._setup_lighting()
+            gl.glCallList(env.static_list)
+            self.backgrounds[col] = fb.resolve(raw=True)
+
+            block = Block(color="blue", size=env.BLOCK_SIZE)
+            block.color_vec = env.grid.colors[0] if env.grid.num_blocks > 0 else COLORS["blue"]
+            block.dir = 0
+
+            # Blocks of each sprite, stacks are rendered whole so the faces
+            # hidden between their blocks are resolved by the depth test
+            layers = [
+                env.grid.cell_positions([(row, stack_col, level) for level in range(top + 1)])
+                for row, stack_col, top in self.stacks
+            ]
+            layers.append([env._get_carry_pos(agent.pos, block)])
+            layers += layers[: self.carried]
+
+            sprites = []
+            for sprite, positions in enumerate(layers):
+                opacity = 1 if sprite < self.inactive else INACTIVE_ROW_OPACITY
+
+                fb.bind()
+                gl.glClearColor(0, 0, 0, 0)
+                gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+                env._load_agent_camera(fb)
+                env._setup_lighting()
+
+                # From far to near, as translucent blocks are drawn
+                dists = np.linalg.norm(np.asarray(positions) - agent.cam_pos, axis=1)
+                for i in np.argsort(-dists, kind="stable"):
+                    block.pos = positions[i]
+                    block.render(opacity)
+
+                rgba = fb.resolve(alpha=True)
+                ys, xs = np.nonzero(rgba[..., 3])
+                if len(ys) == 0:
+                    sprites.append(None)
+                    continue
+
+                y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+                crop = rgba[y0:y1, x0:x1].astype(np.float32)
+                sprites.append((y0, y1, x0, x1, crop[..., :3], crop[..., 3] / 255))
+        finally:
+            agent.pos, agent.dir = agent_pos, agent_dir
+            fb.delete()
+
+        self.sprites[col] = sprites
+
+    def compose(self, envs):
+        """
+        Composite the observations of environments of this scene
+        """
+
+        return self.compose_states(
+            envs,
+            [env.grid.col_at(env.agent.pos) for env in envs],
+            [env.cur_row for env in envs],
+            [env.agent.carrying is not None for env in envs],
+            [env.grid.heights for env in envs],
+        )
+
+    def compose_states(self, envs, poses, cur_rows, carrying, heights):
+        """
+        Composite the observations of states given by the column the agent
+        faces, the current row, whether a block is carried and the stack
+        heights. Camera poses seen for the first time are rendered with the
+        environment of the state.
+        """
+
+        env = envs[0]
+        frames = np.empty((len(envs), env.obs_height, env.obs_width, 3), dtype=np.uint8)
+
+        for i, (env, col, cur_row, is_carrying, stacks) in enumerate(
+            zip(envs, poses, cur_rows, carrying, heights)
+        ):
+            if self.sprites[col] is None:
+                self._render_pose(env, col)
+
+            # Sprites of the non-empty stacks, from far to near
+            stacks = np.asarray(stacks)
+            rows, cols = np.nonzero(stacks)
+            sprites = (rows * self.num_cols + cols) * self.max_height + stacks[rows, cols] - 1
+            sprites[rows != cur_row] += self.inactive
+
+            if is_carrying:
+                sprites = np.append(sprites, self.carried)
+
+            sprites = sprites[np.argsort(-self.depths[col, sprites], kind="stable")]
+
+            img = self.backgrounds[col].copy()
+            for sprite in sprites:
+                layer = self.sprites[col][sprite]
+                if layer is None:
+                    continue
+
+                y0, y1, x0, x1, rgb, alpha = layer
+                region = img[y0:y1, x0:x1]
+                region *= 1 - alpha[..., np.newaxis]
+                region += rgb
+
+            np.round(img, out=img)
+            frames[i] = img
+
+        return frames
+
+    def memory_bytes(self):
+        sprite_bytes = sum(
+            layer[4].nbytes + layer[5].nbytes
+            for sprites in self.sprites
+            if sprites is not None
+            for layer in sprites
+            if layer is not None
+        )
+        return self.backgrounds.nbytes + self.depths.nbytes + sprite_bytes
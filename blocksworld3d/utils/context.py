@@ -0,0 +1,272 @@
+"""
+OpenGL context backends
+
+pyglet -- invisible pyglet window, needs an X server (or PYGLET_HEADLESS)
+egl    -- surfaceless EGL context, no display server needed
+osmesa -- Mesa off-screen context, software rendering only
+
+Environments render into frame buffer objects, so the backends only need to
+provide a current context. The backend is selected with the `gl_backend`
+argument of MiniWorldEnv or the BLOCKSWORLD3D_GL_BACKEND environment variable.
+"""
+
+import ctypes
+import ctypes.util
+import os
+
+import pyglet
+
+from . import gl
+
+# Names of the available context backends
+BACKENDS = ["pyglet", "egl", "osmesa"]
+
+# EGL enums
+EGL_DEFAULT_DISPLAY = None
+EGL_NO_CONTEXT = None
+EGL_NO_SURFACE = None
+EGL_NONE = 0x3038
+EGL_SURFACE_TYPE = 0x3033
+EGL_PBUFFER_BIT = 0x0001
+EGL_RENDERABLE_TYPE = 0x3040
+EGL_OPENGL_BIT = 0x0008
+EGL_OPENGL_API = 0x30A2
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+# OSMesa enums
+OSMESA_RGBA = 0x1908
+GL_UNSIGNED_BYTE = 0x1401
+
+
+def get_backend_name(name=None):
+    """
+    Resolve the name of the context backend to use
+    """
+
+    if name is None:
+        name = os.environ.get("BLOCKSWORLD3D_GL_BACKEND", "pyglet")
+
+    assert name in BACKENDS, 'unknown OpenGL backend "%s"' % name
+
+    return name
+
+
+def create_context(name=None):
+    """
+    Create a new OpenGL context and make it current
+    """
+
+    name = get_backend_name(name)
+
+    # pyglet checks errors after every call, which needs a pyglet context
+    if name != "pyglet" and not gl.loaded:
+        pyglet.options["debug_gl"] = False
+
+    gl.load()
+
+    if name == "egl":
+        return EGLContext()
+    if name == "osmesa":
+        return OSMesaContext()
+    return PygletContext()
+
+
+def _load_library(name, default):
+    path = ctypes.util.find_library(name) or default
+    return ctypes.CDLL(path)
+
+
+class PygletContext:
+    """
+    Context owned by an invisible pyglet window
+    """
+
+    def __init__(self):
+        self.window = pyglet.window.Window(width=1, height=1, visible=False)
+
+        # The objects of the window do not outlive it
+        self.share_group = self
+
+    def switch_to(self):
+        self.window.switch_to()
+
+    def close(self):
+        self.window.close()
+
+
+class EGLContext:
+    """
+    Surfaceless EGL context, works without a display server
+    """
+
+    # Library, display and first context, shared by all contexts of a process
+    lib = None
+    display = None
+    share_context = None
+
+    # Objects are shared with the first context, which is never destroyed
+    share_group = "egl"
+
+    def __init__(self):
+        if EGLContext.lib is None:
+            EGLContext._init_display()
+
+        egl = EGLContext.lib
+        display = EGLContext.display
+
+        # Surfaceless displays only have pbuffer configs, not window ones
+        attribs = (ctypes.c_int * 5)(
+            EGL_SURFACE_TYPE,
+            EGL_PBUFFER_BIT,
+            EGL_RENDERABLE_TYPE,
+            EGL_OPENGL_BIT,
+            EGL_NONE,
+        )
+        config = ctypes.c_void_p()
+        num_configs = ctypes.c_int()
+        ok = egl.eglChooseConfig(
+            display, attribs, ctypes.byref(config), 1, ctypes.byref(num_configs)
+        )
+        assert ok and num_configs.value > 0, "no EGL config supports OpenGL"
+
+        # Share textures and display lists with the first context
+        self.context = egl.eglCreateContext(
+            display, config, EGLContext.share_context, None
+        )
+        assert self.context, "failed to create EGL context"
+
+        if EGLContext.share_context is None:
+            EGLContext.share_context = self.context
+
+        self.switch_to()
+
+    @classmethod
+    def _init_display(cls):
+        egl = _load_library("EGL", "libEGL.so.1")
+
+        egl.eglGetProcAddress.restype = ctypes.c_void_p
+        egl.eglGetProcAddress.argtypes = [ctypes.c_char_p]
+        egl.eglGetDisplay.restype = ctypes.c_void_p
+        egl.eglGetDisplay.argtypes = [ctypes.c_void_p]
+        egl.eglInitialize.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        egl.eglBindAPI.argtypes = [ctypes.c_uint]
+        egl.eglChooseConfig.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        egl.eglCreateContext.restype = ctypes.c_void_p
+        egl.eglCreateContext.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+        ]
+        egl.eglMakeCurrent.argtypes = [ctypes.c_void_p] * 4
+        egl.eglDestroyContext.argtypes = [ctypes.c_void_p] * 2
+
+        # Prefer Mesa's surfaceless platform, which needs no device or display
+        display = None
+        get_platform_display = egl.eglGetProcAddress(b"eglGetPlatformDisplayEXT")
+        if get_platform_display:
+            get_platform_display = ctypes.CFUNCTYPE(
+                ctypes.c_void_p, ctypes.c_uint, ctypes.c_void_p, ctypes.c_void_p
+            )(get_platform_display)
+            display = get_platform_display(
+                EGL_PLATFORM_SURFACELESS_MESA, EGL_DEFAULT_DISPLAY, None
+            )
+
+        if not display:
+            display = egl.eglGetDisplay(EGL_DEFAULT_DISPLAY)
+
+        major, minor = ctypes.c_int(), ctypes.c_int()
+        ok = egl.eglInitialize(display, ctypes.byref(major), ctypes.byref(minor))
+        assert ok, "failed to initialize EGL display"
+
+        ok = egl.eglBindAPI(EGL_OPENGL_API)
+        assert ok, "EGL implementation does not support desktop OpenGL"
+
+        cls.lib = egl
+        cls.display = display
+
+    def switch_to(self):
+        ok = EGLContext.lib.eglMakeCurrent(
+            EGLContext.display, EGL_NO_SURFACE, EGL_NO_SURFACE, self.context
+        )
+        assert ok, "failed to make EGL context current"
+        gl.gl_info.set_active_context()
+
+    def close(self):
+        # The first context is kept alive, others may share its objects
+        if self.context is None or self.context == EGLContext.share_context:
+            return
+
+        egl = EGLContext.lib
+        egl.eglMakeCurrent(EGLContext.display, None, None, EGL_NO_CONTEXT)
+        egl.eglDestroyContext(EGLContext.display, self.context)
+        self.context = None
+
+
+class OSMesaContext:
+    """
+    Mesa off-screen rendering context, software rasterizer only
+    """
+
+    # Library and first context, shared by all contexts of a process
+    lib = None
+    share_context = None
+
+    # Objects are shared with the first context, which is never destroyed
+    share_group = "osmesa"
+
+    def __init__(self):
+        if OSMesaContext.lib is None:
+            osmesa = _load_library("OSMesa", "libOSMesa.so")
+            osmesa.OSMesaCreateContextExt.restype = ctypes.c_void_p
+            osmesa.OSMesaCreateContextExt.argtypes = [
+                ctypes.c_uint,
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.c_void_p,
+            ]
+            osmesa.OSMesaMakeCurrent.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+                ctypes.c_uint,
+                ctypes.c_int,
+                ctypes.c_int,
+            ]
+            osmesa.OSMesaDestroyContext.argtypes = [ctypes.c_void_p]
+            OSMesaContext.lib = osmesa
+
+        # Share textures and display lists with the first context
+        self.context = OSMesaContext.lib.OSMesaCreateContextExt(
+            OSMESA_RGBA, 24, 0, 0, OSMesaContext.share_context
+        )
+        assert self.context, "failed to create OSMesa context"
+
+        if OSMesaContext.share_context is None:
+            OSMesaContext.share_context = self.context
+
+        # OSMesa needs a color buffer, all rendering goes to frame buffer objects
+        self.buffer = (ctypes.c_ubyte * 4)()
+
+        self.switch_to()
+
+    def switch_to(self):
+        ok = OSMesaContext.lib.OSMesaMakeCurrent(
+            self.context, self.buffer, GL_UNSIGNED_BYTE, 1, 1
+        )
+        assert ok, "failed to make OSMesa context current"
+        gl.gl_info.set_active_context()
+
+    def close(self):
+        # The first context is kept alive, others may share its objects
+        if self.context is None or self.context == OSMesaContext.share_context:
+            return
+
+        OSMesaContext.lib.OSMesaDestroyContext(self.context)
+        self.context = None
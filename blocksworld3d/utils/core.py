@@ -1,76 +1,33 @@
 import math
 from ctypes import POINTER
-from enum import IntEnum
-from typing import Optional, Tuple
+from typing import Optional, Sequence, Tuple
 
 import gymnasium as gym
 import numpy as np
 import pyglet
 from gymnasium import spaces
 from gymnasium.core import ObsType
-from pyglet.gl import (
-    GL_AMBIENT,
-    GL_AMBIENT_AND_DIFFUSE,
-    GL_ANY_SAMPLES_PASSED,
-    GL_COLOR_BUFFER_BIT,
-    GL_COLOR_MATERIAL,
-    GL_COMPILE,
-    GL_CULL_FACE,
-    GL_DEPTH_BUFFER_BIT,
-    GL_DEPTH_TEST,
-    GL_DIFFUSE,
-    GL_FRAMEBUFFER,
-    GL_FRONT_AND_BACK,
-    GL_LIGHT0,
-    GL_LIGHTING,
-    GL_MODELVIEW,
-    GL_POLYGON,
-    GL_POSITION,
-    GL_PROJECTION,
-    GL_QUADS,
-    GL_QUERY_RESULT,
-    GL_SMOOTH,
-    GL_TEXTURE_2D,
-    GLfloat,
-    GLubyte,
-    GLuint,
-    glBegin,
-    glBeginQuery,
-    glBindFramebuffer,
-    glCallList,
-    glClear,
-    glClearColor,
-    glClearDepth,
-    glColor3f,
-    glColorMaterial,
-    glDeleteLists,
-    glDeleteQueries,
-    glDisable,
-    glEnable,
-    glEnd,
-    glEndList,
-    glEndQuery,
-    glFlush,
-    glGenQueries,
-    glGetQueryObjectuiv,
-    glLightfv,
-    glLoadIdentity,
-    glLoadMatrixf,
-    glMatrixMode,
-    glNewList,
-    glNormal3f,
-    glOrtho,
-    glShadeModel,
-    glTexCoord2f,
-    gluLookAt,
-    gluPerspective,
-    glVertex3f,
-)
 
-from .entity import Agent, Entity
-from .math import Y_VEC, intersect_circle_segs
-from .opengl import FrameBuffer, Texture, drawBox
+from . import gl
+from .context import create_context, get_backend_name
+from .entity import Agent, Block
+from .math import Y_VEC, intersect_circle_segs, points_in_frustum, segments_hit_boxes
+from .opengl import (
+    LIT_FRAGMENT_SHADER,
+    LIT_VERTEX_SHADER,
+    RENDER_PROFILES,
+    FrameBuffer,
+    GLResources,
+    Preprocess,
+    RenderQueue,
+    ShaderProgram,
+    Texture,
+    drawBox,
+    set_texturing,
+)
 from .params import DEFAULT_PARAMS
+from .symbolic import Actions
+from .viewer import RemoteViewer
 
 # Default wall height for room
 DEFAULT_WALL_HEIGHT = 8
@@ -78,6 +35,22 @@ DEFAULT_WALL_HEIGHT = 8
 # Texture size/density in texels/meter
 TEX_DENSITY = 512
 
+# Observation channels, see MiniWorldEnv.render_obs
+OBS_CHANNELS = ["rgb", "depth", "instance", "row"]
+
+# Near and far planes of the agent camera
+CAM_Z_NEAR = 0.04
+CAM_Z_FAR = 100.0
+
+# Opacity of the blocks outside of the current row
+INACTIVE_ROW_OPACITY = 0.35
+
+# Modelview matrix of the top view, maps Y to +Z and Z to +Y
+TOP_VIEW_MATRIX = [1, 0, 0, 0, 0, 0, 1, 0, 0, -1, 0, 0, 0, 0, 0, 1]
+
+# Domain randomization parameters of the whole world
+WORLD_PARAMS = ["sky_color", "light_pos", "light_color", "light_ambient"]
+
 
 def gen_texcs_wall(tex, min_x, min_y, width, height):
     """
@@ -403,35 +376,35 @@ class Room:
         Render the static elements of the room
         """
 
-        glColor3f(1, 1, 1)
+        gl.glColor3f(1, 1, 1)
 
         # Draw the floor
         self.floor_tex.bind()
-        glBegin(GL_POLYGON)
-        glNormal3f(0, 1, 0)
+        gl.glBegin(gl.GL_POLYGON)
+        gl.glNormal3f(0, 1, 0)
         for i in range(self.floor_verts.shape[0]):
-            glTexCoord2f(*self.floor_texcs[i, :])
-            glVertex3f(*self.floor_verts[i, :])
-        glEnd()
+            gl.glTexCoord2f(*self.floor_texcs[i, :])
+            gl.glVertex3f(*self.floor_verts[i, :])
+        gl.glEnd()
 
         # Draw the ceiling
         if not self.no_ceiling:
             self.ceil_tex.bind()
-            glBegin(GL_POLYGON)
-            glNormal3f(0, -1, 0)
+            gl.glBegin(gl.GL_POLYGON)
+            gl.glNormal3f(0, -1, 0)
             for i in range(self.ceil_verts.shape[0]):
-                glTexCoord2f(*self.ceil_texcs[i, :])
-                glVertex3f(*self.ceil_verts[i, :])
-            glEnd()
+                gl.glTexCoord2f(*self.ceil_texcs[i, :])
+                gl.glVertex3f(*self.ceil_verts[i, :])
+            gl.glEnd()
 
         # Draw the walls
         self.wall_tex.bind()
-        glBegin(GL_QUADS)
+        gl.glBegin(gl.GL_QUADS)
         for i in range(self.wall_verts.shape[0]):
-            glNormal3f(*self.wall_norms[i, :])
-            glTexCoord2f(*self.wall_texcs[i, :])
-            glVertex3f(*self.wall_verts[i, :])
-        glEnd()
+            gl.glNormal3f(*self.wall_norms[i, :])
+            gl.glTexCoord2f(*self.wall_texcs[i, :])
+            gl.glVertex3f(*self.wall_verts[i, :])
+        gl.glEnd()
 
 
 class MiniWorldEnv(gym.Env):
@@ -441,27 +414,14 @@ class MiniWorldEnv(gym.Env):
     """
 
     metadata = {
-        "render.modes": ["human", "rgb_array"],
+        "render.modes": ["human", "rgb_array", "remote"],
         "video.frames_per_second": 30,
-        "render_modes": ["human", "rgb_array"],
+        "render_modes": ["human", "rgb_array", "remote"],
         "render_fps": 30,
     }
 
     # Enumeration of possible actions
-    class Actions(IntEnum):
-        # Turn left or right by a small amount
-        move_left = 0
-        move_right = 1
-
-        # Pick up or drop an object being carried
-        pickup = 2
-        drop = 3
-
-        # Toggle row
-        toggle_row = 4
-
-        # Done completing task
-        done = 5
+    Actions = Actions
 
     def __init__(
         self,
@@ -474,6 +434,13 @@ class MiniWorldEnv(gym.Env):
         domain_rand: bool = False,
         render_mode: Optional[str] = None,
         view: str = "agent",
+        gl_backend: Optional[str] = None,
+        obs_channels: Sequence[str] = ("rgb",),
+        viewer_address: Optional[Tuple[str, int]] = None,
+        render_quality: str = "high",
+        render_pipeline: str = "fixed",
+        obs_preprocess: Optional[dict] = None,
+        frame_skip: int = 1,
     ):
         # Action enumeration for this environment
         self.actions = MiniWorldEnv.Actions
@@ -481,16 +448,55 @@ class MiniWorldEnv(gym.Env):
         # Actions are discrete integer values
         self.action_space = spaces.Discrete(len(self.actions))
 
-        # Observations are RGB images with pixels in [0, 255]
-        self.observation_space = spaces.Box(
-            low=0, high=255, shape=(obs_height, obs_width, 3), dtype=np.uint8
-        )
+        # Observations are RGB images with pixels in [0, 255], or a dict
+        # when more channels are requested, all rendered in the same pass
+        assert len(obs_channels) > 0
+        assert all(c in OBS_CHANNELS for c in obs_channels), obs_channels
+        self.obs_channels = tuple(obs_channels)
+
+        # Greyscale, downsampling and float conversion of the rgb channel,
+        # applied on the GPU, see Preprocess in utils.opengl
+        self.obs_preprocess = Preprocess(**(obs_preprocess or {}))
+        grey, factor, half_float = self.obs_preprocess
+
+        channel_spaces = {
+            "rgb": spaces.Box(
+                low=0,
+                high=1 if half_float else 255,
+                shape=(obs_height // factor, obs_width // factor, 1 if grey else 3),
+                dtype=np.float16 if half_float else np.uint8,
+            ),
+            # Distance along the camera axis, in meters
+            "depth": spaces.Box(
+                low=0, high=CAM_Z_FAR, shape=(obs_height, obs_width, 1), dtype=np.float32
+            ),
+            # Id of the block at each pixel, -1 for the background
+            "instance": spaces.Box(
+                low=-1, high=254, shape=(obs_height, obs_width), dtype=np.int16
+            ),
+            # Row of the block at each pixel, -1 for the background
+            # and the carried block
+            "row": spaces.Box(
+                low=-1, high=254, shape=(obs_height, obs_width), dtype=np.int16
+            ),
+        }
+        if self.obs_channels == ("rgb",):
+            self.observation_space = channel_spaces["rgb"]
+        else:
+            self.observation_space = spaces.Dict(
+                {c: channel_spaces[c] for c in self.obs_channels}
+            )
 
         self.reward_range = (-math.inf, math.inf)
 
         # Maximum number of steps per episode
         self.max_episode_steps = max_episode_steps
 
+        # Number of times each action is repeated, only the last frame is
+        # rendered. Episode lengths count the repeated steps.
+        assert frame_skip >= 1, frame_skip
+        self.frame_skip = frame_skip
+
         # Simulation parameters, used for domain randomization
         self.params = params
 
@@ -500,18 +506,52 @@ class MiniWorldEnv(gym.Env):
         # Window for displaying the environment to humans
         self.window = None
 
+        # Viewer process used by the remote render mode, see utils.viewer
+        # Spawned locally, or connected to viewer_address when set
+        self.viewer = None
+        self.viewer_address = viewer_address
+
         # Invisible window to render into (shadow OpenGL context)
-        self.shadow_window = pyglet.window.Window(width=1, height=1, visible=False)
+        # Created along with the frame buffers on the first render
+        self.shadow_window = None
 
-        # Enable depth testing and backface culling
-        glEnable(GL_DEPTH_TEST)
-        glEnable(GL_CULL_FACE)
+        # OpenGL context backend, see utils.context
+        self.gl_backend = get_backend_name(gl_backend)
+
+        # Sample counts and formats of the frame buffers, see utils.opengl
+        assert render_quality in RENDER_PROFILES, render_quality
+        self.render_quality = render_quality
+        self.render_profile = RENDER_PROFILES[render_quality]
+
+        # Fixed-function lighting, or the shader program of utils.opengl
+        assert render_pipeline in ["fixed", "shader"], render_pipeline
+        self.render_pipeline = render_pipeline
+        self.program = None
 
         # Frame buffer used to render observations
-        self.obs_fb = FrameBuffer(obs_width, obs_height, 8)
+        self.obs_fb = None
 
         # Frame buffer used for human visualization
-        self.vis_fb = FrameBuffer(window_width, window_height, 16)
+        self.vis_fb = None
+
+        # Occlusion query ids, and the entities of the pending queries
+        self.query_ids = []
+        self.query_ents = []
+
+        # OpenGL objects created for this environment, freed by close()
+        self.gl_resources = GLResources()
+
+        # Display list holding the static parts of the environment
+        self.static_list = None
+
+        # Draw calls of the blocks, sorted by render state, see render_stats
+        self.render_queue = RenderQueue()
+
+        # Frame buffer sizes
+        self.obs_width = obs_width
+        self.obs_height = obs_height
+        self.window_width = window_width
+        self.window_height = window_height
 
         # Set rendering mode
         self.render_mode = render_mode
@@ -524,18 +564,14 @@ class MiniWorldEnv(gym.Env):
         self.obs_disp_width = 256
         self.obs_disp_height = obs_height * (self.obs_disp_width / obs_width)
 
-        # For displaying text
-        self.text_label = pyglet.text.Label(
-            font_name="Arial",
-            font_size=14,
-            multiline=True,
-            width=400,
-            x=window_width + 5,
-            y=window_height - (self.obs_disp_height + 19),
-        )
+        # For displaying text, created with the human window
+        self.text_label = None
 
-        # Initialize the state
-        self.reset(options={'problem_instance': 'gap'})
+        # Last observation rendered into the observation frame buffer
+        self.last_obs = None
+
+        # Initialize the state, the first observation is rendered lazily
+        self._reset_world(options={'problem_instance': 'gap'})
 
     def reset(
         self, *, seed: Optional[int] = None, options: Optional[dict] = None
@@ -544,6 +580,20 @@ class MiniWorldEnv(gym.Env):
         Reset the simulation at the start of a new episode
         This also randomizes many environment parameters (domain randomization)
         """
+
+        self._reset_world(seed=seed, options=options)
+
+        # Generate the first camera image
+        obs = self.render_obs()
+
+        # Return first observation
+        return obs, self._get_info()
+
+    def _reset_world(self, seed=None, options=None):
+        """
+        Generate a new episode without rendering anything
+        """
+
         super().reset(seed=seed)
 
         # Step count since episode start
@@ -572,13 +622,22 @@ class MiniWorldEnv(gym.Env):
         # Check if domain randomization is enabled or not
         rand = self.np_random if self.domain_rand else None
 
-        # Randomize elements of the world (domain randomization)
-        self.params.sample_many(rand, self, ["sky_color", "light_pos", "light_color", "light_ambient"])
-
+        # Randomize elements of the world (domain randomization),
+        # unless the values were sampled ahead of time for a batch of envs
+        world_params = options.get('domain_params')
+        if world_params is None:
+            self.params.sample_many(rand, self, WORLD_PARAMS)
+        else:
+            for name in WORLD_PARAMS:
+                setattr(self, name, np.array(world_params[name]))
 
-        # Randomize parameters of the entities
+        # Randomize parameters of the entities, all blocks at once
+        Block.randomize_many(
+            [ent for ent in self.entities if isinstance(ent, Block)], self.params, rand
+        )
         for ent in self.entities:
-            ent.randomize(self.params, rand)
+            if not isinstance(ent, Block):
+                ent.randomize(self.params, rand)
 
         # Compute the min and max x, z extents of the whole floorplan
         self.min_x = min(r.min_x for r in self.rooms)
@@ -590,14 +649,65 @@ class MiniWorldEnv(gym.Env):
         if len(self.wall_segs) == 0:
             self._gen_static_data()
 
-        # Pre-compile static parts of the environment into a display list
-        self._render_static()
+        # Static parts of the environment are compiled on the next render
+        self.static_dirty = True
 
-        # Generate the first camera image
-        obs = self.render_obs()
+        # Top view projections and backgrounds, see render_top_view
+        self.top_views = {}
 
-        # Return first observation
-        return obs, {}
+    def _init_context(self):
+        """
+        Create the OpenGL context and the observation frame buffer.
+        Deferred until the first render, so that constructing an
+        environment does not need OpenGL at all.
+        """
+
+        if self.shadow_window is not None:
+            return
+
+        # Invisible window to render into (shadow OpenGL context)
+        self.shadow_window = create_context(self.gl_backend)
+        Texture.share_group = self.shadow_window.share_group
+
+        # Enable depth testing and backface culling
+        gl.glEnable(gl.GL_DEPTH_TEST)
+        gl.glEnable(gl.GL_CULL_FACE)
+
+        # Upload the packaged textures into the new context
+        Texture.preload()
+
+        self.static_list = self.gl_resources.gen("lists")[0]
+
+        if self.render_pipeline == "shader":
+            self.program = ShaderProgram(
+                LIT_VERTEX_SHADER, LIT_FRAGMENT_SHADER, self.gl_resources
+            )
+            self.program.use()
+        ShaderProgram.current = self.program
+
+        # Frame buffer used to render observations
+        # Block labels are written to a stencil buffer packed with the depth
+        stencil = "instance" in self.obs_channels or "row" in self.obs_channels
+        self.obs_fb = FrameBuffer(
+            self.obs_width,
+            self.obs_height,
+            self.render_profile.obs_samples,
+            stencil=stencil,
+            color_format=self.render_profile.color_format,
+            resolve_depth="depth" in self.obs_channels,
+            resources=self.gl_resources,
+            preprocess=self.obs_preprocess,
+        )
+
+    def _make_current(self):
+        """
+        Make the OpenGL context of the environment current
+        This is necessary on Linux Nvidia drivers
+        """
+
+        self.shadow_window.switch_to()
+        ShaderProgram.current = self.program
+        Texture.share_group = self.shadow_window.share_group
 
     def _get_carry_pos(self, agent_pos, ent):
         """
@@ -613,25 +723,25 @@ class MiniWorldEnv(gym.Env):
 
         return pos
     
-    def _get_blocks_in_row(self):
-        """"Return list of blocks in current row"""
-        blocks_in_row = [block for block in self.blocks if block.pos[0] % 2 == self.cur_row]
-        return blocks_in_row
-    
     def move_agent(self, lateral_dir):
         """
         Move the agent laterally
         """
         
-        movement = (0, 0, lateral_dir)
-        next_pos = tuple(a + b for a, b in zip(self.agent.pos, movement))
-        
-        if next_pos[2] != 1 and next_pos[2] != 7:
-            if self.prev_move == lateral_dir or self.agent.pos[2] == 2 or self.agent.pos[2] == 6:
-                self.agent.pos = next_pos
-                self.prev_move = lateral_dir
-        else:
-            return False      
+        num_cols = self.grid.num_cols
+        col = self.grid.col_at(self.agent.pos)
+        next_col = col + lateral_dir
+
+        if not 0 <= next_col < num_cols:
+            return False
+
+        x, y, _ = self.agent.pos
+        next_pos = (x, y, self.spots[0, next_col, 2])
+
+        # Leaving the interior columns requires two presses in the same direction
+        if self.prev_move == lateral_dir or col == 0 or col == num_cols - 1:
+            self.agent.pos = next_pos
+            self.prev_move = lateral_dir
 
         carrying = self.agent.carrying
         if carrying:
@@ -649,6 +759,34 @@ class MiniWorldEnv(gym.Env):
         Perform one action and update the simulation
         """
 
+        reward, termination, truncation = self._step_repeat(action)
+
+        # Generate the current camera image
+        obs = self.render_obs()
+
+        return obs, reward, termination, truncation, self._get_info()
+
+    def _step_repeat(self, action):
+        """
+        Apply an action frame_skip times, or until the episode ends,
+        and return the summed reward and the last flags
+        """
+
+        total_reward = 0
+        for _ in range(self.frame_skip):
+            self._step_world(action)
+            reward, termination, truncation = self._step_reward()
+            total_reward += reward
+            if termination or truncation:
+                break
+
+        return total_reward, termination, truncation
+
+    def _step_world(self, action):
+        """
+        Apply an action to the world without rendering anything
+        """
+
         self.step_count += 1
 
         if action == self.actions.move_left:
@@ -658,64 +796,31 @@ class MiniWorldEnv(gym.Env):
             self.move_agent(1)
 
         elif action == self.actions.pickup:
-            test_pos = self.agent.pos
-            dir_vec = self.agent.dir_vec
-            current_row_blocks = self._get_blocks_in_row()
-            current_stack_blocks = self._get_blocks_in_stack(test_pos, dir_vec, current_row_blocks)
-            
-            # Iterate through the sorted list of usable blocks and pick up the first suitable one
-            for closest_block in current_stack_blocks:
-                if not self.agent.carrying:
-                    if isinstance(closest_block, Entity) and closest_block.is_beneath is None:
-                        self.agent.carrying = closest_block
-                        loc = int(closest_block.pos[2] - 2)
-                        self.update_representation(loc, action.name)
-                        if closest_block.is_above:
-                            bottom_block = closest_block.is_above
-                            bottom_block.is_beneath = None
-                            closest_block.is_above = None
-                else:
-                    break
+            if not self.agent.carrying:
+                # Pick up the block at the top of the stack the agent faces
+                loc = self.grid.col_at(self.agent.pos)
+                block_id = self.grid.top(self.cur_row, loc)
+
+                if block_id is not None:
+                    self.agent.carrying = self.blocks[block_id]
+                    self.update_representation(loc, self.actions(action).name)
 
         elif action == self.actions.drop:
             if self.agent.carrying:
-                current_block = self.agent.carrying
-
-                # Find the sorted list of usable blocks
-                test_pos = self.agent.pos
-                dir_vec = self.agent.dir_vec
-                current_row_blocks = self._get_blocks_in_row()
-                current_stack_blocks = self._get_blocks_in_stack(test_pos, dir_vec, current_row_blocks)
-                
-                # Limit to 5 blocks per stack
-                if len(current_stack_blocks) < 5:
-                    # Iterate through the sorted blocks to find the first suitable target block
-                    for target_block in current_stack_blocks:
-                        if current_block != target_block and target_block.is_beneath is None:
-                            new_pos = np.array(target_block.pos, dtype=np.float32)
-                            new_pos[1] = target_block.pos[1] + target_block.height
-                            new_dir = target_block.dir
-                            target_block.is_beneath = current_block
-                            current_block.is_above = target_block
-                            loc = int(target_block.pos[2] - 2)
-                            break
-                    else:
-                        # If no suitable target block found, place the carried blocks at a default position
-                        closest_spot = min(self.spots[self.cur_row], key=lambda spot: np.linalg.norm(np.cross(dir_vec, spot - test_pos)))
-                        new_pos = closest_spot
-                        loc = int(closest_spot[2] - 2)
-                        new_dir = 0
-                    
-                    # Update the position and direction of the carried blocks and release it
-                    self.agent.carrying.pos = new_pos
-                    self.agent.carrying.dir = new_dir
-                    self.agent.carrying = None
-                    
+                # Drop the carried block on the stack the agent faces
+                loc = self.grid.col_at(self.agent.pos)
+
+                # Limit the height of the stacks
+                if self.grid.heights[self.cur_row, loc] < self.grid.max_height:
                     # Update the interal representation of the blocks
-                    self.update_representation(loc, action.name)
-                
+                    self.update_representation(loc, self.actions(action).name)
+
+                    # Release the carried block
+                    self.agent.carrying.dir = 0
+                    self.agent.carrying = None
+
         elif action == self.actions.toggle_row:
-            self.cur_row = not self.cur_row
+            self.cur_row = (self.cur_row + 1) % self.grid.num_rows
 
         # If we are carrying an object, update its position as we move
         if self.agent.carrying:
@@ -723,21 +828,23 @@ class MiniWorldEnv(gym.Env):
             self.agent.carrying.pos = ent_pos
             self.agent.carrying.dir = self.agent.dir
 
-        # Generate the current camera image
-        obs = self.render_obs()
+    def _step_reward(self):
+        """
+        Reward, termination and truncation flags of the last step
+        """
 
         # If the maximum time step count is reached
         if self.step_count >= self.max_episode_steps:
-            termination = False
-            truncation = True
-            reward = 0
-            return obs, reward, termination, truncation, {}
+            return 0, False, True
 
-        reward = 0
-        termination = False
-        truncation = False
+        return 0, False, False
 
-        return obs, reward, termination, truncation, {}
+    def _get_info(self):
+        """
+        Auxiliary information returned by reset and step
+        """
+
+        return {}
 
     def add_rect_room(self, min_x, max_x, min_z, max_z, **kwargs):
         """
@@ -976,46 +1083,6 @@ class MiniWorldEnv(gym.Env):
 
         return None
     
-    def intersect_ray_block(self, ray_origin, ray_dir, blocks):
-        size = 2 * blocks.radius
-
-        bounds_min = np.array([blocks.pos[0], 0, blocks.pos[2]]) - np.array([size / 2, 0, size / 2])
-        bounds_max = np.array([blocks.pos[0], 0, blocks.pos[2]]) + np.array([size / 2, 0, size / 2])
-
-        tmin = -np.inf
-        tmax = np.inf
-
-        # Check intersections only for x and z coordinates (i=0 and i=2)
-        for i in [0, 2]:
-            if ray_dir[i] != 0:
-                t1 = (bounds_min[i] - ray_origin[i]) / ray_dir[i]
-                t2 = (bounds_max[i] - ray_origin[i]) / ray_dir[i]
-                ti_min = min(t1, t2)
-                ti_max = max(t1, t2)
-                tmin = max(tmin, ti_min)
-                tmax = min(tmax, ti_max)
-            elif i == 2 and (bounds_min[i] <= ray_origin[i] <= bounds_max[i]):
-                continue
-            else:
-                return None
-
-        if tmin > tmax or tmax < 0:
-            return None
-
-        return tmin
-    
-    # Gets the closest blocks in the linesight
-    def _get_blocks_in_stack(self, ray_origin, ray_dir, current_row_blocks):
-        current_stack_blocks = []
-
-        for blocks in current_row_blocks:
-            t = self.intersect_ray_block(ray_origin, ray_dir, blocks)
-            if t is not None:
-                current_stack_blocks.append((t, blocks))
-
-        current_stack_blocks.sort(key=lambda x: x[0])
-        return [blocks for _, blocks in current_stack_blocks]
-
     def _load_tex(self, tex_name):
         """
         Load a texture, with or without domain randomization
@@ -1058,25 +1125,63 @@ class MiniWorldEnv(gym.Env):
 
         return 1.0 - 0.2 * (self.step_count / self.max_episode_steps)
 
+    @property
+    def render_stats(self):
+        """
+        Draw calls and render state changes of the blocks in the last
+        rendered frame, for profiling
+        """
+
+        return dict(self.render_queue.stats)
+
     def _render_static(self):
         """
         Render the static elements of the scene into a display list.
-        Called once at the beginning of each episode.
+        Called once at the beginning of each episode. Lighting is set
+        before calling the list, so the list does not depend on it.
+        """
+
+        # Compiling replaces the previous contents of the list
+        gl.glNewList(self.static_list, gl.GL_COMPILE)
+
+        # Render the rooms
+        set_texturing(True)
+        for room in self.rooms:
+            room._render()
+
+        # Render the static entities
+        for ent in self.entities:
+            if ent.is_static:
+                ent.render()
+
+        gl.glEndList()
+
+    def _setup_lighting(self):
         """
+        Set the light parameters, relative to the current modelview matrix
+        """
+
+        light_pos = (gl.GLfloat * 4)(*self.light_pos + [1])
 
-        # TODO: manage this automatically
-        # glIsList
-        glDeleteLists(1, 1)
-        glNewList(1, GL_COMPILE)
+        if self.program is not None:
+            # The light position uniform is in eye space
+            modelview = (gl.GLfloat * 16)()
+            gl.glGetFloatv(gl.GL_MODELVIEW_MATRIX, modelview)
+            eye_light_pos = np.array(light_pos) @ np.array(modelview).reshape(4, 4)
+
+            self.program.set_uniform("light_pos", *map(float, eye_light_pos))
+            self.program.set_uniform("light_color", *map(float, self.light_color[:3]))
+            self.program.set_uniform("light_ambient", *map(float, self.light_ambient[:3]))
+            return
 
         # Light position
-        glLightfv(GL_LIGHT0, GL_POSITION, (GLfloat * 4)(*self.light_pos + [1]))
+        gl.glLightfv(gl.GL_LIGHT0, gl.GL_POSITION, light_pos)
 
         # Background/minimum light level
-        glLightfv(GL_LIGHT0, GL_AMBIENT, (GLfloat * 4)(*self.light_ambient))
+        gl.glLightfv(gl.GL_LIGHT0, gl.GL_AMBIENT, (gl.GLfloat * 4)(*self.light_ambient))
 
         # Diffuse light color
-        glLightfv(GL_LIGHT0, GL_DIFFUSE, (GLfloat * 4)(*self.light_color))
+        gl.glLightfv(gl.GL_LIGHT0, gl.GL_DIFFUSE, (gl.GLfloat * 4)(*self.light_color))
 
         # glLightf(GL_LIGHT0, GL_SPOT_CUTOFF, 180)
         # glLightf(GL_LIGHT0, GL_SPOT_EXPONENT, 0)
@@ -1084,71 +1189,126 @@ class MiniWorldEnv(gym.Env):
         # glLightf(GL_LIGHT0, GL_LINEAR_ATTENUATION, 0)
         # glLightf(GL_LIGHT0, GL_QUADRATIC_ATTENUATION, 0)
 
-        glEnable(GL_LIGHTING)
-        glEnable(GL_LIGHT0)
+        gl.glEnable(gl.GL_LIGHTING)
+        gl.glEnable(gl.GL_LIGHT0)
 
-        glShadeModel(GL_SMOOTH)
-        glEnable(GL_COLOR_MATERIAL)
-        glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
+        gl.glShadeModel(gl.GL_SMOOTH)
+        gl.glEnable(gl.GL_COLOR_MATERIAL)
+        gl.glColorMaterial(gl.GL_FRONT_AND_BACK, gl.GL_AMBIENT_AND_DIFFUSE)
 
-        # Render the rooms
-        glEnable(GL_TEXTURE_2D)
-        for room in self.rooms:
-            room._render()
+    def _render_world(self, frame_buffer, render_agent, raw=False):
+        """
+        Render the world from a given camera position into a frame buffer,
+        and produce a numpy image array as output, preprocessed unless raw
+        is set.
+        """
 
-        # Render the static entities
-        for ent in self.entities:
-            if ent.is_static:
-                ent.render()
+        # Pre-compile static parts of the environment into a display list
+        if self.static_dirty:
+            self._render_static()
+            self.static_dirty = False
+
+        self._render_dynamic(frame_buffer, render_agent, draw_static=True)
+
+        # Resolve the rendered image into a numpy array
+        img = frame_buffer.resolve(raw=raw)
 
-        glEndList()
+        return img
 
-    def _render_world(self, frame_buffer, render_agent):
+    def _render_dynamic(self, frame_buffer, render_agent, draw_static=False):
         """
-        Render the world from a given camera position into a frame buffer,
-        and produce a numpy image array as output.
+        Render the blocks and the agent, after the compiled static
+        parts of the world when draw_static is set
         """
 
+        # Label each pixel with the id of the block drawn last, plus one
+        if frame_buffer.stencil:
+            assert self.grid.num_blocks < 255, "too many blocks to label"
+            gl.glEnable(gl.GL_STENCIL_TEST)
+            gl.glStencilOp(gl.GL_KEEP, gl.GL_KEEP, gl.GL_REPLACE)
+            gl.glStencilFunc(gl.GL_ALWAYS, 0, 0xFF)
+
         # Call the display list for the static parts of the environment
-        glCallList(1)
+        if draw_static:
+            self._setup_lighting()
+            gl.glCallList(self.static_list)
         
-        camera_pos = self.agent.cam_pos
-        sorted_entities = sorted(self.entities, key=lambda ent: -np.linalg.norm(ent.pos - camera_pos))
+        # Blocks of the current row, and the carried block, are opaque
+        depths = np.linalg.norm(self.grid.positions - self.agent.cam_pos, axis=1)
+        opaque = self.grid.cells[:, 0] == self.cur_row
+        if self.agent.carrying is not None:
+            opaque[self.agent.carrying.id] = True
+
+        for block, depth, is_opaque in zip(self.blocks, depths, opaque):
+            self.render_queue.add(
+                block.draw,
+                depth,
+                opacity=1 if is_opaque else INACTIVE_ROW_OPACITY,
+                label=block.id + 1 if frame_buffer.stencil else None,
+            )
+        self.render_queue.flush()
 
-        # Render the non-static entities
-        for ent in sorted_entities:
-            if not ent.is_static and ent is not self.agent:
-                opacity = 1 if ent.pos[0] % 2 == self.cur_row or self.agent.carrying == ent else 0.35
-                ent.render(opacity)
-                # ent.draw_bound()
+        # Render the other non-static entities
+        for ent in self.entities:
+            if not ent.is_static and ent is not self.agent and not isinstance(ent, Block):
+                ent.render()
+
+        if frame_buffer.stencil:
+            gl.glDisable(gl.GL_STENCIL_TEST)
 
         if render_agent:
             self.agent.render()
 
-        # Resolve the rendered image into a numpy array
-        img = frame_buffer.resolve()
-
-        return img
-
-    def render_top_view(self, frame_buffer=None, render_agent=True, return_scale=False):
+    def render_top_view(
+        self, frame_buffer=None, render_agent=True, return_scale=False, cached=False
+    ):
         """
-        Render a top view of the whole map (from above)
+        Render a top view of the whole map (from above), as an RGB image
+        that is never preprocessed, see obs_preprocess
+        With cached, the static parts of the world are rendered once per
+        episode into a background image, and only the blocks and the agent
+        are rendered on later calls, then composited over the background.
         """
 
+        # Create the OpenGL context on first use
+        self._init_context()
+
         if frame_buffer is None:
             frame_buffer = self.obs_fb
 
         # Switch to the default OpenGL context
-        # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self._make_current()
 
-        # Bind the frame buffer before rendering into it
-        frame_buffer.bind()
+        view = self._get_top_view(frame_buffer)
 
-        # Clear the color and depth buffers
-        glClearColor(*self.sky_color, 1.0)
-        glClearDepth(1.0)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        if cached:
+            img = self._render_top_view_cached(frame_buffer, view, render_agent)
+        else:
+            # Bind the frame buffer before rendering into it
+            frame_buffer.bind()
+
+            # Clear the color and depth buffers
+            gl.glClearColor(*self.sky_color, 1.0)
+            gl.glClearDepth(1.0)
+            gl.glClearStencil(0)
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT | gl.GL_STENCIL_BUFFER_BIT)
+
+            self._load_top_view_matrices(view)
+            img = self._render_world(frame_buffer, render_agent=render_agent, raw=True)
+
+        if return_scale:
+            return img, view["scale"]
+        return img
+
+    def _get_top_view(self, frame_buffer):
+        """
+        Projection of the top view for a frame buffer size,
+        computed once per episode
+        """
+
+        key = (frame_buffer.width, frame_buffer.height)
+        if key in self.top_views:
+            return self.top_views[key]
 
         # Scene extents to render
         min_x = self.min_x - 1
@@ -1175,84 +1335,125 @@ class MiniWorldEnv(gym.Env):
             min_x -= w_diff / 2
             max_x += w_diff / 2
 
-        # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        glOrtho(min_x, max_x, -max_z, -min_z, -100, 100.0)
+        x_scale = frame_buffer.width / (max_x - min_x)
+        z_scale = frame_buffer.height / (max_z - min_z)
 
-        # Setup the camera
-        # Y maps to +Z, Z maps to +Y
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        m = [
-            1,
-            0,
-            0,
-            0,
-            0,
-            0,
-            1,
-            0,
-            0,
-            -1,
-            0,
-            0,
-            0,
-            0,
-            0,
-            1,
-        ]
-        glLoadMatrixf((GLfloat * len(m))(*m))
-
-        if return_scale:
-            x_scale = frame_buffer.width / (max_x - min_x)
-            z_scale = frame_buffer.height / (max_z - min_z)
-
-            scale = {
+        view = {
+            "ortho": (min_x, max_x, -max_z, -min_z, -100, 100.0),
+            "scale": {
                 "x_scale": x_scale,
                 "z_scale": z_scale,
                 "x_offset": int(0 - min_x * x_scale),
                 "z_offset": int(0 - min_z * z_scale),
-            }
+            },
+            # Static background image, rendered on first use
+            "background": None,
+        }
+        self.top_views[key] = view
 
-            return self._render_world(frame_buffer, render_agent=render_agent), scale
-        else:
-            return self._render_world(frame_buffer, render_agent=render_agent)
+        return view
+
+    def _load_top_view_matrices(self, view):
+        # Set the projection matrix
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.glOrtho(*view["ortho"])
+
+        # Setup the camera
+        # Y maps to +Z, Z maps to +Y
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+        gl.glLoadMatrixf((gl.GLfloat * len(TOP_VIEW_MATRIX))(*TOP_VIEW_MATRIX))
+
+    def _render_top_view_cached(self, frame_buffer, view, render_agent):
+        """
+        Render the top view over a cached image of the static world
+        """
+
+        frame_buffer.bind()
+        self._load_top_view_matrices(view)
+
+        if view["background"] is None:
+            if self.static_dirty:
+                self._render_static()
+                self.static_dirty = False
+
+            gl.glClearColor(*self.sky_color, 1.0)
+            gl.glClearDepth(1.0)
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            self._setup_lighting()
+            gl.glCallList(self.static_list)
+            view["background"] = frame_buffer.resolve(raw=True).astype(np.uint16)
+            frame_buffer.bind()
+
+        # Render the dynamic layer over a transparent background
+        gl.glClearColor(0, 0, 0, 0)
+        gl.glClearDepth(1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+        self._setup_lighting()
+        self._render_dynamic(frame_buffer, render_agent)
+        layer = frame_buffer.resolve(alpha=True)
+
+        # The layer colors are premultiplied by their coverage
+        transparency = 255 - layer[:, :, 3:].astype(np.uint16)
+        img = layer[:, :, :3] + (transparency * view["background"] + 127) // 255
+
+        return np.minimum(img, 255).astype(np.uint8)
 
     def render_obs(self, frame_buffer=None):
         """
         Render an observation from the point of view of the agent
         """
 
+        # Create the OpenGL context on first use
+        self._init_context()
+
         if frame_buffer is None:
             frame_buffer = self.obs_fb
 
         # Switch to the default OpenGL context
-        # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self._make_current()
 
         # Bind the frame buffer before rendering into it
         frame_buffer.bind()
 
         # Clear the color and depth buffers
-        glClearColor(*self.sky_color, 1.0)
-        glClearDepth(1.0)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        gl.glClearColor(*self.sky_color, 1.0)
+        gl.glClearDepth(1.0)
+        gl.glClearStencil(0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT | gl.GL_STENCIL_BUFFER_BIT)
+
+        self._load_agent_camera(frame_buffer)
+
+        img = self._render_world(frame_buffer, render_agent=False)
+
+        if self.obs_channels != ("rgb",):
+            img = self._get_obs_channels(frame_buffer, img)
+
+        if frame_buffer is self.obs_fb:
+            self.last_obs = img
+
+        return img
+
+    def _load_agent_camera(self, frame_buffer):
+        """
+        Load the projection and view matrices of the agent camera
+        """
 
         # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        gluPerspective(
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.gluPerspective(
             self.agent.cam_fov_y,
             frame_buffer.width / float(frame_buffer.height),
-            0.04,
-            100.0,
+            CAM_Z_NEAR,
+            CAM_Z_FAR,
         )
 
         # Setup the camera
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        gluLookAt(
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+        gl.gluLookAt(
             # Eye position
             *self.agent.cam_pos,
             # Target
@@ -1262,25 +1463,135 @@ class MiniWorldEnv(gym.Env):
             1.0,
             0.0,
         )
-        
 
-        return self._render_world(frame_buffer, render_agent=False)
+    def _get_obs_channels(self, frame_buffer, img):
+        """
+        Read the requested channels from a frame buffer after rendering
+        """
+
+        obs = {}
+
+        if "rgb" in self.obs_channels:
+            obs["rgb"] = img
+
+        if "depth" in self.obs_channels:
+            depth = frame_buffer.get_depth_map(CAM_Z_NEAR, CAM_Z_FAR)
+            obs["depth"] = depth.astype(np.float32)
+
+        if frame_buffer.stencil:
+            instance = frame_buffer.get_stencil_map().astype(np.int16) - 1
 
-    def get_visible_ents(self):
+            if "instance" in self.obs_channels:
+                obs["instance"] = instance
+
+            if "row" in self.obs_channels:
+                # Look up the row of each block, with -1 for the background
+                rows = np.append(self.grid.cells[:, 0], -1).astype(np.int16)
+                obs["row"] = rows[instance]
+
+        return obs
+
+    def get_visible_blocks(self):
         """
-        Get a list of visible entities.
-        Uses OpenGL occlusion queries to approximate visibility.
+        Compute which blocks are visible to the agent, without rendering.
+        A block is visible when a point of a 3x3 grid on one of its faces
+        (its corners, edge midpoints and center) is inside the camera
+        frustum, and the line of sight to it does not cross an opaque block
+        (a block of the current row, or the carried one), so that blocks
+        clipped by the frustum or partly hidden still count.
+        Blocks of the other rows are drawn translucent and do not hide
+        what is behind them.
+        :return: bool array indexed by block id
+        """
+
+        grid = self.grid
+        num_blocks = grid.num_blocks
+        if num_blocks == 0:
+            return np.zeros(0, dtype=bool)
+
+        half = np.array(self.blocks[0].size) / 2
+        centers = grid.positions + (0, half[1], 0)
+
+        # Grid points of each face, moved slightly inside so they do not
+        # touch neighbors
+        grid_pts = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1]), axis=-1).reshape(-1, 2)
+        offsets = []
+        for axis in range(3):
+            others = [a for a in range(3) if a != axis]
+            for sign in (-1, 1):
+                face = np.zeros((len(grid_pts), 3))
+                face[:, axis] = sign
+                face[:, others] = grid_pts
+                offsets.append(face)
+        offsets = np.concatenate(offsets) * half * 0.98
+        points = (centers[:, np.newaxis] + offsets).reshape(-1, 3)
+        owners = np.repeat(np.arange(num_blocks), len(offsets))
+
+        cam_pos = self.agent.cam_pos
+        visible = points_in_frustum(
+            points,
+            cam_pos,
+            self.agent.cam_dir,
+            self.agent.cam_fov_y,
+            self.obs_width / self.obs_height,
+            CAM_Z_NEAR,
+            CAM_Z_FAR,
+        )
+
+        opaque = grid.cells[:, 0] == self.cur_row
+        if self.agent.carrying is not None:
+            opaque[self.agent.carrying.id] = True
+        occluders = np.flatnonzero(opaque)
+
+        hits = segments_hit_boxes(
+            cam_pos,
+            points,
+            centers[occluders] - half,
+            centers[occluders] + half,
+        )
+        # A block does not hide its own faces
+        hits &= owners[:, np.newaxis] != occluders
+
+        visible &= ~hits.any(axis=1)
+
+        return visible.reshape(num_blocks, -1).any(axis=1)
+
+    def get_visible_ents(self, method="gl"):
+        """
+        Get a set of visible entities.
+        The gl method uses OpenGL occlusion queries to approximate visibility.
+        The analytic method only considers blocks and samples points of their
+        faces, see get_visible_blocks. It does not render, but can miss
+        blocks of which only a sliver is visible.
         :return: set of objects visible to the agent
         """
 
-        # Allocate the occlusion query ids
-        num_ents = len(self.entities)
-        query_ids = (GLuint * num_ents)()
-        glGenQueries(num_ents, query_ids)
+        if method == "analytic":
+            return {self.blocks[i] for i in np.flatnonzero(self.get_visible_blocks())}
+
+        assert method == "gl", method
+
+        self.request_visible_ents()
+        return self.collect_visible_ents()
+
+    def request_visible_ents(self):
+        """
+        Issue the occlusion queries of all entities without waiting for them.
+        Requests can be issued for many environments before collecting the
+        results, so that the GPU works on all of them at once.
+        """
+
+        # Create the OpenGL context on first use
+        self._init_context()
 
         # Switch to the default OpenGL context
-        # This is necessary on Linux Nvidia drivers
-        self.shadow_window.switch_to()
+        self._make_current()
+
+        # Grow the pool of occlusion query ids, reused across calls
+        num_ents = len(self.entities)
+        if len(self.query_ids) < num_ents:
+            self.gl_resources.delete("queries", self.query_ids)
+            self.query_ids = self.gl_resources.gen("queries", num_ents)
 
         # Use the small observation frame buffer
         frame_buffer = self.obs_fb
@@ -1288,25 +1599,25 @@ class MiniWorldEnv(gym.Env):
         # Bind the frame buffer before rendering into it
         frame_buffer.bind()
 
-        # Clear the color and depth buffers
-        glClearColor(*self.sky_color, 1.0)
-        glClearDepth(1.0)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        # Clear the depth buffer, colors are not written
+        gl.glClearDepth(1.0)
+        gl.glClear(gl.GL_DEPTH_BUFFER_BIT)
+        gl.glColorMask(False, False, False, False)
 
         # Set the projection matrix
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        gluPerspective(
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.gluPerspective(
             self.agent.cam_fov_y,
             frame_buffer.width / float(frame_buffer.height),
-            0.04,
-            100.0,
+            CAM_Z_NEAR,
+            CAM_Z_FAR,
         )
 
-        # Setup the cameravisible objects
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        gluLookAt(
+        # Setup the camera
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+        gl.gluLookAt(
             # Eye position
             *self.agent.cam_pos,
             # Target
@@ -1317,20 +1628,21 @@ class MiniWorldEnv(gym.Env):
             0.0,
         )
 
-        # Render the rooms, without texturing
-        glDisable(GL_TEXTURE_2D)
-        for room in self.rooms:
-            room._render()
+        # Render the rooms from the compiled display list
+        if self.static_dirty:
+            self._render_static()
+            self.static_dirty = False
+        gl.glCallList(self.static_list)
 
         # For each entity
-        for ent_idx, ent in enumerate(self.entities):
+        self.query_ents = []
+        for ent in self.entities:
             if ent is self.agent:
                 continue
 
-            glBeginQuery(GL_ANY_SAMPLES_PASSED, query_ids[ent_idx])
+            gl.glBeginQuery(gl.GL_ANY_SAMPLES_PASSED, self.query_ids[len(self.query_ents)])
             pos = ent.pos
 
-            # glColor3f(1, 0, 0)
             drawBox(
                 x_min=pos[0] - 0.1,
                 x_max=pos[0] + 0.1,
@@ -1340,33 +1652,132 @@ class MiniWorldEnv(gym.Env):
                 z_max=pos[2] + 0.1,
             )
 
-            glEndQuery(GL_ANY_SAMPLES_PASSED)
+            gl.glEndQuery(gl.GL_ANY_SAMPLES_PASSED)
+            self.query_ents.append(ent)
 
-        vis_objs = set()
+        gl.glColorMask(True, True, True, True)
 
-        # Get query results
-        for ent_idx, ent in enumerate(self.entities):
-            if ent is self.agent:
-                continue
+        # Start executing the queries
+        gl.glFlush()
 
-            visible = (GLuint * 1)(1)
-            glGetQueryObjectuiv(query_ids[ent_idx], GL_QUERY_RESULT, visible)
+    def collect_visible_ents(self):
+        """
+        Get the results of the last request_visible_ents call
+        :return: set of objects visible to the agent
+        """
 
-            if visible[0] != 0:
-                vis_objs.add(ent)
+        self._make_current()
 
-        # Free the occlusion query ids
-        glDeleteQueries(1, query_ids)
+        vis_objs = set()
+        if len(self.query_ents) == 0:
+            return vis_objs
+
+        # Queries complete in order, so only the last one is waited on,
+        # the results of the others are then already available
+        result = gl.GLuint(0)
+        for idx in reversed(range(len(self.query_ents))):
+            ent = self.query_ents[idx]
+            gl.glGetQueryObjectuiv(self.query_ids[idx], gl.GL_QUERY_RESULT, result)
+            if result.value != 0:
+                vis_objs.add(ent)
 
-        # img = frame_buffer.resolve()
-        # return img
+        self.query_ents = []
 
         return vis_objs
 
     def close(self):
         if self.window:
             self.window.close()
-        return
+            self.window = None
+        if self.viewer:
+            self.viewer.close()
+            self.viewer = None
+
+        # Free the OpenGL objects of the environment, then its context
+        # The context is created again if the environment renders later
+        if self.shadow_window is not None:
+            self._make_current()
+            self.gl_resources.release()
+
+            # Textures are freed with the context, unless it shares them
+            if self.shadow_window.share_group is self.shadow_window:
+                Texture.release(self.shadow_window.share_group)
+                Texture.share_group = None
+
+            self.shadow_window.close()
+            self.shadow_window = None
+
+        self.obs_fb = None
+        self.vis_fb = None
+        self.query_ids = []
+        self.query_ents = []
+        self.static_list = None
+        self.program = None
+        ShaderProgram.current = None
+        self.static_dirty = True
+        self.top_views = {}
+
+    def gl_resource_counts(self):
+        """
+        Number of live OpenGL objects of each kind
+        "env" counts the objects of this environment, and "process" the
+        objects of all the environments and textures of the process
+        """
+
+        return {
+            "env": self.gl_resources.counts(),
+            "process": dict(GLResources.live),
+        }
+
+    def memory_report(self):
+        """
+        Estimate the memory used for rendering, in bytes
+        Frame buffers are created on first use, and count as 0 before
+        Textures are shared by all environments of a process
+        """
+
+        report = {}
+        for name in ["obs_fb", "vis_fb"]:
+            fb = getattr(self, name)
+            report[name] = fb.memory_bytes() if fb else {"gpu": 0, "host": 0}
+        report["textures"] = {"gpu": Texture.memory_bytes(), "host": 0}
+
+        report["total"] = {
+            key: sum(entry[key] for entry in report.values()) for key in ["gpu", "host"]
+        }
+
+        return report
+
+    def _get_obs_image(self):
+        """
+        RGB image of the last observation, None without an rgb channel
+        """
+
+        obs = self.last_obs if self.last_obs is not None else self.render_obs()
+        if isinstance(obs, dict):
+            obs = obs.get("rgb")
+
+        # Undo the float conversion and greyscale of preprocessed observations
+        if obs is not None and obs.dtype != np.uint8:
+            obs = np.round(obs.astype(np.float32) * 255).astype(np.uint8)
+        if obs is not None and obs.shape[2] == 1:
+            obs = np.repeat(obs, 3, axis=2)
+
+        return obs
+
+    def _get_render_text(self):
+        """
+        Description of the state shown next to the human view
+        """
+
+        return "pos: (%.2f, %.2f, %.2f)\nangle: %d\ncur_row: %i\nsteps: %d\nstate: %s\ngoal: %s" % (
+            *self.agent.pos,
+            int(self.agent.dir * 180 / math.pi) % 360,
+            self.cur_row, 
+            self.step_count,
+            self.state,
+            self.goal
+        )
 
     def render(self):
         """
@@ -1381,19 +1792,47 @@ class MiniWorldEnv(gym.Env):
             )
             return
 
+        # Only render when the viewer is ready to take a new frame
+        if self.render_mode == "remote":
+            if self.viewer is None:
+                self.viewer = RemoteViewer(self.viewer_address, self.metadata["render_fps"])
+            if not self.viewer.ready():
+                return
+
+        # Frame buffer used for human visualization
+        if self.vis_fb is None:
+            self._init_context()
+            self._make_current()
+            self.vis_fb = FrameBuffer(
+                self.window_width,
+                self.window_height,
+                self.render_profile.vis_samples,
+                color_format=self.render_profile.color_format,
+                resolve_depth=False,
+                resources=self.gl_resources,
+            )
+
         # Render the human-view image
         if self.view == "agent":
             img = self.render_obs(self.vis_fb)
         else:
-            img = self.render_top_view(self.vis_fb)
+            img = self.render_top_view(self.vis_fb, cached=True)
         img_width = img.shape[1]
         img_height = img.shape[0]
 
         if self.render_mode == "rgb_array":
             return img
 
-        # Render the agent's view
-        obs = self.render_obs()
+        # Agent's view, as last rendered
+        obs = self._get_obs_image()
+
+        # The viewer process draws the frame
+        if self.render_mode == "remote":
+            self.viewer.send(img, obs, self._get_render_text())
+            return
+
+        if obs is None:
+            obs = np.zeros((self.obs_height, self.obs_width, 3), dtype=np.uint8)
         obs_width = obs.shape[1]
         obs_height = obs.shape[0]
 
@@ -1401,28 +1840,38 @@ class MiniWorldEnv(gym.Env):
         window_height = max(img_height, self.obs_disp_height)
 
         if self.window is None:
-            config = pyglet.gl.Config(double_buffer=True)
+            config = gl.Config(double_buffer=True)
             self.window = pyglet.window.Window(
                 width=window_width, height=window_height, resizable=False, config=config
             )
 
+            # For displaying text
+            self.text_label = pyglet.text.Label(
+                font_name="Arial",
+                font_size=14,
+                multiline=True,
+                width=400,
+                x=self.window_width + 5,
+                y=self.window_height - (self.obs_disp_height + 19),
+            )
+
         self.window.clear()
         self.window.switch_to()
 
         # Bind the default frame buffer
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 
         # Clear the color and depth buffers
-        glClearColor(0, 0, 0, 1.0)
-        glClearDepth(1.0)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        gl.glClearColor(0, 0, 0, 1.0)
+        gl.glClearDepth(1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 
         # Setup orghogonal projection
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        glOrtho(0, window_width, 0, window_height, 0, 10)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+        gl.glOrtho(0, window_width, 0, window_height, 0, 10)
 
         # Draw the human render to the rendering window
         img_flip = np.ascontiguousarray(np.flip(img, axis=0))
@@ -1430,7 +1879,7 @@ class MiniWorldEnv(gym.Env):
             img_width,
             img_height,
             "RGB",
-            img_flip.ctypes.data_as(POINTER(GLubyte)),
+            img_flip.ctypes.data_as(POINTER(gl.GLubyte)),
             pitch=img_width * 3,
         )
         img_data.blit(0, 0, 0, width=img_width, height=img_height)
@@ -1441,7 +1890,7 @@ class MiniWorldEnv(gym.Env):
             obs_width,
             obs_height,
             "RGB",
-            obs.ctypes.data_as(POINTER(GLubyte)),
+            obs.ctypes.data_as(POINTER(gl.GLubyte)),
             pitch=obs_width * 3,
         )
         obs_data.blit(
@@ -1453,18 +1902,11 @@ class MiniWorldEnv(gym.Env):
         )
 
         # Draw the text label in the window
-        self.text_label.text = "pos: (%.2f, %.2f, %.2f)\nangle: %d\ncur_row: %i\nsteps: %d\nstate: %s\ngoal: %s" % (
-            *self.agent.pos,
-            int(self.agent.dir * 180 / math.pi) % 360,
-            self.cur_row, 
-            self.step_count,
-            self.state,
-            self.goal
-        )
+        self.text_label.text = self._get_render_text()
         self.text_label.draw()
 
         # Force execution of queued commands
-        glFlush()
+        gl.glFlush()
 
         # If we are not running the Pyglet event loop,
         # we have to manually flip the buffers and dispatch events
@@ -2,36 +2,12 @@ import math
 
 import numpy as np
 
-# Map of color names to RGB values
-from pyglet.gl import (
-    GL_BLEND,
-    GL_LINES,
-    GL_ONE_MINUS_SRC_ALPHA,
-    GL_QUADS,
-    GL_SRC_ALPHA,
-    GL_TEXTURE_2D,
-    GL_TRIANGLES,
-    glBegin,
-    glBlendFunc,
-    glColor3f,
-    glColor4f,
-    glDisable,
-    glEnable,
-    glEnd,
-    glNormal3f,
-    glPopMatrix,
-    glPushMatrix,
-    glRotatef,
-    glScalef,
-    glTexCoord2f,
-    glTranslatef,
-    glVertex3f,
-)
-
+from . import gl
 from .math import X_VEC, Y_VEC, Z_VEC, gen_rot_matrix
 from .objmesh import ObjMesh
-from .opengl import Texture, drawBox
+from .opengl import Texture, drawBox, set_texturing
 
+# Map of color names to RGB values
 COLORS = {
     "red": np.array([1.0, 0.0, 0.0]),
     "green": np.array([0.0, 1.0, 0.0]),
@@ -47,6 +23,10 @@ COLOR_NAMES = sorted(list(COLORS.keys()))
 
 
 class Entity:
+    # Entities use slots rather than a per-instance dict, which makes them
+    # smaller and faster to create, subclasses declare their own attributes
+    __slots__ = ("pos", "dir", "radius", "height")
+
     def __init__(self):
         # World position
         # Note: for most entities, the position is at floor level
@@ -87,16 +67,16 @@ class Entity:
 
         x, _, z = self.pos
 
-        glColor3f(1, 0, 0)
-        glBegin(GL_LINES)
+        gl.glColor3f(1, 0, 0)
+        gl.glBegin(gl.GL_LINES)
 
         for i in range(60):
             a = i * 2 * math.pi / 60
             cx = x + self.radius * math.cos(a)
             cz = z + self.radius * math.sin(a)
-            glVertex3f(cx, 0.01, cz)
+            gl.glVertex3f(cx, 0.01, cz)
 
-        glEnd()
+        gl.glEnd()
 
     @property
     def dir_vec(self):
@@ -135,6 +115,8 @@ class MeshEnt(Entity):
     static -- flag indicating this object cannot move
     """
 
+    __slots__ = ("static", "mesh", "scale")
+
     def __init__(self, mesh_name, height, static=True):
         super().__init__()
 
@@ -158,13 +140,13 @@ class MeshEnt(Entity):
         Draw the object
         """
 
-        glPushMatrix()
-        glTranslatef(*self.pos)
-        glScalef(self.scale, self.scale, self.scale)
-        glRotatef(self.dir * 180 / math.pi, 0, 1, 0)
-        glColor3f(1, 1, 1)
+        gl.glPushMatrix()
+        gl.glTranslatef(*self.pos)
+        gl.glScalef(self.scale, self.scale, self.scale)
+        gl.glRotatef(self.dir * 180 / math.pi, 0, 1, 0)
+        gl.glColor3f(1, 1, 1)
         self.mesh.render()
-        glPopMatrix()
+        gl.glPopMatrix()
 
     @property
     def is_static(self):
@@ -177,6 +159,8 @@ class ImageFrame(Entity):
     Note: the position is in the middle of the frame, on the wall
     """
 
+    __slots__ = ("tex", "width", "depth")
+
     def __init__(self, pos, dir, tex_name, width, depth=0.05):
         super().__init__()
 
@@ -207,65 +191,65 @@ class ImageFrame(Entity):
         hz = self.width / 2
         hy = self.height / 2
 
-        glPushMatrix()
-        glTranslatef(*self.pos)
-        glRotatef(self.dir * (180 / math.pi), 0, 1, 0)
+        gl.glPushMatrix()
+        gl.glTranslatef(*self.pos)
+        gl.glRotatef(self.dir * (180 / math.pi), 0, 1, 0)
 
         # Bind texture for front
-        glColor3f(1, 1, 1)
-        glEnable(GL_TEXTURE_2D)
+        gl.glColor3f(1, 1, 1)
+        set_texturing(True)
         self.tex.bind()
 
         # Front face, showing image
-        glBegin(GL_QUADS)
-        glNormal3f(1, 0, 0)
-        glTexCoord2f(1, 1)
-        glVertex3f(sx, +hy, -hz)
-        glTexCoord2f(0, 1)
-        glVertex3f(sx, +hy, +hz)
-        glTexCoord2f(0, 0)
-        glVertex3f(sx, -hy, +hz)
-        glTexCoord2f(1, 0)
-        glVertex3f(sx, -hy, -hz)
-        glEnd()
+        gl.glBegin(gl.GL_QUADS)
+        gl.glNormal3f(1, 0, 0)
+        gl.glTexCoord2f(1, 1)
+        gl.glVertex3f(sx, +hy, -hz)
+        gl.glTexCoord2f(0, 1)
+        gl.glVertex3f(sx, +hy, +hz)
+        gl.glTexCoord2f(0, 0)
+        gl.glVertex3f(sx, -hy, +hz)
+        gl.glTexCoord2f(1, 0)
+        gl.glVertex3f(sx, -hy, -hz)
+        gl.glEnd()
 
         # Black frame/border
-        glDisable(GL_TEXTURE_2D)
-        glColor3f(0, 0, 0)
+        set_texturing(False)
+        gl.glColor3f(0, 0, 0)
 
-        glBegin(GL_QUADS)
+        gl.glBegin(gl.GL_QUADS)
 
         # Left
-        glNormal3f(0, 0, -1)
-        glVertex3f(0, +hy, -hz)
-        glVertex3f(+sx, +hy, -hz)
-        glVertex3f(+sx, -hy, -hz)
-        glVertex3f(0, -hy, -hz)
+        gl.glNormal3f(0, 0, -1)
+        gl.glVertex3f(0, +hy, -hz)
+        gl.glVertex3f(+sx, +hy, -hz)
+        gl.glVertex3f(+sx, -hy, -hz)
+        gl.glVertex3f(0, -hy, -hz)
 
         # Right
-        glNormal3f(0, 0, 1)
-        glVertex3f(+sx, +hy, +hz)
-        glVertex3f(0, +hy, +hz)
-        glVertex3f(0, -hy, +hz)
-        glVertex3f(+sx, -hy, +hz)
+        gl.glNormal3f(0, 0, 1)
+        gl.glVertex3f(+sx, +hy, +hz)
+        gl.glVertex3f(0, +hy, +hz)
+        gl.glVertex3f(0, -hy, +hz)
+        gl.glVertex3f(+sx, -hy, +hz)
 
         # Top
-        glNormal3f(0, 1, 0)
-        glVertex3f(+sx, +hy, +hz)
-        glVertex3f(+sx, +hy, -hz)
-        glVertex3f(0, +hy, -hz)
-        glVertex3f(0, +hy, +hz)
+        gl.glNormal3f(0, 1, 0)
+        gl.glVertex3f(+sx, +hy, +hz)
+        gl.glVertex3f(+sx, +hy, -hz)
+        gl.glVertex3f(0, +hy, -hz)
+        gl.glVertex3f(0, +hy, +hz)
 
         # Bottom
-        glNormal3f(0, -1, 0)
-        glVertex3f(+sx, -hy, -hz)
-        glVertex3f(+sx, -hy, +hz)
-        glVertex3f(0, -hy, +hz)
-        glVertex3f(0, -hy, -hz)
+        gl.glNormal3f(0, -1, 0)
+        gl.glVertex3f(+sx, -hy, -hz)
+        gl.glVertex3f(+sx, -hy, +hz)
+        gl.glVertex3f(0, -hy, +hz)
+        gl.glVertex3f(0, -hy, -hz)
 
-        glEnd()
+        gl.glEnd()
 
-        glPopMatrix()
+        gl.glPopMatrix()
 
 
 class TextFrame(Entity):
@@ -274,6 +258,8 @@ class TextFrame(Entity):
     Note: the position is in the middle of the frame, on the wall
     """
 
+    __slots__ = ("str", "width", "depth", "texs")
+
     def __init__(self, pos, dir, str, height=0.15, depth=0.05):
         super().__init__()
 
@@ -317,84 +303,89 @@ class TextFrame(Entity):
         hz = self.width / 2
         hy = self.height / 2
 
-        glPushMatrix()
-        glTranslatef(*self.pos)
-        glRotatef(self.dir * (180 / math.pi), 0, 1, 0)
+        gl.glPushMatrix()
+        gl.glTranslatef(*self.pos)
+        gl.glRotatef(self.dir * (180 / math.pi), 0, 1, 0)
 
         # Bind texture for front
-        glColor3f(1, 1, 1)
+        gl.glColor3f(1, 1, 1)
 
         # For each character
         for idx, ch in enumerate(self.str):
             tex = self.texs[idx]
             if tex:
-                glEnable(GL_TEXTURE_2D)
+                set_texturing(True)
                 self.texs[idx].bind()
             else:
-                glDisable(GL_TEXTURE_2D)
+                set_texturing(False)
 
             char_width = self.height
             z_0 = hz - char_width * (idx + 1)
             z_1 = z_0 + char_width
 
             # Front face, showing image
-            glBegin(GL_QUADS)
-            glNormal3f(1, 0, 0)
-            glTexCoord2f(1, 1)
-            glVertex3f(sx, +hy, z_0)
-            glTexCoord2f(0, 1)
-            glVertex3f(sx, +hy, z_1)
-            glTexCoord2f(0, 0)
-            glVertex3f(sx, -hy, z_1)
-            glTexCoord2f(1, 0)
-            glVertex3f(sx, -hy, z_0)
-            glEnd()
+            gl.glBegin(gl.GL_QUADS)
+            gl.glNormal3f(1, 0, 0)
+            gl.glTexCoord2f(1, 1)
+            gl.glVertex3f(sx, +hy, z_0)
+            gl.glTexCoord2f(0, 1)
+            gl.glVertex3f(sx, +hy, z_1)
+            gl.glTexCoord2f(0, 0)
+            gl.glVertex3f(sx, -hy, z_1)
+            gl.glTexCoord2f(1, 0)
+            gl.glVertex3f(sx, -hy, z_0)
+            gl.glEnd()
 
         # Black frame/border
-        glDisable(GL_TEXTURE_2D)
-        glColor3f(0, 0, 0)
+        set_texturing(False)
+        gl.glColor3f(0, 0, 0)
 
-        glBegin(GL_QUADS)
+        gl.glBegin(gl.GL_QUADS)
 
         # Left
-        glNormal3f(0, 0, -1)
-        glVertex3f(0, +hy, -hz)
-        glVertex3f(+sx, +hy, -hz)
-        glVertex3f(+sx, -hy, -hz)
-        glVertex3f(0, -hy, -hz)
+        gl.glNormal3f(0, 0, -1)
+        gl.glVertex3f(0, +hy, -hz)
+        gl.glVertex3f(+sx, +hy, -hz)
+        gl.glVertex3f(+sx, -hy, -hz)
+        gl.glVertex3f(0, -hy, -hz)
 
         # Right
-        glNormal3f(0, 0, 1)
-        glVertex3f(+sx, +hy, +hz)
-        glVertex3f(0, +hy, +hz)
-        glVertex3f(0, -hy, +hz)
-        glVertex3f(+sx, -hy, +hz)
+        gl.glNormal3f(0, 0, 1)
+        gl.glVertex3f(+sx, +hy, +hz)
+        gl.glVertex3f(0, +hy, +hz)
+        gl.glVertex3f(0, -hy, +hz)
+        gl.glVertex3f(+sx, -hy, +hz)
 
         # Top
-        glNormal3f(0, 1, 0)
-        glVertex3f(+sx, +hy, +hz)
-        glVertex3f(+sx, +hy, -hz)
-        glVertex3f(0, +hy, -hz)
-        glVertex3f(0, +hy, +hz)
+        gl.glNormal3f(0, 1, 0)
+        gl.glVertex3f(+sx, +hy, +hz)
+        gl.glVertex3f(+sx, +hy, -hz)
+        gl.glVertex3f(0, +hy, -hz)
+        gl.glVertex3f(0, +hy, +hz)
 
         # Bottom
-        glNormal3f(0, -1, 0)
-        glVertex3f(+sx, -hy, -hz)
-        glVertex3f(+sx, -hy, +hz)
-        glVertex3f(0, -hy, +hz)
-        glVertex3f(0, -hy, -hz)
+        gl.glNormal3f(0, -1, 0)
+        gl.glVertex3f(+sx, -hy, -hz)
+        gl.glVertex3f(+sx, -hy, +hz)
+        gl.glVertex3f(0, -hy, +hz)
+        gl.glVertex3f(0, -hy, -hz)
 
-        glEnd()
+        gl.glEnd()
 
-        glPopMatrix()
+        gl.glPopMatrix()
 
 
 class Block(Entity):
     """
     Colored block object
+    When part of a BlockGrid, the block is a view into the grid arrays,
+    which hold its position and color
     """
 
-    def __init__(self, color, size=0.8):
+    __slots__ = ("grid", "id", "color", "size", "_pos", "_color_vec")
+
+    def __init__(self, color, size=0.8, grid=None, block_id=None):
+        self.grid = None
         super().__init__()
 
         if type(size) is int or type(size) is float:
@@ -407,30 +398,96 @@ class Block(Entity):
 
         self.radius = math.sqrt(sx * sx + sz * sz) / 2
         self.height = sy
-        
-        self.is_above = None
-        self.is_beneath = None
+
+        self.grid = grid
+        self.id = block_id
+
+    @property
+    def pos(self):
+        if self.grid is None:
+            return self._pos
+        return self.grid.positions[self.id]
+
+    @pos.setter
+    def pos(self, pos):
+        if self.grid is None:
+            self._pos = pos
+        else:
+            self.grid.positions[self.id] = pos
+
+    @property
+    def color_vec(self):
+        if self.grid is None:
+            return self._color_vec
+        return self.grid.colors[self.id]
+
+    @color_vec.setter
+    def color_vec(self, color_vec):
+        if self.grid is None:
+            self._color_vec = color_vec
+        else:
+            self.grid.colors[self.id] = color_vec
+
+    @property
+    def row(self):
+        """
+        Row of the stack holding this block, -1 if not in a stack
+        """
+
+        return int(self.grid.cells[self.id, 0])
 
     def randomize(self, params, rng):
         self.color_vec = COLORS[self.color] + params.sample(rng, "obj_color_bias")
         self.color_vec = np.clip(self.color_vec, 0, 1)
 
+    @staticmethod
+    def randomize_many(blocks, params, rng):
+        """
+        Randomize a list of blocks with a single draw of the parameters
+        Draws the same values as calling randomize on each block in turn
+        """
+
+        bias = params.sample_batch(rng, ["obj_color_bias"], len(blocks))
+        colors = np.array([COLORS[block.color] for block in blocks]).reshape(-1, 3)
+        color_vecs = np.clip(colors + bias["obj_color_bias"], 0, 1)
+
+        grid = blocks[0].grid if len(blocks) > 0 else None
+        if grid is not None and all(block.grid is grid for block in blocks):
+            # Write all the colors into the grid at once
+            grid.colors[[block.id for block in blocks]] = color_vecs
+        else:
+            for block, color_vec in zip(blocks, color_vecs):
+                block.color_vec = color_vec
+
     def render(self, opacity=1):
         """
         Draw the object
         """
 
-        sx, sy, sz = self.size
+        set_texturing(False)
 
-        glDisable(GL_TEXTURE_2D)
-        glColor4f(*self.color_vec, opacity) # Set the fourth component as opacity
+        gl.glEnable(gl.GL_BLEND) # Enable blending to handle transparency
+        # Alpha accumulates coverage, so layers can be composited afterwards
+        gl.glBlendFuncSeparate(
+            gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA, gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA
+        )
 
-        glEnable(GL_BLEND) # Enable blending to handle transparency
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        self.draw(opacity)
 
-        glPushMatrix()
-        glTranslatef(*self.pos)
-        glRotatef(self.dir * (180 / math.pi), 0, 1, 0)
+        gl.glDisable(gl.GL_BLEND) # Disable blending after drawing the block
+
+    def draw(self, opacity=1):
+        """
+        Draw the block without changing the render state, see RenderQueue
+        """
+
+        sx, sy, sz = self.size
+
+        gl.glColor4f(*self.color_vec, opacity) # Set the fourth component as opacity
+
+        gl.glPushMatrix()
+        gl.glTranslatef(*self.pos)
+        gl.glRotatef(self.dir * (180 / math.pi), 0, 1, 0)
 
         drawBox(
             x_min=-sx / 2,
@@ -441,10 +498,38 @@ class Block(Entity):
             z_max=+sz / 2,
         )
 
-        glPopMatrix()
+        gl.glPopMatrix()
+
+
 
-        glDisable(GL_BLEND) # Disable blending after drawing the block
+class BlockPool:
+    """
+    Blocks of an environment, recycled across episodes
+    Block positions and colors live in the BlockGrid arrays, so reusing
+    a block only binds it to the grid of the new episode. Blocks keep the
+    id of their index in the pool.
+    """
 
+    __slots__ = ("size", "blocks")
+
+    def __init__(self, size=0.8):
+        self.size = size
+        self.blocks = []
+
+    def get(self, grid, color):
+        """
+        Blocks for all the blocks of a grid, created on first use
+        """
+
+        while len(self.blocks) < grid.num_blocks:
+            self.blocks.append(Block(color, self.size, grid, len(self.blocks)))
+
+        blocks = self.blocks[: grid.num_blocks]
+        for block in blocks:
+            block.grid = grid
+            block.color = color
+
+        return blocks
 
 
 class Key(MeshEnt):
@@ -452,6 +537,8 @@ class Key(MeshEnt):
     Key the agent can pick up, carry, and use to open doors
     """
 
+    __slots__ = ()
+
     def __init__(self, color):
         assert color in COLOR_NAMES
         super().__init__(mesh_name=f"key_{color}", height=0.35, static=False)
@@ -462,12 +549,16 @@ class Ball(MeshEnt):
     Ball (sphere) the agent can pick up and carry
     """
 
+    __slots__ = ()
+
     def __init__(self, color, size=0.6):
         assert color in COLOR_NAMES
         super().__init__(mesh_name=f"ball_{color}", height=size, static=False)
 
 
 class Agent(Entity):
+    __slots__ = ("cam_height", "cam_pitch", "cam_fov_y", "cam_fwd_disp", "carrying")
+
     def __init__(self):
         super().__init__()
 
@@ -522,5 +613,25 @@ class Agent(Entity):
     def randomize(self, params, rng):
         pass
 
+    def render(self):
+        """
+        Draw the agent as a triangle, only used in the top view
+        """
+
+        p = self.pos + Y_VEC * self.height
+        dv = self.dir_vec * self.radius
+        rv = self.right_vec * self.radius
+
+        p0 = p + dv
+        p1 = p + 0.75 * (rv - dv)
+        p2 = p + 0.75 * (-rv - dv)
+
+        gl.glColor3f(1, 0, 0)
+        gl.glBegin(gl.GL_TRIANGLES)
+        gl.glVertex3f(*p0)
+        gl.glVertex3f(*p2)
+        gl.glVertex3f(*p1)
+        gl.glEnd()
+
     def step(self, delta_time):
         pass
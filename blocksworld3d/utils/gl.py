@@ -0,0 +1,55 @@
+"""
+Lazily loaded OpenGL bindings
+
+Importing pyglet.gl loads the OpenGL library and creates a context, which is
+slow and needs a display. Modules use `from . import gl` and call functions
+as `gl.glEnable(...)`, so the bindings are only imported on first use.
+"""
+
+import importlib
+import os
+
+import pyglet
+
+# True once pyglet.gl has been imported
+loaded = False
+
+
+def load():
+    """
+    Import the OpenGL bindings, if not already done
+    """
+
+    global loaded
+
+    if loaded:
+        return
+
+    # Solution to https://github.com/maximecb/gym-miniworld/issues/24
+    # until pyglet support egl officially
+    if os.environ.get("PYOPENGL_PLATFORM", None) == "egl":
+        pyglet.options["headless"] = True
+
+    # Environments create their own context, no need for pyglet's
+    pyglet.options["shadow_window"] = False
+
+    pyglet_gl = importlib.import_module("pyglet.gl")
+
+    globals().update(
+        (name, value)
+        for name, value in vars(pyglet_gl).items()
+        if not name.startswith("__")
+    )
+    loaded = True
+
+
+def __getattr__(name):
+    if name.startswith("__") or loaded:
+        raise AttributeError(name)
+
+    load()
+
+    try:
+        return globals()[name]
+    except KeyError:
+        raise AttributeError(name) from None
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+class BlockGrid:
+    """
+    Stacks of blocks stored in fixed-size arrays
+
+    ids       -- (rows, cols, max_height) id of the block at each level, -1 if empty
+    heights   -- (rows, cols) number of blocks in each stack
+    cells     -- (num_blocks, 3) row, column and level of each block,
+                 -1 for blocks outside of the stacks (being carried)
+    positions -- (num_blocks, 3) world position of each block
+    colors    -- (num_blocks, 3) RGB color of each block
+
+    The per-block arrays are views into buffers allocated once for the
+    largest number of blocks, so refilling the grid allocates nothing.
+    """
+
+    def __init__(self, spots, block_height, max_height):
+        # World position of the bottom of each stack, shape (rows, cols, 3)
+        self.spots = np.asarray(spots, dtype=float)
+        self.num_rows, self.num_cols, _ = self.spots.shape
+
+        self.block_height = block_height
+        self.max_height = max_height
+
+        # Full stacks, plus one block being carried
+        self._reserve(self.num_rows * self.num_cols * max_height + 1)
+        self.heights = np.zeros((self.num_rows, self.num_cols), dtype=np.int32)
+        self.ids = np.full((self.num_rows, self.num_cols, max_height), -1, dtype=np.int32)
+
+        self.fill(np.zeros((self.num_rows, self.num_cols), dtype=np.int32))
+
+    def fill(self, heights, num_extra=0):
+        """
+        Reset the grid to the given stack heights
+        Block ids are assigned row by row, from the bottom of each stack,
+        and num_extra more blocks are allocated outside of the stacks
+        """
+
+        heights = np.asarray(heights, dtype=np.int32)
+        assert heights.shape == (self.num_rows, self.num_cols)
+        assert heights.max(initial=0) <= self.max_height
+
+        occupied = np.arange(self.max_height) < heights[:, :, np.newaxis]
+        num_stacked = int(heights.sum())
+        num_blocks = num_stacked + num_extra
+        if num_blocks > len(self._cells):
+            self._reserve(num_blocks)
+
+        self.heights[:] = heights
+        self.ids.fill(-1)
+        self.ids[occupied] = np.arange(num_stacked)
+
+        self.cells = self._cells[:num_blocks]
+        self.cells.fill(-1)
+        self.cells[:num_stacked] = np.argwhere(occupied)
+
+        self.positions = self._positions[:num_blocks]
+        self.positions.fill(0)
+        self.positions[:num_stacked] = self.cell_positions(self.cells[:num_stacked])
+
+        self.colors = self._colors[:num_blocks]
+        self.colors.fill(0)
+
+    def _reserve(self, num_blocks):
+        """
+        Allocate the buffers of the per-block arrays
+        """
+
+        self._cells = np.full((num_blocks, 3), -1, dtype=np.int32)
+        self._positions = np.zeros((num_blocks, 3), dtype=float)
+        self._colors = np.zeros((num_blocks, 3), dtype=float)
+
+    @property
+    def num_blocks(self):
+        return len(self.cells)
+
+    def cell_positions(self, cells):
+        """
+        World positions of blocks at the given (row, col, level) cells
+        """
+
+        cells = np.asarray(cells)
+        pos = self.spots[cells[..., 0], cells[..., 1]].copy()
+        pos[..., 1] += cells[..., 2] * self.block_height
+        return pos
+
+    def col_at(self, pos):
+        """
+        Index of the column closest to a world position
+        """
+
+        return int(np.argmin(np.abs(self.spots[0, :, 2] - pos[2])))
+
+    def top(self, row, col):
+        """
+        Id of the block at the top of a stack, or None if the stack is empty
+        """
+
+        height = self.heights[row, col]
+        if height == 0:
+            return None
+        return int(self.ids[row, col, height - 1])
+
+    def pop(self, row, col):
+        """
+        Remove the block at the top of a stack and return its id
+        """
+
+        block_id = self.top(row, col)
+        assert block_id is not None, "cannot pop from an empty stack"
+
+        self.heights[row, col] -= 1
+        self.ids[row, col, self.heights[row, col]] = -1
+        self.cells[block_id] = -1
+
+        return block_id
+
+    def push(self, row, col, block_id):
+        """
+        Place a block at the top of a stack
+        """
+
+        height = self.heights[row, col]
+        assert height < self.max_height, "stack is full"
+        assert self.cells[block_id, 0] == -1, "block is already in a stack"
+
+        self.ids[row, col, height] = block_id
+        self.heights[row, col] += 1
+        self.cells[block_id] = (row, col, height)
+        self.positions[block_id] = self.cell_positions(self.cells[block_id])
@@ -60,3 +60,51 @@ def intersect_circle_segs(point, radius, segs):
 
     # No intersection
     return None
+
+
+def points_in_frustum(points, cam_pos, cam_dir, fov_y, aspect, z_near, z_far):
+    """
+    Test which points are inside the view frustum of a perspective camera
+    The camera up vector is +Y, fov_y is in degrees
+    """
+
+    fwd = cam_dir / np.linalg.norm(cam_dir)
+    right = np.cross(fwd, Y_VEC)
+    right = right / np.linalg.norm(right)
+    up = np.cross(right, fwd)
+
+    rel = np.asarray(points) - cam_pos
+    z = rel @ fwd
+    x = rel @ right
+    y = rel @ up
+
+    tan_y = math.tan(math.radians(fov_y) / 2)
+    tan_x = tan_y * aspect
+
+    return (
+        (z > z_near)
+        & (z < z_far)
+        & (np.abs(y) <= z * tan_y)
+        & (np.abs(x) <= z * tan_x)
+    )
+
+
+def segments_hit_boxes(origin, targets, box_min, box_max):
+    """
+    Test which segments from origin to each target cross each box
+    Returns a (num_targets, num_boxes) array, True when the box is hit
+    strictly before the target point is reached (slab test)
+    """
+
+    dirs = np.asarray(targets) - origin
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = 1 / dirs[:, np.newaxis, :]
+        t0 = (box_min[np.newaxis] - origin) * inv
+        t1 = (box_max[np.newaxis] - origin) * inv
+
+    # Axes parallel to the segment give nan when the origin is on a slab plane
+    t_near = np.nanmax(np.minimum(t0, t1), axis=2)
+    t_far = np.nanmin(np.maximum(t0, t1), axis=2)
+
+    return (t_near <= t_far) & (t_far > 0) & (t_near < 1)
@@ -1,11 +1,14 @@
+import hashlib
 import os
+import re
+import zipfile
 
 import numpy as np
 import pyglet
-from pyglet.gl import GL_TEXTURE_2D, GL_TRIANGLES, glBindTexture, glDisable, glEnable
 
-from .opengl import Texture
-from .utils import get_file_path
+from . import gl
+from .opengl import Texture, set_texturing
+from .utils import get_cache_dir, get_file_path
 
 
 class ObjMesh:
@@ -42,6 +45,57 @@ class ObjMesh:
         - only triangle faces
         """
 
+        # Processed vertex data is cached on disk, keyed by the source files
+        cache_path = self._cache_path(file_path)
+        data = self._load_cache(cache_path)
+
+        if data is None:
+            data = self._parse(file_path)
+            self._save_cache(cache_path, data)
+
+        list_verts = data["verts"]
+        list_texcs = data["texcs"]
+        list_norms = data["norms"]
+        list_color = data["color"]
+
+        # Recompute the object extents after centering
+        self.min_coords = list_verts.min(axis=0).min(axis=0)
+        self.max_coords = list_verts.max(axis=0).max(axis=0)
+
+        # Vertex lists, one per chunk
+        self.vlists = []
+
+        # Textures, one per chunk
+        self.textures = []
+
+        # For each chunk
+        for (start_idx, end_idx), tex_path in zip(
+            data["chunk_bounds"], data["chunk_texs"]
+        ):
+            num_faces_chunk = end_idx - start_idx
+
+            # Create a vertex list to be used for rendering
+            vlist = pyglet.graphics.vertex_list(
+                3 * num_faces_chunk,
+                ("v3f", list_verts[start_idx:end_idx, :, :].reshape(-1)),
+                ("t2f", list_texcs[start_idx:end_idx, :, :].reshape(-1)),
+                ("n3f", list_norms[start_idx:end_idx, :, :].reshape(-1)),
+                ("c3f", list_color[start_idx:end_idx, :, :].reshape(-1)),
+            )
+
+            if tex_path:
+                texture = Texture.load(str(tex_path))
+            else:
+                texture = None
+
+            self.vlists.append(vlist)
+            self.textures.append(texture)
+
+    def _parse(self, file_path):
+        """
+        Parse an OBJ file into per-face vertex arrays
+        """
+
         # OBJ file format:
         # #Comments
         # mtllib file_name
@@ -56,118 +110,88 @@ class ObjMesh:
 
         # Attempt to load the materials library
         materials = self._load_mtl(file_path)
-        mesh_file = open(file_path)
+
+        with open(file_path) as mesh_file:
+            lines = mesh_file.read().splitlines()
 
         verts = []
         texs = []
         normals = []
         faces = []
+        face_mtls = []
 
         cur_mtl = ""
 
-        # For each line of the input file
-        for line in mesh_file:
-            line = line.rstrip(" \r\n")
+        # Bucket the lines by prefix, numeric conversion is done in bulk below
+        for line in lines:
+            tokens = line.split()
 
             # Skip comments
-            if line.startswith("#") or line == "":
+            if len(tokens) == 0 or tokens[0].startswith("#"):
                 continue
 
-            tokens = line.split(" ")
-            tokens = map(lambda t: t.strip(" "), tokens)
-            tokens = list(filter(lambda t: t != "", tokens))
-
             prefix = tokens[0]
-            tokens = tokens[1:]
 
             if prefix == "v":
-                vert = list(map(lambda v: float(v), tokens))
-                verts.append(vert)
+                verts.append(tokens[1:4])
 
-            if prefix == "vt":
-                tc = list(map(lambda v: float(v), tokens))
-                texs.append(tc)
+            elif prefix == "vt":
+                texs.append(tokens[1:3])
 
-            if prefix == "vn":
-                normal = list(map(lambda v: float(v), tokens))
-                normals.append(normal)
+            elif prefix == "vn":
+                normals.append(tokens[1:4])
 
-            if prefix == "usemtl":
-                mtl_name = tokens[0]
+            elif prefix == "usemtl":
+                mtl_name = tokens[1]
                 if mtl_name in materials:
                     cur_mtl = mtl_name
                 else:
                     cur_mtl = ""
 
-            if prefix == "f":
-                assert len(tokens) == 3, "only triangle faces are supported"
+            elif prefix == "f":
+                assert len(tokens) == 4, "only triangle faces are supported"
+                faces.append(" ".join(tokens[1:]))
+                face_mtls.append(cur_mtl)
 
-                face = []
-                for token in tokens:
-                    indices = filter(lambda t: t != "", token.split("/"))
-                    indices = list(map(lambda idx: int(idx), indices))
-                    assert len(indices) == 2 or len(indices) == 3
-                    face.append(indices)
+        verts = np.array(verts, dtype=np.float32).reshape(-1, 3)
+        normals = np.array(normals, dtype=np.float32).reshape(-1, 3)
 
-                faces.append([face, cur_mtl])
+        # Texture coordinates are optional, index 0 maps to (0, 0)
+        texs = np.array(texs, dtype=np.float32).reshape(-1, 2)
+        texs = np.concatenate([np.zeros((1, 2), dtype=np.float32), texs])
 
-        mesh_file.close()
+        # Face indices are v/t/n or v//n, rewrite the latter as v/0/n
+        # Note: OBJ uses 1-based indexing
+        face_str = re.sub(r"(?<![/\d])(\d+)/+(\d+)(?![/\d])", r"\1/0/\2", " ".join(faces))
+        indices = np.array(face_str.replace("/", " ").split(), dtype=np.int64)
+        indices = indices.reshape(-1, 3, 3)
 
         # Sort the faces by material name
-        faces.sort(key=lambda f: f[1])
+        face_mtls = np.array(face_mtls, dtype=str)
+        order = np.argsort(face_mtls, kind="stable")
+        indices = indices[order]
+        face_mtls = face_mtls[order]
 
         # Compute the start and end faces for each chunk in the model
-        cur_mtl = None
-        chunks = []
-        for idx, face in enumerate(faces):
-            face, mtl_name = face
-            if mtl_name != cur_mtl:
-                if len(chunks) > 0:
-                    chunks[-1]["end_idx"] = idx
-                chunks.append(
-                    {"mtl": materials[mtl_name], "start_idx": idx, "end_idx": None}
-                )
-                cur_mtl = mtl_name
-        chunks[-1]["end_idx"] = len(faces)
-
-        num_faces = len(faces)
-        # print('num verts=%d' % len(verts))
-        # print('num faces=%d' % num_faces)
-        # print('num chunks=%d' % len(chunks))
-
-        # Create numpy arrays to store the vertex data
-        list_verts = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
-        list_norms = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
-        list_texcs = np.zeros(shape=(num_faces, 3, 2), dtype=np.float32)
-        list_color = np.zeros(shape=(num_faces, 3, 3), dtype=np.float32)
-
-        # For each triangle
-        for f_idx, face in enumerate(faces):
-            face, mtl_name = face
-
-            # Get the color for this face
-            f_mtl = materials[mtl_name]
-            f_color = f_mtl["Kd"] if f_mtl else np.array((1, 1, 1))
-
-            # For each tuple of indices
-            for l_idx, indices in enumerate(face):
-                # Note: OBJ uses 1-based indexing
-                # and texture coordinates are optional
-                if len(indices) == 3:
-                    v_idx, t_idx, n_idx = indices
-                    vert = verts[v_idx - 1]
-                    texc = texs[t_idx - 1]
-                    normal = normals[n_idx - 1]
-                else:
-                    v_idx, n_idx = indices
-                    vert = verts[v_idx - 1]
-                    normal = normals[n_idx - 1]
-                    texc = [0, 0]
-
-                list_verts[f_idx, l_idx, :] = vert
-                list_texcs[f_idx, l_idx, :] = texc
-                list_norms[f_idx, l_idx, :] = normal
-                list_color[f_idx, l_idx, :] = f_color
+        mtl_names, start_idxs = np.unique(face_mtls, return_index=True)
+        end_idxs = np.append(start_idxs[1:], len(face_mtls))
+        chunk_bounds = np.stack([start_idxs, end_idxs], axis=1)
+        chunk_texs = np.array(
+            [materials[name].get("map_Kd", "") for name in mtl_names], dtype=str
+        )
+
+        # Gather the vertex data for each triangle
+        list_verts = verts[indices[:, :, 0] - 1]
+        list_texcs = texs[indices[:, :, 1]]
+        list_norms = normals[indices[:, :, 2] - 1]
+
+        # Get the color for each face
+        mtl_colors = np.array(
+            [materials[name].get("Kd", np.ones(3)) for name in mtl_names],
+            dtype=np.float32,
+        ).reshape(-1, 3)
+        chunk_idxs = np.searchsorted(start_idxs, np.arange(len(face_mtls)), "right") - 1
+        list_color = np.repeat(mtl_colors[chunk_idxs][:, np.newaxis, :], 3, axis=1)
 
         # Re-center the object so that the base is at y=0
         # and the object is centered in x and z
@@ -181,39 +205,50 @@ class ObjMesh:
         list_verts[:, :, 0] -= mean_x
         list_verts[:, :, 2] -= mean_z
 
-        # Recompute the object extents after centering
-        self.min_coords = list_verts.min(axis=0).min(axis=0)
-        self.max_coords = list_verts.max(axis=0).max(axis=0)
-
-        # Vertex lists, one per chunk
-        self.vlists = []
-
-        # Textures, one per chunk
-        self.textures = []
-
-        # For each chunk
-        for chunk in chunks:
-            start_idx = chunk["start_idx"]
-            end_idx = chunk["end_idx"]
-            num_faces_chunk = end_idx - start_idx
-
-            # Create a vertex list to be used for rendering
-            vlist = pyglet.graphics.vertex_list(
-                3 * num_faces_chunk,
-                ("v3f", list_verts[start_idx:end_idx, :, :].reshape(-1)),
-                ("t2f", list_texcs[start_idx:end_idx, :, :].reshape(-1)),
-                ("n3f", list_norms[start_idx:end_idx, :, :].reshape(-1)),
-                ("c3f", list_color[start_idx:end_idx, :, :].reshape(-1)),
-            )
+        return {
+            "verts": list_verts,
+            "texcs": list_texcs,
+            "norms": list_norms,
+            "color": list_color,
+            "chunk_bounds": chunk_bounds,
+            "chunk_texs": chunk_texs,
+        }
 
-            mtl = chunk["mtl"]
-            if "map_Kd" in mtl:
-                texture = Texture.load(mtl["map_Kd"])
-            else:
-                texture = None
+    @staticmethod
+    def _cache_path(file_path):
+        """
+        Path of the on-disk cache entry for a mesh file
+        Keyed by the path, size and modification time of the OBJ/MTL files
+        """
 
-            self.vlists.append(vlist)
-            self.textures.append(texture)
+        key = []
+        for path in (file_path, os.path.splitext(file_path)[0] + ".mtl"):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                key.append("%s:%d:%d" % (os.path.realpath(path), stat.st_size, stat.st_mtime_ns))
+
+        digest = hashlib.sha1("|".join(key).encode()).hexdigest()
+        return os.path.join(get_cache_dir("meshes"), digest + ".npz")
+
+    @staticmethod
+    def _load_cache(cache_path):
+        try:
+            with np.load(cache_path) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # Missing, or truncated by a crashed writer, rebuilt by the caller
+            return None
+
+    @staticmethod
+    def _save_cache(cache_path, data):
+        # Write to a temporary file first, many processes may race on this
+        tmp_path = "%s.%d.tmp.npz" % (cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            np.savez(tmp_path, **data)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
 
     def _load_mtl(self, model_file):
         model_dir, file_name = os.path.split(model_file)
@@ -282,11 +317,11 @@ class ObjMesh:
             texture = self.textures[idx]
 
             if texture:
-                glEnable(GL_TEXTURE_2D)
-                glBindTexture(texture.target, texture.id)
+                set_texturing(True)
+                gl.glBindTexture(texture.target, texture.id)
             else:
-                glDisable(GL_TEXTURE_2D)
+                set_texturing(False)
 
-            vlist.draw(GL_TRIANGLES)
+            vlist.draw(gl.GL_TRIANGLES)
 
-        glDisable(GL_TEXTURE_2D)
+        set_texturing(False)
@@ -1,102 +1,422 @@
+import ctypes
+import hashlib
 import os
+import struct
+from collections import Counter, namedtuple
 from ctypes import POINTER, byref
 
 import numpy as np
-import pyglet
-
-# Solution to https://github.com/maximecb/gym-miniworld/issues/24
-# until pyglet support egl officially
-from pyglet.gl import (
-    GL_COLOR_ATTACHMENT0,
-    GL_COLOR_BUFFER_BIT,
-    GL_DEPTH_ATTACHMENT,
-    GL_DEPTH_BUFFER_BIT,
-    GL_DEPTH_COMPONENT,
-    GL_DEPTH_COMPONENT16,
-    GL_DEPTH_TEST,
-    GL_DRAW_FRAMEBUFFER,
-    GL_FLOAT,
-    GL_FRAMEBUFFER,
-    GL_FRAMEBUFFER_COMPLETE,
-    GL_FRAMEBUFFER_INCOMPLETE_ATTACHMENT,
-    GL_FRAMEBUFFER_INCOMPLETE_DRAW_BUFFER,
-    GL_FRAMEBUFFER_INCOMPLETE_LAYER_TARGETS,
-    GL_FRAMEBUFFER_INCOMPLETE_MISSING_ATTACHMENT,
-    GL_FRAMEBUFFER_INCOMPLETE_MULTISAMPLE,
-    GL_FRAMEBUFFER_INCOMPLETE_READ_BUFFER,
-    GL_FRAMEBUFFER_UNDEFINED,
-    GL_FRAMEBUFFER_UNSUPPORTED,
-    GL_GENERATE_MIPMAP_HINT,
-    GL_LINEAR,
-    GL_LINEAR_MIPMAP_LINEAR,
-    GL_LINES,
-    GL_MULTISAMPLE,
-    GL_NEAREST,
-    GL_NICEST,
-    GL_PACK_ALIGNMENT,
-    GL_QUADS,
-    GL_READ_FRAMEBUFFER,
-    GL_RENDERBUFFER,
-    GL_RGB,
-    GL_RGBA,
-    GL_RGBA32F,
-    GL_TEXTURE_2D,
-    GL_TEXTURE_2D_MULTISAMPLE,
-    GL_TEXTURE_MAG_FILTER,
-    GL_TEXTURE_MIN_FILTER,
-    GL_UNSIGNED_BYTE,
-    GL_UNSIGNED_SHORT,
-    GLint,
-    GLubyte,
-    GLuint,
-    GLushort,
-    gl_info,
-    glBegin,
-    glBindFramebuffer,
-    glBindRenderbuffer,
-    glBindTexture,
-    glBlitFramebuffer,
-    glCheckFramebufferStatus,
-    glColor3f,
-    glEnable,
-    glEnd,
-    glFramebufferRenderbuffer,
-    glFramebufferTexture2D,
-    glGenerateMipmap,
-    glGenFramebuffers,
-    glGenRenderbuffers,
-    glGenTextures,
-    glGetIntegerv,
-    glHint,
-    glNormal3f,
-    glPixelStorei,
-    glReadPixels,
-    glRenderbufferStorage,
-    glRenderbufferStorageMultisample,
-    glTexImage2D,
-    glTexImage2DMultisample,
-    glTexParameteri,
-    glVertex3f,
-    glViewport,
+from pyglet.extlibs import png
+
+from . import gl
+from .utils import get_cache_dir, get_file_path, get_subdir_path
+
+# OpenGL texture object
+GLTexture = namedtuple("GLTexture", ["id", "target", "width", "height"])
+
+# Multisampled color buffer formats: OpenGL enum name, bytes per sample
+COLOR_FORMATS = {
+    "rgba32f": ("GL_RGBA32F", 16),
+    "rgba8": ("GL_RGBA8", 4),
+}
+
+# Render quality profiles, chosen when creating an environment
+# obs_samples/vis_samples -- samples of the observation and human frame buffers
+# color_format            -- format of the multisampled color buffers
+RenderProfile = namedtuple("RenderProfile", ["obs_samples", "vis_samples", "color_format"])
+RENDER_PROFILES = {
+    "high": RenderProfile(8, 16, "rgba32f"),
+    "medium": RenderProfile(4, 4, "rgba8"),
+    "low": RenderProfile(1, 1, "rgba8"),
+}
+
+# Preprocessing of the resolved frames, done on the GPU before reading them
+# grey       -- convert to a single greyscale channel
+# downsample -- integer factor, each output pixel averages a block of pixels
+# half_float -- read float16 values in [0, 1] rather than uint8 values
+Preprocess = namedtuple(
+    "Preprocess", ["grey", "downsample", "half_float"], defaults=[False, 1, False]
 )
 
-from .utils import get_file_path
+# Names of the frame buffer error enums
+FB_ERROR_ENUMS = [
+    "GL_FRAMEBUFFER_UNDEFINED",
+    "GL_FRAMEBUFFER_INCOMPLETE_ATTACHMENT",
+    "GL_FRAMEBUFFER_INCOMPLETE_MISSING_ATTACHMENT",
+    "GL_FRAMEBUFFER_INCOMPLETE_DRAW_BUFFER",
+    "GL_FRAMEBUFFER_INCOMPLETE_READ_BUFFER",
+    "GL_FRAMEBUFFER_UNSUPPORTED",
+    "GL_FRAMEBUFFER_INCOMPLETE_MULTISAMPLE",
+    "GL_FRAMEBUFFER_INCOMPLETE_LAYER_TARGETS",
+]
+
+
+# Kinds of OpenGL objects tracked by GLResources, with the names of the
+# functions creating and deleting them
+GL_OBJECT_KINDS = {
+    "framebuffers": ("glGenFramebuffers", "glDeleteFramebuffers"),
+    "renderbuffers": ("glGenRenderbuffers", "glDeleteRenderbuffers"),
+    "textures": ("glGenTextures", "glDeleteTextures"),
+    "queries": ("glGenQueries", "glDeleteQueries"),
+    "lists": ("glGenLists", "glDeleteLists"),
+    "programs": ("glCreateProgram", "glDeleteProgram"),
+}
+
+# Shaders of the programmable pipeline. They use the compatibility profile
+# inputs, so that rooms and entities are drawn the same way as with the
+# fixed pipeline, but lighting and texturing come from uniforms, which can
+# change on every frame without recompiling the static display list.
+LIT_VERTEX_SHADER = """
+#version 120
+
+varying vec3 normal;
+varying vec3 eye_pos;
+varying vec4 color;
+
+void main()
+{
+    // Same transform as the fixed pipeline, for identical depth values
+    gl_Position = ftransform();
+    normal = gl_NormalMatrix * gl_Normal;
+    eye_pos = vec3(gl_ModelViewMatrix * gl_Vertex);
+    color = gl_Color;
+    gl_TexCoord[0] = gl_MultiTexCoord0;
+}
+"""
+
+LIT_FRAGMENT_SHADER = """
+#version 120
+
+// Default global ambient light of the fixed pipeline
+const vec3 scene_ambient = vec3(0.2);
 
-if os.environ.get("PYOPENGL_PLATFORM", None) == "egl":
-    pyglet.options["headless"] = True
+// Light position in eye space, w is 0 for a directional light
+uniform vec4 light_pos;
+uniform vec3 light_color;
+uniform vec3 light_ambient;
 
+uniform bool use_texture;
+uniform sampler2D tex;
 
-# Mapping of frame buffer error enums to strings
-FB_ERROR_ENUMS = {
-    GL_FRAMEBUFFER_UNDEFINED: "GL_FRAMEBUFFER_UNDEFINED",
-    GL_FRAMEBUFFER_INCOMPLETE_ATTACHMENT: "GL_FRAMEBUFFER_INCOMPLETE_ATTACHMENT",
-    GL_FRAMEBUFFER_INCOMPLETE_MISSING_ATTACHMENT: "GL_FRAMEBUFFER_INCOMPLETE_MISSING_ATTACHMENT",
-    GL_FRAMEBUFFER_INCOMPLETE_DRAW_BUFFER: "GL_FRAMEBUFFER_INCOMPLETE_DRAW_BUFFER",
-    GL_FRAMEBUFFER_INCOMPLETE_READ_BUFFER: "GL_FRAMEBUFFER_INCOMPLETE_READ_BUFFER",
-    GL_FRAMEBUFFER_UNSUPPORTED: "GL_FRAMEBUFFER_UNSUPPORTED",
-    GL_FRAMEBUFFER_INCOMPLETE_MULTISAMPLE: "GL_FRAMEBUFFER_INCOMPLETE_MULTISAMPLE",
-    GL_FRAMEBUFFER_INCOMPLETE_LAYER_TARGETS: "GL_FRAMEBUFFER_INCOMPLETE_LAYER_TARGETS",
+varying vec3 normal;
+varying vec3 eye_pos;
+varying vec4 color;
+
+void main()
+{
+    vec3 light_dir = light_pos.w == 0.0 ? light_pos.xyz : light_pos.xyz - eye_pos;
+    float diffuse = max(dot(normal, normalize(light_dir)), 0.0);
+
+    // Colors act as both the ambient and diffuse material colors
+    vec3 rgb = color.rgb * (scene_ambient + light_ambient + diffuse * light_color);
+    gl_FragColor = vec4(clamp(rgb, 0.0, 1.0), color.a);
+
+    if (use_texture)
+        gl_FragColor *= texture2D(tex, gl_TexCoord[0].st);
 }
+"""
+
+
+class GLResources:
+    """
+    Registry of the OpenGL objects created for an environment
+    Objects are released together when the environment is closed, which
+    must happen while the context that created them is current. The
+    number of live objects of each kind is also counted for the whole
+    process, to detect leaks.
+    """
+
+    # Live objects of each kind, over all the registries of the process
+    live = Counter()
+
+    def __init__(self):
+        self.objects = {kind: set() for kind in GL_OBJECT_KINDS}
+
+    def gen(self, kind, count=1):
+        """
+        Create count objects of the given kind, returns their ids
+        """
+
+        gen_name, _ = GL_OBJECT_KINDS[kind]
+
+        if kind == "lists":
+            # Display lists are allocated as a range of consecutive ids
+            base = getattr(gl, gen_name)(count)
+            assert base != 0, "failed to allocate display lists"
+            ids = list(range(base, base + count))
+        elif kind == "programs":
+            ids = [getattr(gl, gen_name)() for _ in range(count)]
+        else:
+            id_array = (gl.GLuint * count)()
+            getattr(gl, gen_name)(count, id_array)
+            ids = list(id_array)
+
+        self.objects[kind].update(ids)
+        GLResources.live[kind] += count
+
+        return ids
+
+    def delete(self, kind, ids):
+        """
+        Delete objects of the given kind created by this registry
+        """
+
+        ids = [i for i in ids if i in self.objects[kind]]
+        if len(ids) == 0:
+            return
+
+        _, delete_name = GL_OBJECT_KINDS[kind]
+
+        if kind == "lists":
+            for list_id in ids:
+                getattr(gl, delete_name)(list_id, 1)
+        elif kind == "programs":
+            for program_id in ids:
+                getattr(gl, delete_name)(program_id)
+        else:
+            getattr(gl, delete_name)(len(ids), (gl.GLuint * len(ids))(*ids))
+
+        self.objects[kind].difference_update(ids)
+        GLResources.live[kind] -= len(ids)
+
+    def release(self):
+        """
+        Delete all the objects of the registry
+        """
+
+        for kind in GL_OBJECT_KINDS:
+            self.delete(kind, list(self.objects[kind]))
+
+    def counts(self):
+        """
+        Number of live objects of each kind in the registry
+        """
+
+        return {kind: len(ids) for kind, ids in self.objects.items()}
+
+
+# Shaders of the preprocessing pass, drawn as a quad covering the output
+PREPROCESS_VERTEX_SHADER = """
+#version 120
+
+void main()
+{
+    gl_Position = gl_Vertex;
+}
+"""
+
+PREPROCESS_FRAGMENT_SHADER = """
+#version 120
+
+uniform sampler2D src;
+// Size of a source pixel in texture coordinates
+uniform vec2 texel;
+uniform int factor;
+uniform bool grey;
+
+void main()
+{
+    // Average the block of source pixels covered by this output pixel
+    vec2 corner = floor(gl_FragCoord.xy) * float(factor);
+    vec3 rgb = vec3(0.0);
+    for (int i = 0; i < factor; i++)
+        for (int j = 0; j < factor; j++)
+            rgb += texture2D(src, (corner + vec2(i, j) + 0.5) * texel).rgb;
+    rgb /= float(factor * factor);
+
+    // Same weights as GreyscaleWrapper
+    if (grey)
+        rgb = vec3(dot(rgb, vec3(0.30, 0.59, 0.11)));
+
+    gl_FragColor = vec4(rgb, 1.0);
+}
+"""
+
+
+class ShaderProgram:
+    """
+    Linked GLSL program, with cached uniform locations
+    """
+
+    # Program of the environment being rendered, None with the fixed pipeline
+    current = None
+
+    def __init__(self, vertex_src, fragment_src, resources):
+        self.resources = resources
+        self.id = resources.gen("programs")[0]
+        self.locations = {}
+
+        shaders = [
+            self._compile(gl.GL_VERTEX_SHADER, vertex_src),
+            self._compile(gl.GL_FRAGMENT_SHADER, fragment_src),
+        ]
+        for shader in shaders:
+            gl.glAttachShader(self.id, shader)
+        gl.glLinkProgram(self.id)
+
+        # The shaders are not needed once the program is linked
+        for shader in shaders:
+            gl.glDetachShader(self.id, shader)
+            gl.glDeleteShader(shader)
+
+        status = gl.GLint(0)
+        gl.glGetProgramiv(self.id, gl.GL_LINK_STATUS, byref(status))
+        assert status.value, "failed to link shader program: %s" % self._log(
+            gl.glGetProgramiv, gl.glGetProgramInfoLog, self.id
+        )
+
+    @classmethod
+    def _compile(cls, shader_type, source):
+        shader = gl.glCreateShader(shader_type)
+        src = ctypes.create_string_buffer(source.encode())
+        src_ptrs = (POINTER(gl.GLchar) * 1)(ctypes.cast(src, POINTER(gl.GLchar)))
+        gl.glShaderSource(shader, 1, src_ptrs, None)
+        gl.glCompileShader(shader)
+
+        status = gl.GLint(0)
+        gl.glGetShaderiv(shader, gl.GL_COMPILE_STATUS, byref(status))
+        assert status.value, "failed to compile shader: %s" % cls._log(
+            gl.glGetShaderiv, gl.glGetShaderInfoLog, shader
+        )
+
+        return shader
+
+    @staticmethod
+    def _log(get_iv, get_log, obj_id):
+        length = gl.GLint(0)
+        get_iv(obj_id, gl.GL_INFO_LOG_LENGTH, byref(length))
+        log = ctypes.create_string_buffer(max(length.value, 1))
+        get_log(obj_id, length, None, ctypes.cast(log, POINTER(gl.GLchar)))
+        return log.value.decode(errors="replace")
+
+    def use(self):
+        gl.glUseProgram(self.id)
+
+    def set_uniform(self, name, *values):
+        """
+        Set a uniform of the program, which must be in use
+        Python ints set integer uniforms, other values float uniforms
+        """
+
+        loc = self.locations.get(name)
+        if loc is None:
+            loc = self.locations[name] = gl.glGetUniformLocation(self.id, name.encode())
+
+        suffix = "i" if all(isinstance(v, int) for v in values) else "f"
+        getattr(gl, "glUniform%d%s" % (len(values), suffix))(loc, *values)
+
+
+def set_texturing(enabled):
+    """
+    Enable or disable 2D texturing, with either rendering pipeline
+    """
+
+    if enabled:
+        gl.glEnable(gl.GL_TEXTURE_2D)
+    else:
+        gl.glDisable(gl.GL_TEXTURE_2D)
+
+    if ShaderProgram.current is not None:
+        ShaderProgram.current.set_uniform("use_texture", int(enabled))
+
+
+# Draw call queued in a RenderQueue
+# translucent -- drawn with blending, after the opaque items
+# textured    -- drawn with 2D texturing enabled
+# depth       -- distance to the camera
+# label       -- stencil value written by the item, None to keep the current one
+# opacity     -- alpha value passed to draw
+# draw        -- function drawing the item, called with the opacity
+DrawItem = namedtuple(
+    "DrawItem", ["translucent", "textured", "depth", "label", "opacity", "draw"]
+)
+
+
+class RenderQueue:
+    """
+    Draw calls of a frame, sorted to minimize OpenGL state changes
+    Opaque items are drawn first, grouped by state, then translucent items,
+    so that they blend over everything behind them. Both are drawn from
+    back to front, which keeps the depth ties of the 16-bit depth buffer
+    resolved the same way as when entities were drawn one by one. Items
+    only set their color and transform, the queue sets blending, texturing
+    and stencil labels when they change.
+    """
+
+    def __init__(self):
+        self.items = []
+
+        # State changes of the last flush, for profiling
+        self.stats = Counter()
+
+    def add(self, draw, depth, opacity=1, textured=False, label=None):
+        """
+        Queue a draw call
+        """
+
+        self.items.append(DrawItem(opacity < 1, textured, depth, label, opacity, draw))
+
+    def flush(self):
+        """
+        Issue the queued draw calls, then clear the queue
+        """
+
+        opaque = sorted(
+            (item for item in self.items if not item.translucent),
+            key=lambda item: (item.textured, -item.depth),
+        )
+        translucent = sorted(
+            (item for item in self.items if item.translucent),
+            key=lambda item: -item.depth,
+        )
+
+        stats = Counter(draws=len(self.items))
+        blend = textured = label = None
+
+        for item in opaque + translucent:
+            if item.translucent != blend:
+                blend = item.translucent
+                if blend:
+                    gl.glEnable(gl.GL_BLEND)
+                    # Alpha accumulates coverage, so layers can be composited afterwards
+                    gl.glBlendFuncSeparate(
+                        gl.GL_SRC_ALPHA,
+                        gl.GL_ONE_MINUS_SRC_ALPHA,
+                        gl.GL_ONE,
+                        gl.GL_ONE_MINUS_SRC_ALPHA,
+                    )
+                else:
+                    gl.glDisable(gl.GL_BLEND)
+                stats["blend"] += 1
+
+            if item.textured != textured:
+                textured = item.textured
+                set_texturing(textured)
+                stats["texture"] += 1
+
+            if item.label is not None and item.label != label:
+                label = item.label
+                gl.glStencilFunc(gl.GL_ALWAYS, label, 0xFF)
+                stats["stencil"] += 1
+
+            item.draw(item.opacity)
+
+        if blend:
+            gl.glDisable(gl.GL_BLEND)
+
+        self.items = []
+        self.stats = stats
+
+
+def fb_error_str(res):
+    """
+    Map a frame buffer status enum to its name
+    """
+
+    for name in FB_ERROR_ENUMS:
+        if getattr(gl, name) == res:
+            return name
+    return res
 
 
 class Texture:
@@ -110,6 +430,14 @@ class Texture:
     # Cache of textures
     tex_cache = {}
 
+    # Decoded RGBA pixels, indexed by texture file path
+    pixel_cache = {}
+
+    # Share group of the current context, see utils.context. Texture objects
+    # are uploaded once per share group, and registered in its resources.
+    share_group = None
+    resources = {}
+
     @classmethod
     def get(self, tex_name, rng=None):
         """
@@ -117,7 +445,10 @@ class Texture:
         Also performs domain randomization if multiple versions are available.
         """
 
-        paths = self.tex_paths.get(tex_name, [])
+        if len(self.tex_paths) == 0:
+            self.tex_paths.update(self._scan_textures())
+
+        paths = self.tex_paths.setdefault(tex_name, [])
 
         # Get an inventory of the existing texture files
         if len(paths) == 0:
@@ -140,10 +471,94 @@ class Texture:
             path = paths[0]
 
         if path not in self.tex_cache:
-            self.tex_cache[path] = Texture(Texture.load(path), tex_name)
+            self.tex_cache[path] = Texture(path, tex_name)
 
         return self.tex_cache[path]
 
+    @classmethod
+    def preload(cls):
+        """
+        Load all the packaged textures into the current OpenGL context.
+        Called when the rendering context is created, so that generating
+        the static data of a room never has to touch the disk.
+        """
+
+        if len(cls.tex_paths) == 0:
+            cls.tex_paths.update(cls._scan_textures())
+
+        for tex_name, paths in cls.tex_paths.items():
+            for path in paths:
+                if path not in cls.tex_cache:
+                    cls.tex_cache[path] = Texture(path, tex_name)
+                cls.tex_cache[path].upload()
+
+    @staticmethod
+    def _scan_textures():
+        """
+        Inventory of the packaged texture files, indexed by texture name
+        Versions of a texture are numbered name_1.png to name_9.png
+        """
+
+        tex_dir = get_subdir_path("textures")
+        versions = {}
+
+        for file_name in os.listdir(tex_dir):
+            name, ext = os.path.splitext(file_name)
+            tex_name, _, idx = name.rpartition("_")
+            if ext == ".png" and tex_name and idx.isdigit():
+                versions.setdefault(tex_name, {})[int(idx)] = os.path.join(
+                    tex_dir, file_name
+                )
+
+        tex_paths = {}
+        for tex_name, files in versions.items():
+            paths = []
+            for i in range(1, 10):
+                if i not in files:
+                    break
+                paths.append(files[i])
+            if len(paths) > 0:
+                tex_paths[tex_name] = paths
+
+        return tex_paths
+
+    @classmethod
+    def get_pixels(cls, tex_path):
+        """
+        Get the decoded RGBA pixels of a texture file, bottom row first.
+        Pixels are decoded once and stored in an on-disk cache which is
+        memory-mapped, so that all processes share the same pages.
+        """
+
+        if tex_path in cls.pixel_cache:
+            return cls.pixel_cache[tex_path]
+
+        stat = os.stat(tex_path)
+        key = "%s:%d:%d" % (os.path.realpath(tex_path), stat.st_size, stat.st_mtime_ns)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        cache_path = os.path.join(get_cache_dir("textures"), digest + ".npy")
+
+        try:
+            pixels = np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError, EOFError):
+            # Decode with pyglet's pure-Python PNG reader, which needs no context
+            width, height, rows, _ = png.Reader(filename=tex_path).asRGBA8()
+            pixels = np.stack([np.frombuffer(row, dtype=np.uint8) for row in rows])
+            pixels = np.flip(pixels.reshape(height, width, 4), axis=0)
+
+            # Write to a temporary file first, many processes may race on this
+            tmp_path = "%s.%d.tmp.npy" % (cache_path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                np.save(tmp_path, pixels)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass
+
+        cls.pixel_cache[tex_path] = pixels
+
+        return pixels
+
     @classmethod
     def load(cls, tex_path):
         """
@@ -153,45 +568,90 @@ class Texture:
 
         # print('Loading texture "%s"' % tex_path)
 
-        img = pyglet.image.load(tex_path)
-        tex = img.get_texture()
-        glEnable(tex.target)
-        glBindTexture(tex.target, tex.id)
+        pixels = np.ascontiguousarray(cls.get_pixels(tex_path))
+        height, width, _ = pixels.shape
 
-        glTexImage2D(
-            GL_TEXTURE_2D,
+        # Plain texture object, independent of the context backend
+        resources = cls.resources.setdefault(cls.share_group, GLResources())
+        tex_id = resources.gen("textures")[0]
+        tex = GLTexture(tex_id, gl.GL_TEXTURE_2D, width, height)
+        gl.glEnable(tex.target)
+        gl.glBindTexture(tex.target, tex.id)
+
+        gl.glTexImage2D(
+            gl.GL_TEXTURE_2D,
             0,
-            GL_RGB,
-            img.width,
-            img.height,
+            gl.GL_RGB,
+            width,
+            height,
             0,
-            GL_RGBA,
-            GL_UNSIGNED_BYTE,
-            img.get_image_data().get_data("RGBA", img.width * 4),
+            gl.GL_RGBA,
+            gl.GL_UNSIGNED_BYTE,
+            pixels.ctypes.data_as(POINTER(gl.GLubyte)),
         )
 
         # Generate mipmaps (multiple levels of detail)
-        glHint(GL_GENERATE_MIPMAP_HINT, GL_NICEST)
-        glGenerateMipmap(GL_TEXTURE_2D)
+        gl.glHint(gl.GL_GENERATE_MIPMAP_HINT, gl.GL_NICEST)
+        gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
 
         # Trilinear texture filtering
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR)
 
         # Unbind the texture
-        glBindTexture(GL_TEXTURE_2D, 0)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
 
         return tex
 
-    def __init__(self, tex, tex_name):
-        assert not isinstance(tex, str)
-        self.tex = tex
-        self.width = self.tex.width
-        self.height = self.tex.height
+    def __init__(self, tex_path, tex_name):
+        # The texture is only decoded and uploaded to OpenGL when first bound,
+        # the size is read from the PNG header
+        with open(tex_path, "rb") as f:
+            self.width, self.height = struct.unpack(">II", f.read(24)[16:24])
+
+        # Texture object of each share group
+        self.texs = {}
+        self.path = tex_path
         self.name = tex_name
 
+    @property
+    def tex(self):
+        return self.texs.get(Texture.share_group)
+
+    def upload(self):
+        if Texture.share_group not in self.texs:
+            self.texs[Texture.share_group] = Texture.load(self.path)
+
+    @classmethod
+    def release(cls, share_group):
+        """
+        Free the texture objects of a share group, before its context is
+        destroyed. They are uploaded again if the share group is used later.
+        """
+
+        resources = cls.resources.pop(share_group, None)
+        if resources is not None:
+            resources.release()
+
+        for tex in cls.tex_cache.values():
+            tex.texs.pop(share_group, None)
+
+    @classmethod
+    def memory_bytes(cls):
+        """
+        Estimate the memory used by the uploaded textures, in bytes
+        Textures are shared by all environments of a process
+        """
+
+        # RGBA texels, plus a third for the mipmaps, in each share group
+        return sum(
+            tex.width * tex.height * 4 * 4 // 3 * len(tex.texs)
+            for tex in cls.tex_cache.values()
+        )
+
     def bind(self):
-        glBindTexture(self.tex.target, self.tex.id)
+        self.upload()
+        gl.glBindTexture(self.tex.target, self.tex.id)
 
 
 class FrameBuffer:
@@ -199,132 +659,270 @@ class FrameBuffer:
     Manage frame buffers for rendering
     """
 
-    def __init__(self, width, height, num_samples=1):
-        """Create the frame buffer objects"""
+    def __init__(
+        self,
+        width,
+        height,
+        num_samples=1,
+        stencil=False,
+        color_format="rgba32f",
+        resolve_depth=True,
+        resources=None,
+        preprocess=None,
+    ):
+        """
+        Create the frame buffer objects
+        With stencil, the depth buffer is packed with an 8-bit stencil
+        buffer, which can be used to label the rendered objects
+        color_format is the format of the multisampled color buffer,
+        "rgba32f" or "rgba8". Without resolve_depth, only the colors are
+        resolved, so the depth map can only be read without multisampling,
+        when rendering directly into the final frame buffer.
+        The OpenGL objects are created in the resources registry, see
+        GLResources, and freed with delete().
+        With preprocess, a Preprocess tuple, the colors returned by
+        resolve() go through a final pass on the GPU, so that only the
+        preprocessed pixels are read back.
+        """
 
         assert num_samples > 0
         assert num_samples <= 16
+        assert color_format in COLOR_FORMATS, color_format
 
         self.width = width
         self.height = height
-
-        # Create a frame buffer (rendering target)
-        self.multi_fbo = GLuint(0)
-        glGenFramebuffers(1, byref(self.multi_fbo))
-        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
-
-        # The try block here is because some OpenGL drivers
-        # (Intel GPU drivers on MacBooks in particular) do not
-        # support multisampling on frame buffer objects
-        try:
-            # Ensure that the correct extension is supported
-            assert gl_info.have_extension("GL_EXT_framebuffer_multisample")
-
-            # Get the maximum number of samples supported
-            MAX_SAMPLES_EXT = 0x8D57
-            max_samples = GLint()
-            glGetIntegerv(MAX_SAMPLES_EXT, max_samples)
-            max_samples = max_samples.value
-
-            if num_samples > max_samples:
-                print(f"Falling back to num_samples={max_samples}")
-                num_samples = max_samples
-
-            # Create a multisampled texture to render into
-            fbTex = GLuint(0)
-            glGenTextures(1, byref(fbTex))
-            glBindTexture(GL_TEXTURE_2D_MULTISAMPLE, fbTex)
-            glTexImage2DMultisample(
-                GL_TEXTURE_2D_MULTISAMPLE, num_samples, GL_RGBA32F, width, height, True
-            )
-            glFramebufferTexture2D(
-                GL_FRAMEBUFFER,
-                GL_COLOR_ATTACHMENT0,
-                GL_TEXTURE_2D_MULTISAMPLE,
-                fbTex,
-                0,
-            )
-
-            # Attach a multisampled depth buffer to the FBO
-            depth_rb = GLuint(0)
-            glGenRenderbuffers(1, byref(depth_rb))
-            glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
-            glRenderbufferStorageMultisample(
-                GL_RENDERBUFFER, num_samples, GL_DEPTH_COMPONENT16, width, height
-            )
-            glFramebufferRenderbuffer(
-                GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
-            )
-
-            # Check that the frame buffer creation succeeded
-            res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
-            assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
-
-        except Exception:
-            print("Falling back to non-multisampled frame buffer")
-
-            # Create a plain texture to render into
-            fbTex = GLuint(0)
-            glGenTextures(1, byref(fbTex))
-            glBindTexture(GL_TEXTURE_2D, fbTex)
-            glTexImage2D(
-                GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_FLOAT, None
-            )
-            glFramebufferTexture2D(
-                GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, fbTex, 0
-            )
-
-            # Attach depth buffer to FBO
-            depth_rb = GLuint(0)
-            glGenRenderbuffers(1, byref(depth_rb))
-            glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
-            glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT16, width, height)
-            glFramebufferRenderbuffer(
-                GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
-            )
-
-        # Sanity check
-        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
-        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+        self.stencil = stencil
+        self.color_format = color_format
+        self.resolve_depth = resolve_depth or stencil
+        self.resources = resources if resources is not None else GLResources()
+        # Kinds and ids of the objects created for this frame buffer
+        self.objects = []
+        color_format = getattr(gl, COLOR_FORMATS[color_format][0])
+
+        # Depth buffer format, and the attachment it is bound to
+        if stencil:
+            depth_format = gl.GL_DEPTH24_STENCIL8
+            depth_attachment = gl.GL_DEPTH_STENCIL_ATTACHMENT
+        else:
+            depth_format = gl.GL_DEPTH_COMPONENT16
+            depth_attachment = gl.GL_DEPTH_ATTACHMENT
+
+        # Rendering directly into the final frame buffer when not multisampling
+        self.multi_fbo = None
+
+        if num_samples > 1:
+            # Create a frame buffer (rendering target)
+            self.multi_fbo = self._gen("framebuffers")
+            gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.multi_fbo)
+
+            # The try block here is because some OpenGL drivers
+            # (Intel GPU drivers on MacBooks in particular) do not
+            # support multisampling on frame buffer objects
+            try:
+                # Ensure that the correct extension is supported
+                assert gl.gl_info.have_extension("GL_EXT_framebuffer_multisample")
+
+                # Get the maximum number of samples supported
+                MAX_SAMPLES_EXT = 0x8D57
+                max_samples = gl.GLint()
+                gl.glGetIntegerv(MAX_SAMPLES_EXT, max_samples)
+                max_samples = max_samples.value
+
+                if num_samples > max_samples:
+                    print(f"Falling back to num_samples={max_samples}")
+                    num_samples = max_samples
+
+                # Create a multisampled texture to render into
+                fbTex = self._gen("textures")
+                gl.glBindTexture(gl.GL_TEXTURE_2D_MULTISAMPLE, fbTex)
+                gl.glTexImage2DMultisample(
+                    gl.GL_TEXTURE_2D_MULTISAMPLE, num_samples, color_format, width, height, True
+                )
+                gl.glFramebufferTexture2D(
+                    gl.GL_FRAMEBUFFER,
+                    gl.GL_COLOR_ATTACHMENT0,
+                    gl.GL_TEXTURE_2D_MULTISAMPLE,
+                    fbTex,
+                    0,
+                )
+
+                # Attach a multisampled depth buffer to the FBO
+                depth_rb = self._gen("renderbuffers")
+                gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, depth_rb)
+                gl.glRenderbufferStorageMultisample(
+                    gl.GL_RENDERBUFFER, num_samples, depth_format, width, height
+                )
+                gl.glFramebufferRenderbuffer(
+                    gl.GL_FRAMEBUFFER, depth_attachment, gl.GL_RENDERBUFFER, depth_rb
+                )
+
+                # Check that the frame buffer creation succeeded
+                res = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+                assert res == gl.GL_FRAMEBUFFER_COMPLETE, fb_error_str(res)
+
+            except Exception:
+                print("Falling back to non-multisampled frame buffer")
+                num_samples = 1
+                self.color_format = "rgba8"
+
+                # Create a plain texture to render into
+                fbTex = self._gen("textures")
+                gl.glBindTexture(gl.GL_TEXTURE_2D, fbTex)
+                gl.glTexImage2D(
+                    gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, width, height, 0, gl.GL_RGBA, gl.GL_FLOAT, None
+                )
+                gl.glFramebufferTexture2D(
+                    gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D, fbTex, 0
+                )
+
+                # Attach depth buffer to FBO
+                depth_rb = self._gen("renderbuffers")
+                gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, depth_rb)
+                gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, depth_format, width, height)
+                gl.glFramebufferRenderbuffer(
+                    gl.GL_FRAMEBUFFER, depth_attachment, gl.GL_RENDERBUFFER, depth_rb
+                )
+
+            # Sanity check
+            res = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+            assert res == gl.GL_FRAMEBUFFER_COMPLETE, fb_error_str(res)
 
         # Create the frame buffer used to resolve the final render
-        self.final_fbo = GLuint(0)
-        glGenFramebuffers(1, byref(self.final_fbo))
-        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
+        self.final_fbo = self._gen("framebuffers")
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.final_fbo)
 
         # Create the texture used to resolve the final render
-        fbTex = GLuint(0)
-        glGenTextures(1, byref(fbTex))
-        glBindTexture(GL_TEXTURE_2D, fbTex)
-        glTexImage2D(
-            GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_FLOAT, None
+        # Sampled pixel by pixel by the preprocessing pass
+        fbTex = self._gen("textures")
+        gl.glBindTexture(gl.GL_TEXTURE_2D, fbTex)
+        gl.glTexImage2D(
+            gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, width, height, 0, gl.GL_RGBA, gl.GL_FLOAT, None
         )
-        glFramebufferTexture2D(
-            GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, fbTex, 0
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+        self.final_tex = fbTex
+        gl.glFramebufferTexture2D(
+            gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D, fbTex, 0
         )
 
         # Create a depth buffer for the final frame buffer
-        depth_rb = GLuint(0)
-        glGenRenderbuffers(1, byref(depth_rb))
-        glBindRenderbuffer(GL_RENDERBUFFER, depth_rb)
-        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT16, width, height)
-        glFramebufferRenderbuffer(
-            GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depth_rb
+        depth_rb = self._gen("renderbuffers")
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, depth_rb)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, depth_format, width, height)
+        gl.glFramebufferRenderbuffer(
+            gl.GL_FRAMEBUFFER, depth_attachment, gl.GL_RENDERBUFFER, depth_rb
         )
 
         # Sanity check
-        res = glCheckFramebufferStatus(GL_FRAMEBUFFER)
-        assert res == GL_FRAMEBUFFER_COMPLETE, FB_ERROR_ENUMS.get(res, res)
+        res = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+        assert res == gl.GL_FRAMEBUFFER_COMPLETE, fb_error_str(res)
 
         # Enable depth testing
-        glEnable(GL_DEPTH_TEST)
+        gl.glEnable(gl.GL_DEPTH_TEST)
 
         # Unbind the frame buffer
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+        # Without multisampling, the final frame buffer is rendered into
+        self.separate_fbos = self.multi_fbo is not None
+        if not self.separate_fbos:
+            self.multi_fbo = self.final_fbo
+        self.num_samples = num_samples
 
         # Array to render the image into (for observation rendering)
         # The array is stored in column-major order
         self.img_array = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+        self.rgba_array = None
+
+        self.preprocess = None
+        if preprocess is not None and preprocess != Preprocess():
+            self._init_preprocess(preprocess)
+
+    def _gen(self, kind):
+        obj_id = self.resources.gen(kind)[0]
+        self.objects.append((kind, obj_id))
+        return obj_id
+
+    def _init_preprocess(self, preprocess):
+        """
+        Create the output buffer and the program of the preprocessing pass
+        """
+
+        grey, factor, half_float = preprocess
+        assert factor >= 1
+        assert self.width % factor == 0 and self.height % factor == 0, (
+            "frame buffer size must be a multiple of the downsampling factor"
+        )
+
+        self.preprocess = preprocess
+        self.pre_width = self.width // factor
+        self.pre_height = self.height // factor
+
+        # Output buffer, with a single channel when converting to greyscale
+        if grey:
+            tex_format = gl.GL_R16F if half_float else gl.GL_R8
+        else:
+            tex_format = gl.GL_RGBA16F if half_float else gl.GL_RGBA8
+
+        self.pre_fbo = self._gen("framebuffers")
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.pre_fbo)
+
+        pre_tex = self._gen("textures")
+        gl.glBindTexture(gl.GL_TEXTURE_2D, pre_tex)
+        gl.glTexImage2D(
+            gl.GL_TEXTURE_2D,
+            0,
+            tex_format,
+            self.pre_width,
+            self.pre_height,
+            0,
+            gl.GL_RGBA,
+            gl.GL_FLOAT,
+            None,
+        )
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glFramebufferTexture2D(
+            gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D, pre_tex, 0
+        )
+
+        res = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+        assert res == gl.GL_FRAMEBUFFER_COMPLETE, fb_error_str(res)
+
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+        self.pre_program = ShaderProgram(
+            PREPROCESS_VERTEX_SHADER, PREPROCESS_FRAGMENT_SHADER, self.resources
+        )
+        self.objects.append(("programs", self.pre_program.id))
+
+        # The uniforms are kept by the program between passes
+        self.pre_program.use()
+        self.pre_program.set_uniform("src", 0)
+        self.pre_program.set_uniform("texel", 1 / self.width, 1 / self.height)
+        self.pre_program.set_uniform("factor", factor)
+        self.pre_program.set_uniform("grey", int(grey))
+        self._restore_program()
+
+        self.pre_array = np.zeros(
+            shape=(self.pre_height, self.pre_width, 1 if grey else 3),
+            dtype=np.float16 if half_float else np.uint8,
+        )
+
+    @staticmethod
+    def _restore_program():
+        program = ShaderProgram.current
+        gl.glUseProgram(program.id if program is not None else 0)
+
+    def delete(self):
+        """
+        Delete the OpenGL objects of the frame buffer
+        Its context must be current
+        """
+
+        for kind, obj_id in self.objects:
+            self.resources.delete(kind, [obj_id])
+        self.objects = []
 
     def bind(self):
         """
@@ -332,93 +930,159 @@ class FrameBuffer:
         """
 
         # Bind the multisampled frame buffer
-        glEnable(GL_MULTISAMPLE)
-        glBindFramebuffer(GL_FRAMEBUFFER, self.multi_fbo)
-        glViewport(0, 0, self.width, self.height)
+        gl.glEnable(gl.GL_MULTISAMPLE)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.multi_fbo)
+        gl.glViewport(0, 0, self.width, self.height)
 
-    def resolve(self):
+    def resolve(self, alpha=False, raw=False):
         """
         Produce a numpy image array from the rendered image
+        With alpha, the image has a fourth channel holding the alpha values
+        The image is preprocessed if the frame buffer has a preprocessing
+        pass, unless alpha or raw is set
         """
 
-        # Resolve the multisampled frame buffer into the final frame buffer
-        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.multi_fbo)
-        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.final_fbo)
-        glBlitFramebuffer(
-            0,
-            0,
-            self.width,
-            self.height,
-            0,
-            0,
-            self.width,
-            self.height,
-            GL_COLOR_BUFFER_BIT,
-            GL_LINEAR,
-        )
+        if self.separate_fbos:
+            # Resolve the multisampled frame buffer into the final frame buffer
+            gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.multi_fbo)
+            gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self.final_fbo)
+            gl.glBlitFramebuffer(
+                0,
+                0,
+                self.width,
+                self.height,
+                0,
+                0,
+                self.width,
+                self.height,
+                gl.GL_COLOR_BUFFER_BIT,
+                gl.GL_LINEAR,
+            )
 
-        # Resolve the depth component as well
-        glBlitFramebuffer(
-            0,
-            0,
-            self.width,
-            self.height,
-            0,
-            0,
-            self.width,
-            self.height,
-            GL_DEPTH_BUFFER_BIT,
-            GL_NEAREST,
-        )
+            # Resolve the depth (and stencil) components as well
+            depth_bits = gl.GL_DEPTH_BUFFER_BIT
+            if self.stencil:
+                depth_bits |= gl.GL_STENCIL_BUFFER_BIT
+            if self.resolve_depth:
+                gl.glBlitFramebuffer(
+                    0,
+                    0,
+                    self.width,
+                    self.height,
+                    0,
+                    0,
+                    self.width,
+                    self.height,
+                    depth_bits,
+                    gl.GL_NEAREST,
+                )
+
+        if self.preprocess is not None and not (alpha or raw):
+            return self._resolve_preprocessed()
 
         # Copy the frame buffer contents into a numpy array
         # Note: glReadPixels reads starting from the lower left corner
-        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
-        glPixelStorei(GL_PACK_ALIGNMENT, 1)
-        glReadPixels(
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.final_fbo)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        if alpha:
+            if self.rgba_array is None:
+                self.rgba_array = np.zeros(
+                    shape=(self.height, self.width, 4), dtype=np.uint8
+                )
+            img_array, img_format = self.rgba_array, gl.GL_RGBA
+        else:
+            img_array, img_format = self.img_array, gl.GL_RGB
+
+        gl.glReadPixels(
             0,
             0,
             self.width,
             self.height,
-            GL_RGB,
-            GL_UNSIGNED_BYTE,
-            self.img_array.ctypes.data_as(POINTER(GLubyte)),
+            img_format,
+            gl.GL_UNSIGNED_BYTE,
+            img_array.ctypes.data_as(POINTER(gl.GLubyte)),
         )
 
         # Unbind the frame buffer
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 
         # Flip the image because OpenGL maps (0,0) to the lower-left corner
         # Note: this is necessary for gym.wrappers.Monitor to record videos
         # properly, otherwise they are vertically inverted.
         # Note: ascontiguousarray operates in constant time because it
         # does not copy the data
-        img = np.ascontiguousarray(np.flip(self.img_array, axis=0))
+        img = np.ascontiguousarray(np.flip(img_array, axis=0))
 
         return img
 
+    def _resolve_preprocessed(self):
+        """
+        Render the resolved image through the preprocessing pass, and read
+        back the result
+        """
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.pre_fbo)
+        gl.glViewport(0, 0, self.pre_width, self.pre_height)
+        gl.glDisable(gl.GL_DEPTH_TEST)
+
+        self.pre_program.use()
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.final_tex)
+
+        # Quad covering the whole output
+        gl.glBegin(gl.GL_QUADS)
+        gl.glVertex2f(-1, -1)
+        gl.glVertex2f(1, -1)
+        gl.glVertex2f(1, 1)
+        gl.glVertex2f(-1, 1)
+        gl.glEnd()
+
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        self._restore_program()
+        gl.glEnable(gl.GL_DEPTH_TEST)
+
+        grey, _, half_float = self.preprocess
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(
+            0,
+            0,
+            self.pre_width,
+            self.pre_height,
+            gl.GL_RED if grey else gl.GL_RGB,
+            gl.GL_HALF_FLOAT if half_float else gl.GL_UNSIGNED_BYTE,
+            self.pre_array.ctypes.data_as(POINTER(gl.GLubyte)),
+        )
+
+        # Unbind the frame buffer
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+        return np.ascontiguousarray(np.flip(self.pre_array, axis=0))
+
     def get_depth_map(self, z_near=0.04, z_far=1.0):
         """
         Read the depth buffer into a depth map
         The values returned are real-world z-distance from the observer
         """
 
+        # Without multisampling, the depth is rendered into the final frame
+        # buffer and there is nothing to resolve
+        assert self.resolve_depth or not self.separate_fbos, "frame buffer does not resolve its depth"
+
         depth_map = np.zeros(shape=(self.height, self.width, 1), dtype=np.uint16)
 
-        glBindFramebuffer(GL_FRAMEBUFFER, self.final_fbo)
-        glPixelStorei(GL_PACK_ALIGNMENT, 1)
-        glReadPixels(
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.final_fbo)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(
             0,
             0,
             self.width,
             self.height,
-            GL_DEPTH_COMPONENT,
-            GL_UNSIGNED_SHORT,
-            depth_map.ctypes.data_as(POINTER(GLushort)),
+            gl.GL_DEPTH_COMPONENT,
+            gl.GL_UNSIGNED_SHORT,
+            depth_map.ctypes.data_as(POINTER(gl.GLushort)),
         )
 
         # Unbind the frame buffer
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 
         # Flip the depth map vertically to map OpenAI gym conventions
         depth_map = np.flip(depth_map, axis=0)
@@ -435,26 +1099,81 @@ class FrameBuffer:
         return depth_map
 
 
+    def get_stencil_map(self):
+        """
+        Read the resolved stencil buffer into an array of labels
+        """
+
+        assert self.stencil, "frame buffer has no stencil buffer"
+
+        stencil_map = np.zeros(shape=(self.height, self.width), dtype=np.uint8)
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.final_fbo)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(
+            0,
+            0,
+            self.width,
+            self.height,
+            gl.GL_STENCIL_INDEX,
+            gl.GL_UNSIGNED_BYTE,
+            stencil_map.ctypes.data_as(POINTER(gl.GLubyte)),
+        )
+
+        # Unbind the frame buffer
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+        # Flip the stencil map vertically to map OpenAI gym conventions
+        return np.ascontiguousarray(np.flip(stencil_map, axis=0))
+
+
+    def memory_bytes(self):
+        """
+        Estimate the memory used by the frame buffer, in bytes
+        """
+
+        pixels = self.width * self.height
+        depth_bytes = 4 if self.stencil else 2
+
+        # Final RGBA8 texture and depth buffer
+        gpu = pixels * (4 + depth_bytes)
+        if self.separate_fbos:
+            color_bytes = COLOR_FORMATS[self.color_format][1]
+            gpu += pixels * self.num_samples * (color_bytes + depth_bytes)
+
+        host = self.img_array.nbytes
+        if self.rgba_array is not None:
+            host += self.rgba_array.nbytes
+
+        if self.preprocess is not None:
+            grey, _, half_float = self.preprocess
+            texel_bytes = (1 if grey else 4) * (2 if half_float else 1)
+            gpu += self.pre_width * self.pre_height * texel_bytes
+            host += self.pre_array.nbytes
+
+        return {"gpu": gpu, "host": host}
+
+
 def drawAxes(len=0.1):
     """
     Draw X/Y/Z axes in red/green/blue colors
     """
 
-    glBegin(GL_LINES)
+    gl.glBegin(gl.GL_LINES)
 
-    glColor3f(1, 0, 0)
-    glVertex3f(0, 0, 0)
-    glVertex3f(len, 0, 0)
+    gl.glColor3f(1, 0, 0)
+    gl.glVertex3f(0, 0, 0)
+    gl.glVertex3f(len, 0, 0)
 
-    glColor3f(0, 1, 0)
-    glVertex3f(0, 0, 0)
-    glVertex3f(0, len, 0)
+    gl.glColor3f(0, 1, 0)
+    gl.glVertex3f(0, 0, 0)
+    gl.glVertex3f(0, len, 0)
 
-    glColor3f(0, 0, 1)
-    glVertex3f(0, 0, 0)
-    glVertex3f(0, 0, len)
+    gl.glColor3f(0, 0, 1)
+    gl.glVertex3f(0, 0, 0)
+    gl.glVertex3f(0, 0, len)
 
-    glEnd()
+    gl.glEnd()
 
 
 def drawBox(x_min, x_max, y_min, y_max, z_min, z_max):
@@ -462,42 +1181,42 @@ def drawBox(x_min, x_max, y_min, y_max, z_min, z_max):
     Draw a 3D box
     """
 
-    glBegin(GL_QUADS)
-
-    glNormal3f(0, 0, 1)
-    glVertex3f(x_max, y_max, z_max)
-    glVertex3f(x_min, y_max, z_max)
-    glVertex3f(x_min, y_min, z_max)
-    glVertex3f(x_max, y_min, z_max)
-
-    glNormal3f(0, 0, -1)
-    glVertex3f(x_min, y_max, z_min)
-    glVertex3f(x_max, y_max, z_min)
-    glVertex3f(x_max, y_min, z_min)
-    glVertex3f(x_min, y_min, z_min)
-
-    glNormal3f(-1, 0, 0)
-    glVertex3f(x_min, y_max, z_max)
-    glVertex3f(x_min, y_max, z_min)
-    glVertex3f(x_min, y_min, z_min)
-    glVertex3f(x_min, y_min, z_max)
-
-    glNormal3f(1, 0, 0)
-    glVertex3f(x_max, y_max, z_min)
-    glVertex3f(x_max, y_max, z_max)
-    glVertex3f(x_max, y_min, z_max)
-    glVertex3f(x_max, y_min, z_min)
-
-    glNormal3f(0, 1, 0)
-    glVertex3f(x_max, y_max, z_max)
-    glVertex3f(x_max, y_max, z_min)
-    glVertex3f(x_min, y_max, z_min)
-    glVertex3f(x_min, y_max, z_max)
-
-    glNormal3f(0, -1, 0)
-    glVertex3f(x_max, y_min, z_min)
-    glVertex3f(x_max, y_min, z_max)
-    glVertex3f(x_min, y_min, z_max)
-    glVertex3f(x_min, y_min, z_min)
-
-    glEnd()
+    gl.glBegin(gl.GL_QUADS)
+
+    gl.glNormal3f(0, 0, 1)
+    gl.glVertex3f(x_max, y_max, z_max)
+    gl.glVertex3f(x_min, y_max, z_max)
+    gl.glVertex3f(x_min, y_min, z_max)
+    gl.glVertex3f(x_max, y_min, z_max)
+
+    gl.glNormal3f(0, 0, -1)
+    gl.glVertex3f(x_min, y_max, z_min)
+    gl.glVertex3f(x_max, y_max, z_min)
+    gl.glVertex3f(x_max, y_min, z_min)
+    gl.glVertex3f(x_min, y_min, z_min)
+
+    gl.glNormal3f(-1, 0, 0)
+    gl.glVertex3f(x_min, y_max, z_max)
+    gl.glVertex3f(x_min, y_max, z_min)
+    gl.glVertex3f(x_min, y_min, z_min)
+    gl.glVertex3f(x_min, y_min, z_max)
+
+    gl.glNormal3f(1, 0, 0)
+    gl.glVertex3f(x_max, y_max, z_min)
+    gl.glVertex3f(x_max, y_max, z_max)
+    gl.glVertex3f(x_max, y_min, z_max)
+    gl.glVertex3f(x_max, y_min, z_min)
+
+    gl.glNormal3f(0, 1, 0)
+    gl.glVertex3f(x_max, y_max, z_max)
+    gl.glVertex3f(x_max, y_max, z_min)
+    gl.glVertex3f(x_min, y_max, z_min)
+    gl.glVertex3f(x_min, y_max, z_max)
+
+    gl.glNormal3f(0, -1, 0)
+    gl.glVertex3f(x_max, y_min, z_min)
+    gl.glVertex3f(x_max, y_min, z_max)
+    gl.glVertex3f(x_min, y_min, z_max)
+    gl.glVertex3f(x_min, y_min, z_min)
+
+    gl.glEnd()
@@ -110,6 +110,47 @@ class DomainParams:
         for name in param_names:
             setattr(target_obj, name, self.sample(rng, name))
 
+    def sample_batch(self, rng, param_names, n):
+        """
+        Sample a list of parameters for n environments at once
+        Returns a structured array of shape (n,) with one field per name
+        rng is either one generator shared by all rows, or a list of n
+        generators, one independent stream per row. Row i then only depends
+        on rng[i], and matches what sample_many would draw from it, rows are
+        then drawn one by one rather than in one vectorized call.
+        Note: when rng is None, every row holds the default values
+        """
+
+        if rng is not None and not isinstance(rng, np.random.Generator):
+            assert len(rng) == n, "expected one generator per row"
+            if n == 0:
+                return self.sample_batch(None, param_names, 0)
+            return np.concatenate([self.sample_batch(r, param_names, 1) for r in rng])
+
+        dtype = []
+        for name in param_names:
+            assert name in self.params, name
+            p = self.params[name]
+            field_type = float if p.type == "float" else np.int64
+            dtype.append((name, field_type, np.shape(p.default)))
+
+        batch = np.empty(n, dtype=dtype)
+
+        for name in param_names:
+            p = self.params[name]
+            size = (n,) + np.shape(p.default)
+
+            if rng is None:
+                batch[name] = p.default
+            elif p.type == "float":
+                batch[name] = rng.uniform(p.min, p.max, size=size)
+            elif p.type == "int":
+                batch[name] = rng.integers(p.min, p.max + 1, size=size)
+            else:
+                assert False
+
+        return batch
+
 
 # Default simulation parameters
 DEFAULT_PARAMS = DomainParams()
@@ -1,4 +1,3 @@
-import copy
 from itertools import chain
 
 problems = {
@@ -89,6 +88,14 @@ def get_problem_list():
     return list(problems.keys())
 
 def get_problem_instance(problem_instance):
-    start = copy.deepcopy(problems[problem_instance]['start'])
-    goal = copy.deepcopy(problems[problem_instance]['goal'])
+    # Custom problems of any shape can be passed as {'start': ..., 'goal': ...}
+    if isinstance(problem_instance, dict):
+        problem = problem_instance
+    else:
+        problem = problems[problem_instance]
+
+    start = [list(row) for row in problem['start']]
+    goal = [list(row) for row in problem['goal']]
+    assert len(set(map(len, start + goal))) == 1, "rows must have the same length"
+    assert len(start) == len(goal), "start and goal must have the same shape"
     return start, goal
\ No newline at end of file
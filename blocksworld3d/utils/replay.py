@@ -0,0 +1,121 @@
+import multiprocessing
+
+import numpy as np
+from gymnasium.utils import seeding
+
+from .problems import get_problem_instance
+from .symbolic import (
+    MAX_STACK_HEIGHT,
+    initial_state,
+    render_key,
+    rollout,
+    sample_start_col,
+)
+
+# Environment used to render states inside pool workers
+_worker_env = None
+
+
+def _make_env(env_kwargs):
+    # Imported here so that worker processes only load the renderer on demand
+    from ..blocksworld3d import BlocksWorld3D
+
+    env = BlocksWorld3D(**env_kwargs)
+    assert not env.domain_rand, "replay requires domain randomization to be disabled"
+    return env
+
+
+def _init_worker(env_kwargs):
+    global _worker_env
+    _worker_env = _make_env(env_kwargs)
+
+
+def _render_states(env, states):
+    frames = []
+    for state in states:
+        env.set_symbolic_state(state)
+        frames.append(env.render_obs())
+    return frames
+
+
+def _render_states_worker(states):
+    return _render_states(_worker_env, states)
+
+
+class ReplayEngine:
+    """
+    Regenerate observation sequences from logged episodes
+
+    Episodes are stored as (problem_instance, seed, actions) tuples. The
+    action logs are first run through the symbolic transitions, the visited
+    states are deduplicated, and each unique state is rendered only once.
+    """
+
+    def __init__(self, num_workers=0, size=8, **env_kwargs):
+        self.num_workers = num_workers
+        self.size = size
+        self.env_kwargs = dict(env_kwargs, size=size)
+        self.env = None
+
+    def rollout(self, problem_instance, seed, actions):
+        """
+        Compute the symbolic states visited by a logged episode
+        The seed must be the one passed to reset() when recording
+        """
+
+        assert seed is not None, "episodes must be recorded with an explicit seed"
+
+        start, _ = get_problem_instance(problem_instance)
+        rng, _ = seeding.np_random(seed)
+        start_col = sample_start_col(rng, len(start[0]))
+
+        max_height = self.env_kwargs.get("max_height", MAX_STACK_HEIGHT)
+        return rollout(initial_state(start, start_col), actions, max_height)
+
+    def render(self, episodes):
+        """
+        Render a list of (problem_instance, seed, actions) episodes
+        Returns one array of shape (len(actions) + 1, H, W, 3) per episode
+        """
+
+        # Map each visited state to the index of its unique render
+        unique_keys = {}
+        episode_idxs = []
+        for problem_instance, seed, actions in episodes:
+            states = self.rollout(problem_instance, seed, actions)
+            idxs = [
+                unique_keys.setdefault(render_key(s), len(unique_keys))
+                for s in states
+            ]
+            episode_idxs.append(np.array(idxs, dtype=np.int64))
+
+        frames = np.stack(self.render_states(list(unique_keys.keys())))
+
+        return [frames[idxs] for idxs in episode_idxs]
+
+    def render_states(self, states):
+        """
+        Render a list of symbolic states, optionally across a worker pool
+        """
+
+        if self.num_workers <= 1 or len(states) <= 1:
+            if self.env is None:
+                self.env = _make_env(self.env_kwargs)
+            return _render_states(self.env, states)
+
+        # Each worker owns its OpenGL context, so avoid forking the parent's
+        ctx = multiprocessing.get_context("spawn")
+        bounds = np.linspace(0, len(states), self.num_workers + 1).astype(int)
+        chunks = [states[a:b] for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+        with ctx.Pool(
+            len(chunks), initializer=_init_worker, initargs=(self.env_kwargs,)
+        ) as pool:
+            results = pool.map(_render_states_worker, chunks)
+
+        return [frame for chunk in results for frame in chunk]
+
+    def close(self):
+        if self.env is not None:
+            self.env.close()
+            self.env = None
@@ -0,0 +1,253 @@
+from collections import namedtuple
+from enum import IntEnum
+
+import numpy as np
+
+
+class Actions(IntEnum):
+    """
+    Enumeration of possible actions
+    """
+
+    # Turn left or right by a small amount
+    move_left = 0
+    move_right = 1
+
+    # Pick up or drop an object being carried
+    pickup = 2
+    drop = 3
+
+    # Toggle row
+    toggle_row = 4
+
+    # Done completing task
+    done = 5
+
+
+# Discrete state of a BlocksWorld3D episode
+# col       -- column the agent is facing
+# row       -- row currently selected by the agent
+# prev_move -- direction of the last successful lateral move (or None)
+# carrying  -- whether the agent is holding a block
+# heights   -- tuple of rows, each a tuple of stack heights
+SymbolicState = namedtuple(
+    "SymbolicState", ["col", "row", "prev_move", "carrying", "heights"]
+)
+
+# Macro-actions, see plan_macro
+# GotoColumn -- face the given column
+# MoveBlock  -- carry the top block of stack (row, src) onto stack (row, dst)
+GotoColumn = namedtuple("GotoColumn", ["col"])
+MoveBlock = namedtuple("MoveBlock", ["row", "src", "dst"])
+
+# Maximum number of blocks in a single stack
+MAX_STACK_HEIGHT = 5
+
+
+def sample_start_col(rng, num_cols):
+    """
+    Sample the starting column of the agent (first or last column)
+    """
+
+    return int(rng.choice((0, num_cols - 1)))
+
+
+def sample_start_cols(rng, num_cols):
+    """
+    Sample the starting columns of a batch of episodes
+    rng is one shared generator, drawn from in one call, or a list of
+    generators, one per episode, drawn from in turn
+    """
+
+    num_cols = np.asarray(num_cols)
+    if isinstance(rng, np.random.Generator):
+        first = rng.integers(0, 2, size=num_cols.shape) == 0
+    else:
+        first = np.array([r.integers(0, 2) == 0 for r in rng], dtype=bool)
+    return np.where(first, 0, num_cols - 1)
+
+
+def initial_state(start, start_col):
+    """
+    Build the symbolic state at the beginning of an episode
+    """
+
+    heights = tuple(tuple(row) for row in start)
+    return SymbolicState(
+        col=start_col, row=0, prev_move=None, carrying=False, heights=heights
+    )
+
+
+def transition(state, action, max_height=MAX_STACK_HEIGHT):
+    """
+    Apply one primitive action to a symbolic state
+    Mirrors the logic of BlocksWorld3D.step without any rendering
+    """
+
+    col, row, prev_move, carrying, heights = state
+    num_cols = len(heights[row])
+
+    if action == Actions.move_left or action == Actions.move_right:
+        lateral_dir = -1 if action == Actions.move_left else 1
+        next_col = col + lateral_dir
+
+        # Leaving the interior columns requires two presses in the same direction
+        if 0 <= next_col < num_cols:
+            if prev_move == lateral_dir or col == 0 or col == num_cols - 1:
+                return state._replace(col=next_col, prev_move=lateral_dir)
+
+    elif action == Actions.pickup:
+        if not carrying and heights[row][col] > 0:
+            return state._replace(
+                carrying=True, heights=_add_block(heights, row, col, -1)
+            )
+
+    elif action == Actions.drop:
+        if carrying and heights[row][col] < max_height:
+            return state._replace(
+                carrying=False, heights=_add_block(heights, row, col, 1)
+            )
+
+    elif action == Actions.toggle_row:
+        return state._replace(row=(row + 1) % len(heights))
+
+    return state
+
+
+def action_masks(col, row, prev_move, carrying, heights, max_height=MAX_STACK_HEIGHT):
+    """
+    Compute which actions change the state, for a batch of N states
+    col, row, prev_move (0 for None) and carrying have shape (N,),
+    heights has shape (N, rows, cols), and max_height is a scalar or has
+    shape (N,). Returns a (N, num_actions) bool array.
+    done never changes the state, it is only allowed when no other action
+    is, so that a masked policy always has an action to take.
+    """
+
+    col = np.asarray(col)
+    row = np.asarray(row)
+    prev_move = np.asarray(prev_move)
+    carrying = np.asarray(carrying, dtype=bool)
+    heights = np.asarray(heights)
+
+    num_rows, num_cols = heights.shape[1:]
+    height = heights[np.arange(len(col)), row, col]
+    at_edge = (col == 0) | (col == num_cols - 1)
+
+    masks = np.zeros((len(col), len(Actions)), dtype=bool)
+    masks[:, Actions.move_left] = (col > 0) & ((prev_move == -1) | at_edge)
+    masks[:, Actions.move_right] = (col < num_cols - 1) & ((prev_move == 1) | at_edge)
+    masks[:, Actions.pickup] = ~carrying & (height > 0)
+    masks[:, Actions.drop] = carrying & (height < max_height)
+    masks[:, Actions.toggle_row] = num_rows > 1
+    masks[:, Actions.done] = ~masks.any(axis=1)
+
+    return masks
+
+
+def action_mask(state, max_height=MAX_STACK_HEIGHT):
+    """
+    Mask of the actions that change a single symbolic state
+    """
+
+    return action_masks(
+        [state.col],
+        [state.row],
+        [state.prev_move or 0],
+        [state.carrying],
+        [state.heights],
+        max_height,
+    )[0]
+
+
+def rollout(state, actions, max_height=MAX_STACK_HEIGHT):
+    """
+    Run a sequence of actions through the symbolic transitions
+    Returns the list of visited states, including the initial one
+    """
+
+    states = [state]
+    for action in actions:
+        state = transition(state, action, max_height)
+        states.append(state)
+
+    return states
+
+
+def plan_macro(state, macro, max_height=MAX_STACK_HEIGHT):
+    """
+    Plan the primitive actions carrying out a macro-action from a state
+    Raises ValueError when the macro-action cannot be carried out
+    """
+
+    num_rows, num_cols = len(state.heights), len(state.heights[0])
+
+    if isinstance(macro, GotoColumn):
+        if not 0 <= macro.col < num_cols:
+            raise ValueError("no column %d" % macro.col)
+        return _plan_goto(state, macro.col)[0]
+
+    if isinstance(macro, MoveBlock):
+        if not 0 <= macro.row < num_rows:
+            raise ValueError("no row %d" % macro.row)
+        if not (0 <= macro.src < num_cols and 0 <= macro.dst < num_cols):
+            raise ValueError("no column %d or %d" % (macro.src, macro.dst))
+        if state.carrying:
+            raise ValueError("already carrying a block")
+        if state.heights[macro.row][macro.src] == 0:
+            raise ValueError("stack (%d, %d) is empty" % (macro.row, macro.src))
+        if macro.src != macro.dst and state.heights[macro.row][macro.dst] >= max_height:
+            raise ValueError("stack (%d, %d) is full" % (macro.row, macro.dst))
+
+        actions = [Actions.toggle_row] * ((macro.row - state.row) % num_rows)
+        state = state._replace(row=macro.row)
+
+        to_src, state = _plan_goto(state, macro.src)
+        to_dst, _ = _plan_goto(state, macro.dst)
+        return actions + to_src + [Actions.pickup] + to_dst + [Actions.drop]
+
+    raise ValueError("unknown macro-action %r" % (macro,))
+
+
+def _plan_goto(state, col):
+    """
+    Lateral moves to face a column, and the state reached
+    Interior columns can only be left in the direction of the last move,
+    so the agent may first have to go to the end of the row and come back.
+    Raises ValueError when the agent cannot move at all.
+    """
+
+    actions = []
+    while state.col != col:
+        toward = Actions.move_left if col < state.col else Actions.move_right
+        away = Actions.move_right if toward == Actions.move_left else Actions.move_left
+
+        action = toward
+        next_state = transition(state, toward)
+        if next_state == state:
+            action = away
+            next_state = transition(state, away)
+
+        # Interior column without a previous move, e.g. a custom start
+        if next_state == state:
+            raise ValueError("cannot move from column %d" % state.col)
+
+        actions.append(action)
+        state = next_state
+
+    return actions, state
+
+
+def render_key(state):
+    """
+    Key identifying states that produce identical observations
+    The previous move direction does not affect rendering
+    """
+
+    return state._replace(prev_move=None)
+
+
+def _add_block(heights, row, col, delta):
+    stacks = list(heights[row])
+    stacks[col] += delta
+    return heights[:row] + (tuple(stacks),) + heights[row + 1 :]
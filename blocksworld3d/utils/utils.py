@@ -11,6 +11,21 @@ def get_subdir_path(sub_dir):
     return dir_path
 
 
+def get_cache_dir(sub_dir):
+    """
+    Get the directory used to cache processed resource files on disk.
+    Defaults to ~/.cache/blocksworld3d and can be overridden with the
+    BLOCKSWORLD3D_CACHE_DIR environment variable.
+    """
+
+    cache_dir = os.environ.get(
+        "BLOCKSWORLD3D_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "blocksworld3d"),
+    )
+
+    return os.path.join(cache_dir, sub_dir)
+
+
 def get_file_path(sub_dir, file_name, default_ext):
     """
     Get the absolute path of a resource file, which may be relative to
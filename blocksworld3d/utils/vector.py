@@ -0,0 +1,223 @@
+import numpy as np
+from gymnasium import spaces
+from gymnasium.utils import seeding
+
+from ..blocksworld3d import BlocksWorld3D
+from .core import WORLD_PARAMS
+from .problems import get_problem_instance
+from .symbolic import Actions, action_masks, sample_start_col, sample_start_cols
+
+
+class BlocksWorld3DBatch:
+    """
+    Synchronous batch of BlocksWorld3D environments
+
+    Resets take one problem instance and seed per environment, plus a mask of
+    the environments to reset, so that only finished episodes are rebuilt.
+    Seeded resets draw the start column as env.reset(seed=seed) does, so
+    their episodes can be replayed from their seed. With per_env_rng, each
+    environment has its own random stream, so its episodes only depend on
+    its own seeds and not on the rest of the batch. Independent streams
+    cannot be drawn from at once, so seeded start columns, and the start
+    columns and domain randomization parameters of per_env_rng, are drawn
+    in a loop over the reset environments. Only with a single shared stream
+    and no seeds is each of them drawn in one vectorized call. With several
+    observation channels, the observations are dicts of arrays with one row
+    per environment.
+    """
+
+    def __init__(self, num_envs, seed=None, per_env_rng=True, **env_kwargs):
+        self.num_envs = num_envs
+        self.envs = [BlocksWorld3D(**env_kwargs) for _ in range(num_envs)]
+        self.per_env_rng = per_env_rng
+
+        # Shared stream, and one independent child stream per environment
+        seed_seq = np.random.SeedSequence(seed)
+        self.np_random = np.random.default_rng(seed_seq)
+        self.env_rngs = [np.random.default_rng(s) for s in seed_seq.spawn(num_envs)]
+
+        env = self.envs[0]
+        self.params = env.params
+        self.domain_rand = env.domain_rand
+
+        # With composited observations, all the environments share their
+        # prerendered layers and are composited in one batch
+        self.compositor = env.compositor
+        for env in self.envs:
+            env.compositor = self.compositor
+
+        # Last observation of each environment, one array per channel when
+        # the observations are dicts
+        space = env.observation_space
+        if isinstance(space, spaces.Dict):
+            self.obs = {
+                name: np.zeros((num_envs,) + s.shape, dtype=s.dtype)
+                for name, s in space.spaces.items()
+            }
+        else:
+            self.obs = np.zeros((num_envs,) + space.shape, dtype=space.dtype)
+        self.infos = [{} for _ in range(num_envs)]
+
+    def reset(self, problem_instances, seeds=None, mask=None):
+        """
+        Reset the environments selected by mask (all of them by default)
+        problem_instances and seeds hold one entry per environment, entries
+        of environments that are not reset are ignored.
+        Returns the observations and infos of all the environments.
+        """
+
+        if isinstance(problem_instances, (str, dict)):
+            problem_instances = [problem_instances] * self.num_envs
+        assert len(problem_instances) == self.num_envs
+
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+        idxs = np.flatnonzero(mask)
+
+        if seeds is None:
+            env_seeds = [None] * len(idxs)
+        else:
+            env_seeds = [int(seeds[i]) for i in idxs]
+            for i, seed in zip(idxs, env_seeds):
+                # Child of the seed, so it differs from the env's own stream
+                self.env_rngs[i] = np.random.default_rng(
+                    np.random.SeedSequence(seed).spawn(1)[0]
+                )
+
+        if self.per_env_rng:
+            rng = [self.env_rngs[i] for i in idxs]
+        elif seeds is None:
+            rng = self.np_random
+        else:
+            # Reproducible draws for a given set of seeds
+            rng = np.random.default_rng(env_seeds)
+
+        num_cols = [len(get_problem_instance(problem_instances[i])[0][0]) for i in idxs]
+        if seeds is None:
+            start_cols = sample_start_cols(rng, num_cols)
+        else:
+            # Same draw as env.reset(seed=seed), so that episodes can be
+            # replayed from their seed, see ReplayEngine.rollout
+            start_cols = [
+                sample_start_col(seeding.np_random(seed)[0], n)
+                for seed, n in zip(env_seeds, num_cols)
+            ]
+        world_params = self.params.sample_batch(
+            rng if self.domain_rand else None, WORLD_PARAMS, len(idxs)
+        )
+
+        for j, i in enumerate(idxs):
+            options = {
+                'problem_instance': problem_instances[i],
+                'start_col': int(start_cols[j]),
+                'domain_params': world_params[j],
+            }
+            if self.compositor is None:
+                obs, self.infos[i] = self.envs[i].reset(seed=env_seeds[j], options=options)
+                self._store_obs(i, obs)
+            else:
+                self.envs[i]._reset_world(seed=env_seeds[j], options=options)
+                self.infos[i] = self.envs[i]._get_info()
+
+        if self.compositor is not None and len(idxs) > 0:
+            self.obs[idxs] = self.compositor.compose([self.envs[i] for i in idxs])
+
+        return self._copy_obs(), list(self.infos)
+
+    def step(self, actions):
+        """
+        Step every environment, finished episodes are not reset automatically,
+        pass terminations | truncations as the mask of the next reset call
+        """
+
+        assert len(actions) == self.num_envs
+
+        rewards = np.zeros(self.num_envs, dtype=float)
+        terminations = np.zeros(self.num_envs, dtype=bool)
+        truncations = np.zeros(self.num_envs, dtype=bool)
+
+        if self.compositor is None:
+            for i, (env, action) in enumerate(zip(self.envs, actions)):
+                obs, rewards[i], terminations[i], truncations[i], self.infos[i] = env.step(action)
+                self._store_obs(i, obs)
+        else:
+            for i, (env, action) in enumerate(zip(self.envs, actions)):
+                rewards[i], terminations[i], truncations[i] = env._step_repeat(action)
+            self.obs[:] = self.compositor.compose(self.envs)
+            for i, env in enumerate(self.envs):
+                self.infos[i] = env._get_info()
+
+        return self._copy_obs(), rewards, terminations, truncations, list(self.infos)
+
+    def step_macro(self, macros):
+        """
+        Execute one macro-action in every environment, see
+        BlocksWorld3D.step_macro, and render only the final frames
+        All the macro-actions are planned before any environment is stepped,
+        so that an impossible one raises ValueError with the batch unchanged.
+        """
+
+        assert len(macros) == self.num_envs
+        plans = [env.plan_macro(macro) for env, macro in zip(self.envs, macros)]
+
+        rewards = np.zeros(self.num_envs, dtype=float)
+        terminations = np.zeros(self.num_envs, dtype=bool)
+        truncations = np.zeros(self.num_envs, dtype=bool)
+        num_steps = np.zeros(self.num_envs, dtype=int)
+
+        for i, (env, actions) in enumerate(zip(self.envs, plans)):
+            rewards[i], terminations[i], truncations[i], num_steps[i] = env._step_plan(actions)
+
+        if self.compositor is None:
+            for i, env in enumerate(self.envs):
+                self._store_obs(i, env.render_obs())
+        else:
+            self.obs[:] = self.compositor.compose(self.envs)
+
+        for i, env in enumerate(self.envs):
+            self.infos[i] = env._get_info()
+            self.infos[i]['num_steps'] = int(num_steps[i])
+
+        return self._copy_obs(), rewards, terminations, truncations, list(self.infos)
+
+    def _store_obs(self, i, obs):
+        if isinstance(self.obs, dict):
+            for name, channel in obs.items():
+                self.obs[name][i] = channel
+        else:
+            self.obs[i] = obs
+
+    def _copy_obs(self):
+        if isinstance(self.obs, dict):
+            return {name: channel.copy() for name, channel in self.obs.items()}
+        return self.obs.copy()
+
+    def action_masks(self):
+        """
+        Valid-action masks of all the environments, shape (num_envs, num_actions)
+        The states of the environments with the same layout are masked in a
+        single batched call, see symbolic.action_masks.
+        """
+
+        masks = np.zeros((self.num_envs, len(Actions)), dtype=bool)
+
+        layouts = {}
+        for i, env in enumerate(self.envs):
+            layouts.setdefault(env.grid.heights.shape, []).append(i)
+
+        for idxs in layouts.values():
+            envs = [self.envs[i] for i in idxs]
+            masks[idxs] = action_masks(
+                col=[env.grid.col_at(env.agent.pos) for env in envs],
+                row=[env.cur_row for env in envs],
+                prev_move=[env.prev_move or 0 for env in envs],
+                carrying=[env.agent.carrying is not None for env in envs],
+                heights=np.stack([env.grid.heights for env in envs]),
+                max_height=np.array([env.grid.max_height for env in envs]),
+            )
+
+        return masks
+
+    def close(self):
+        for env in self.envs:
+            env.close()
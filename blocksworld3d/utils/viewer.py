@@ -0,0 +1,287 @@
+"""
+Human viewer running in a separate process
+
+The environment sends frames and state text to the viewer, which draws them
+in its own pyglet window. Frames are sent from a background thread, and only
+the latest frame is kept when the viewer falls behind, so stepping is never
+blocked by the display. Closing does not hang on a viewer that stopped
+reading either. The viewer is either spawned locally, or listens on a
+socket so it can run on another machine:
+
+    BLOCKSWORLD3D_VIEWER_KEY=secret python -m blocksworld3d.utils.viewer --port 6000
+
+Socket connections are authenticated with a secret key, shared by both ends.
+Frames are sent as raw pixels behind a small header, nothing received by
+the viewer is unpickled.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+from ctypes import POINTER
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+# Environment variable holding the key of the remote viewer connections
+AUTHKEY_ENV = "BLOCKSWORLD3D_VIEWER_KEY"
+
+# Largest frame message accepted by the viewer, in bytes
+MAX_MESSAGE_BYTES = 64 * 2**20
+
+# Time given to the viewer to take the last frame when closing, in seconds
+CLOSE_TIMEOUT = 1
+
+# Display width of the observation, next to the main view
+OBS_DISP_WIDTH = 256
+
+
+class RemoteViewer:
+    """
+    Sending end of the viewer, owned by the environment
+    """
+
+    def __init__(self, address=None, max_fps=30, authkey=None):
+        self.min_interval = 1 / max_fps
+        self.last_send = -float("inf")
+
+        if address is None:
+            # Spawn rather than fork, the viewer creates its own context
+            ctx = multiprocessing.get_context("spawn")
+            recv_conn, self.conn = ctx.Pipe(duplex=False)
+            self.process = ctx.Process(target=run_viewer, args=(recv_conn,), daemon=True)
+            self.process.start()
+            recv_conn.close()
+        else:
+            self.process = None
+            self.conn = Client(tuple(address), authkey=get_authkey(authkey))
+
+        # Latest frame not sent yet, replaced by newer frames
+        self.pending = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._send_loop, daemon=True)
+        self.thread.start()
+
+    def ready(self):
+        """
+        Check if enough time has passed to send another frame
+        """
+
+        return not self.closed and time.monotonic() - self.last_send >= self.min_interval
+
+    def send(self, img, obs, text):
+        """
+        Queue a frame for display without waiting for it to be sent
+        """
+
+        self.last_send = time.monotonic()
+
+        with self.cond:
+            self.pending = (img, obs, text)
+            self.cond.notify()
+
+    def _send_loop(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                frame, self.pending = self.pending, None
+
+            if frame is None:
+                break
+
+            try:
+                self.conn.send_bytes(encode_frame(*frame))
+            except (OSError, EOFError):
+                # The viewer window was closed
+                self.closed = True
+                break
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout=CLOSE_TIMEOUT)
+
+        if self.thread.is_alive():
+            # The viewer stopped reading and the last frame is stuck. Closing
+            # the connection does not wake up a blocked write, so break the
+            # other end instead, which makes the send fail.
+            if self.process is not None:
+                self.process.terminate()
+            else:
+                try:
+                    with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+                        sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.thread.join(timeout=CLOSE_TIMEOUT)
+        else:
+            try:
+                self.conn.send_bytes(b"")
+            except (OSError, EOFError):
+                pass
+        self.conn.close()
+
+        if self.process is not None:
+            self.process.join(timeout=1)
+
+
+def get_authkey(authkey=None):
+    """
+    Secret key of the remote viewer connections, from the argument or the
+    BLOCKSWORLD3D_VIEWER_KEY environment variable
+    """
+
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError("remote viewers need a secret key, set %s" % AUTHKEY_ENV)
+
+    return authkey.encode() if isinstance(authkey, str) else bytes(authkey)
+
+
+def encode_frame(img, obs, text):
+    """
+    Frame message: the length of a JSON header holding the image shapes and
+    the state text, the header, then the uint8 pixels of the images
+    """
+
+    images = [np.ascontiguousarray(a, dtype=np.uint8) for a in (img, obs) if a is not None]
+    header = json.dumps({"shapes": [a.shape for a in images], "text": text}).encode()
+
+    return b"".join([struct.pack(">I", len(header)), header] + [a.tobytes() for a in images])
+
+
+def decode_frame(data):
+    """
+    Images and text of a frame message, see encode_frame
+    Raises ValueError on malformed messages
+    """
+
+    (header_len,) = struct.unpack_from(">I", data)
+    header = json.loads(data[4 : 4 + header_len])
+    offset = 4 + header_len
+
+    images = []
+    for shape in header["shapes"][:2]:
+        shape = tuple(int(n) for n in shape)
+        if len(shape) != 3 or shape[2] != 3 or min(shape) <= 0:
+            raise ValueError("frames must be RGB images")
+
+        size = shape[0] * shape[1] * shape[2]
+        images.append(np.frombuffer(data, np.uint8, size, offset).reshape(shape))
+        offset += size
+
+    if not images or offset != len(data):
+        raise ValueError("malformed frame message")
+
+    img = images[0]
+    obs = images[1] if len(images) > 1 else None
+    return img, obs, str(header["text"])
+
+
+def run_viewer(conn):
+    """
+    Display the frames received on a connection until it is closed
+    """
+
+    import pyglet
+
+    window = None
+    label = None
+
+    while window is None or not window.has_exit:
+        if window is not None:
+            window.dispatch_events()
+
+        try:
+            if not conn.poll(0.01):
+                continue
+            data = conn.recv_bytes(MAX_MESSAGE_BYTES)
+        except (OSError, EOFError):
+            break
+
+        if not data:
+            break
+
+        try:
+            img, obs, text = decode_frame(data)
+        except (ValueError, KeyError, TypeError, struct.error):
+            continue
+        img_height, img_width = img.shape[:2]
+
+        if window is None:
+            obs_disp_height = 0 if obs is None else OBS_DISP_WIDTH * obs.shape[0] // obs.shape[1]
+            window = pyglet.window.Window(
+                width=img_width + OBS_DISP_WIDTH + 200,
+                height=max(img_height, obs_disp_height),
+                resizable=False,
+                caption="BlocksWorld3D",
+            )
+            label = pyglet.text.Label(
+                font_name="Arial",
+                font_size=14,
+                multiline=True,
+                width=400,
+                x=img_width + 5,
+                y=window.height - (obs_disp_height + 19),
+            )
+
+        window.switch_to()
+        window.clear()
+
+        _blit(pyglet, img, 0, 0, img_width, img_height)
+        if obs is not None:
+            obs_disp_height = OBS_DISP_WIDTH * obs.shape[0] // obs.shape[1]
+            _blit(pyglet, obs, img_width, img_height - obs_disp_height, OBS_DISP_WIDTH, obs_disp_height)
+
+        label.text = text
+        label.draw()
+
+        window.flip()
+
+    if window is not None:
+        window.close()
+    conn.close()
+
+
+def _blit(pyglet, img, x, y, width, height):
+    # pyglet images start from the bottom row
+    img = np.ascontiguousarray(np.flip(img, axis=0))
+    img_data = pyglet.image.ImageData(
+        img.shape[1],
+        img.shape[0],
+        "RGB",
+        img.ctypes.data_as(POINTER(pyglet.gl.GLubyte)),
+        pitch=img.shape[1] * 3,
+    )
+    img_data.blit(x, y, 0, width=width, height=height)
+
+
+def serve(host, port, authkey=None):
+    """
+    Wait for an environment to connect, then display its frames
+    """
+
+    with Listener((host, port), authkey=get_authkey(authkey)) as listener:
+        print("Waiting for an environment on %s:%d" % (host, port))
+        with listener.accept() as conn:
+            run_viewer(conn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6000)
+    # Secret key of the connections, BLOCKSWORLD3D_VIEWER_KEY by default
+    parser.add_argument("--authkey", default=None)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.authkey)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from blocksworld3d.utils.problems import get_problem_instance, get_problem_list
+from blocksworld3d.utils.symbolic import (
+    Actions,
+    action_mask,
+    initial_state,
+    transition,
+)
+
+
+def test_action_mask_matches_transition():
+    rng = np.random.default_rng(0)
+
+    for problem in get_problem_list():
+        start, _ = get_problem_instance(problem)
+        for start_col in (0, len(start[0]) - 1):
+            state = initial_state(start, start_col)
+            for _ in range(200):
+                changes = [transition(state, action) != state for action in Actions]
+                expected = np.array(changes[: Actions.done] + [not any(changes)])
+                np.testing.assert_array_equal(action_mask(state), expected)
+                state = transition(state, rng.integers(len(Actions)))
+
+
+def test_action_mask_allows_done_when_stuck():
+    # Interior column without a previous move, single row, nothing to carry
+    state = initial_state([[0, 0, 0]], 1)
+
+    mask = action_mask(state)
+    assert mask[Actions.done] and mask.sum() == 1
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from blocksworld3d.utils.symbolic import MoveBlock
+from blocksworld3d.utils.vector import BlocksWorld3DBatch
+
+
+def test_step_macro_impossible_leaves_batch_unchanged():
+    batch = BlocksWorld3DBatch(3)
+    batch.reset("stairs", seeds=[0, 1, 2])
+    states = [env.symbolic_state for env in batch.envs]
+
+    # Stack (0, 2) of the stairs problem is empty
+    macros = [MoveBlock(row=0, src=0, dst=3)] * 2 + [MoveBlock(row=0, src=2, dst=1)]
+    with pytest.raises(ValueError):
+        batch.step_macro(macros)
+
+    assert [env.symbolic_state for env in batch.envs] == states
+    batch.close()
+
+
+def test_action_masks_match_envs():
+    batch = BlocksWorld3DBatch(4)
+    # Two layouts, masked in separate calls
+    custom = {"start": [[1, 0, 2]], "goal": [[0, 1, 2]]}
+    batch.reset(["stairs", "gap", "stairs", custom], seeds=[0, 1, 2, 3])
+    rng = np.random.default_rng(0)
+
+    for _ in range(20):
+        expected = np.stack([env.action_masks() for env in batch.envs])
+        np.testing.assert_array_equal(batch.action_masks(), expected)
+        batch.step(rng.integers(5, size=batch.num_envs))
+    batch.close()